@@ -3,6 +3,7 @@ import json
 import requests
 from collections import OrderedDict
 from ..common.backends.base import OutputBaseBackend
+from ..common.exceptions import OutputBackendUnavailableError
 
 LOG = logging.getLogger("Elastic Backend")
 
@@ -65,8 +66,10 @@ class ElasticsearchOutputBackend(OutputBaseBackend):
             except: 
                 LOG.warning("Elastic: checking index %s failed! Bulk indexing may fail...", index)
         LOG.info("Elastic: indexing %s docs" % c)
-        self.index_bulk(bulk)
-        self.close()
+        try:
+            self.index_bulk(bulk)
+        finally:
+            self.close()
 
     def index_bulk(self, bulk):
         """Do a bulk indexing into elasticsearch"""
@@ -80,6 +83,12 @@ class ElasticsearchOutputBackend(OutputBaseBackend):
             LOG.error("Error connecting to Elasticsearch: %s", e)
         if r is None:
             LOG.error("Could not get response from elastic, bulk indexing may have failed!")
+            raise OutputBackendUnavailableError(self.get_backend_name(),
+                                                "no response to the bulk request")
+        elif r.status_code >= 500:
+            LOG.warning("Got http error from elastic: %s %s" , r.status_code , r.text)
+            raise OutputBackendUnavailableError(self.get_backend_name(),
+                                                "http error %s" % r.status_code)
         else:
             if r.status_code != 200:
                 LOG.warning("Got http error from elastic: %s %s" , r.status_code , r.text)
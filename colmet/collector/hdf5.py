@@ -3,7 +3,11 @@ stdout backend : print information to stdout
 '''
 import logging
 import os
+import time
+from collections import OrderedDict
 
+import numpy
+from colmet.common.batch import merge_batches
 from colmet.common.metrics import get_counters_class
 from colmet.common.backends.base import OutputBaseBackend
 import tables
@@ -13,8 +17,104 @@ LOG = logging.getLogger()
 
 HDF5_BACKEND_VERSION = 2
 
+# The appended rows are flushed when there are DEFAULT_FLUSH_ROWS of them or
+# DEFAULT_FLUSH_INTERVAL seconds after the previous flush
+DEFAULT_FLUSH_ROWS = 100000
+DEFAULT_FLUSH_INTERVAL = 5
 
-class HDF5TaskstatsCounters(object):
+
+def subset_table_description(description, counters_class):
+    '''
+    Return the columns of a table description kept by a subset of counters
+    (see subset_counters_class)
+    '''
+    return dict((name, column)
+                for (name, column) in description.columns.items()
+                if name in counters_class._header_definitions
+                or name in counters_class._counter_definitions)
+
+
+def _warn_missing(hdf5_class, key, error):
+    if key not in hdf5_class.missing_keys:
+        hdf5_class.missing_keys.append(key)
+        LOG.warning(error)
+
+
+def to_records(hdf5_class, table, counters_list):
+    '''
+    Return counters of the same class as a structured array of the dtype of
+    their table, appended at once. The values which cannot be read or stored
+    keep the default of their column and are logged once.
+    '''
+    records = numpy.empty(len(counters_list), dtype=table.dtype)
+    for name in table.colnames:
+        records[name] = table.coldflts[name]
+    counters_class = type(counters_list[0])
+    fields = [(key, counters_class._get_header)
+              for key in hdf5_class.Counters._header_definitions]
+    fields += [(key, counters_class._get_counter)
+               for key in counters_class._counter_definitions]
+    for (key, get_value) in fields:
+        if key not in table.coldtypes:
+            _warn_missing(hdf5_class, key,
+                          KeyError("no column named \"%s\"" % key))
+            continue
+        try:
+            records[key] = [get_value(counters, key)
+                            for counters in counters_list]
+        except Exception:
+            column = records[key]
+            for (index, counters) in enumerate(counters_list):
+                try:
+                    column[index] = get_value(counters, key)
+                except Exception as e:
+                    _warn_missing(hdf5_class, key, e)
+    return records
+
+
+def batch_records(hdf5_class, table, batch):
+    '''
+    Return the records of a CounterBatch as a structured array of the dtype
+    of their table, the columns are projected and cast by numpy
+    '''
+    array = batch.array
+    records = numpy.empty(len(array), dtype=table.dtype)
+    for name in table.colnames:
+        if name in array.dtype.names:
+            records[name] = array[name]
+        else:
+            records[name] = table.coldflts[name]
+    for name in array.dtype.names:
+        if name not in table.coldtypes:
+            _warn_missing(hdf5_class, name,
+                          KeyError("no column named \"%s\"" % name))
+    return records
+
+
+class HDF5Counters(object):
+    '''
+    Table of the counters of a metric backend, the subclasses give the
+    counters class, the table description and their missing_keys
+    '''
+    Counters = None
+    HDF5TableDescription = None
+
+    @classmethod
+    def get_table_description(cls):
+        return cls.HDF5TableDescription
+
+    @classmethod
+    def to_counters(cls, row):
+        counters = cls.Counters()
+        for key in list(cls.Counters._header_definitions):
+            counters._set_header(key, row[key])
+
+        for key in list(cls.Counters._counter_definitions):
+            counters._set_counter(key, row[key])
+        return counters
+
+
+class HDF5TaskstatsCounters(HDF5Counters):
     Counters = get_counters_class("taskstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -57,39 +157,8 @@ class HDF5TaskstatsCounters(object):
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
-
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
 
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
-
-class HDF5ProcstatsCounters(object):
+class HDF5ProcstatsCounters(HDF5Counters):
     Counters = get_counters_class("procstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -178,38 +247,8 @@ class HDF5ProcstatsCounters(object):
         
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
 
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
-
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
-class HDF5PerfhwCounters(object):
+class HDF5PerfhwCounters(HDF5Counters):
     Counters = get_counters_class("perfhwstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -226,39 +265,8 @@ class HDF5PerfhwCounters(object):
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
-
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
 
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
-
-class HDF5RAPLStatsCounters(object):
+class HDF5RAPLStatsCounters(HDF5Counters):
     Counters = get_counters_class("RAPLstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -295,39 +303,8 @@ class HDF5RAPLStatsCounters(object):
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
-
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
-
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
 
-
-class HDF5InfinibandStatsCounters(object):
+class HDF5InfinibandStatsCounters(HDF5Counters):
     Counters = get_counters_class("infinibandstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -342,42 +319,12 @@ class HDF5InfinibandStatsCounters(object):
         portRcvData = tables.Int64Col(dflt=-1)
         portXmitPkts = tables.Int64Col(dflt=-1)
         portRcvPkts = tables.Int64Col(dflt=-1)
+        port = tables.StringCol(255)
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
-
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
-
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
 
-class HDF5TemperatureStatsCounters(object):
+class HDF5TemperatureStatsCounters(HDF5Counters):
     Counters = get_counters_class("temperaturestats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -390,39 +337,8 @@ class HDF5TemperatureStatsCounters(object):
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
-
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
-
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
 
-class HDF5LustreStatsCounters(object):
+class HDF5LustreStatsCounters(HDF5Counters):
     Counters = get_counters_class("lustrestats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -440,39 +356,8 @@ class HDF5LustreStatsCounters(object):
         
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
-
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
 
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
-
-class JobprocstatsCounters(object):
+class JobprocstatsCounters(HDF5Counters):
     Counters = get_counters_class("jobprocstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -492,39 +377,8 @@ class JobprocstatsCounters(object):
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
 
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
-
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
-
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-
-
-class IpmipowerstatsCounters(object):
+class IpmipowerstatsCounters(HDF5Counters):
     Counters = get_counters_class("ipmipowerstats_default")
 
     class HDF5TableDescription(tables.IsDescription):
@@ -539,39 +393,36 @@ class IpmipowerstatsCounters(object):
 
     missing_keys = []
 
-    @classmethod
-    def get_table_description(cls):
-        return cls.HDF5TableDescription
 
-    @classmethod
-    def to_counters(cls, row):
-        counters = cls.Counters()
-        for key in list(cls.Counters._header_definitions):
-            counters._set_header(key, row[key])
+class HDF5CgroupstatsCounters(HDF5Counters):
+    Counters = get_counters_class("cgroupstats_default")
 
-        for key in list(cls.Counters._counter_definitions):
-            counters._set_counter(key, row[key])
-        return counters
+    class HDF5TableDescription(tables.IsDescription):
+        timestamp = tables.Int64Col(dflt=-1)
+        hostname = tables.StringCol(255)
+        job_id = tables.Int64Col(dflt=-1)
+        metric_backend = tables.StringCol(255)
 
-    @classmethod
-    def to_row(cls, row, counters):
-        for key in list(cls.Counters._header_definitions):
-            try:
-                row[key] = counters._get_header(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
-        for key in list(cls.Counters._counter_definitions):
-            try:
-                row[key] = counters._get_counter(key)
-            except Exception as e:
-                if key not in cls.missing_keys:
-                    cls.missing_keys.append(key)
-                    LOG.warning(e)
+        cpu_usage_usec = tables.Int64Col(dflt=-1)
+        cpu_user_usec = tables.Int64Col(dflt=-1)
+        cpu_system_usec = tables.Int64Col(dflt=-1)
+        cpu_nr_throttled = tables.Int64Col(dflt=-1)
+        cpu_throttled_usec = tables.Int64Col(dflt=-1)
+        memory_current = tables.Int64Col(dflt=-1)
+        memory_peak = tables.Int64Col(dflt=-1)
+        memory_anon = tables.Int64Col(dflt=-1)
+        memory_file = tables.Int64Col(dflt=-1)
+        memory_shmem = tables.Int64Col(dflt=-1)
+        memory_pgfault = tables.Int64Col(dflt=-1)
+        memory_pgmajfault = tables.Int64Col(dflt=-1)
+        io_rbytes = tables.Int64Col(dflt=-1)
+        io_wbytes = tables.Int64Col(dflt=-1)
+        io_rios = tables.Int64Col(dflt=-1)
+        io_wios = tables.Int64Col(dflt=-1)
+
+    missing_keys = []
 
 
-                    
 class HDF5OutputBackend(OutputBaseBackend):
     '''
     stdout backend class
@@ -581,6 +432,17 @@ class HDF5OutputBackend(OutputBaseBackend):
     def open(self):
         self.stat_buffer = dict()
         self.jobs = {}
+        if getattr(self.options, 'hdf5_flush_rows', None) is not None:
+            self.flush_rows = self.options.hdf5_flush_rows
+        else:
+            self.flush_rows = DEFAULT_FLUSH_ROWS
+        if getattr(self.options, 'hdf5_flush_interval', None) is not None:
+            self.flush_interval = self.options.hdf5_flush_interval
+        else:
+            self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        # rows appended since the last flush
+        self.unflushed_rows = 0
+        self.last_flush = time.time()
 
     def _get_job_stat(self, job_id):
         if job_id not in self.jobs:
@@ -591,6 +453,19 @@ class HDF5OutputBackend(OutputBaseBackend):
         for job_file in self.jobs.values():
             job_file.close_job_file()
 
+    def flush(self):
+        '''
+        Write the appended rows of every file
+        '''
+        hdf5_files = dict((id(job.job_file), job.job_file)
+                          for job in self.jobs.values()
+                          if job.job_file is not None and job.job_file.isopen)
+        for hdf5_file in hdf5_files.values():
+            hdf5_file.flush()
+        LOG.debug("HDF5: Flushed %s rows" % self.unflushed_rows)
+        self.unflushed_rows = 0
+        self.last_flush = time.time()
+
     def push(self, counters_list):
         '''
         put the metrics to the output backend
@@ -608,6 +483,41 @@ class HDF5OutputBackend(OutputBaseBackend):
             jobstat.append_stats(c_list)
             c+=len(c_list)
         LOG.info("HDF5: Pushed %s metrics" % c) 
+        self._appended(c)
+
+    def push_batches(self, batches):
+        '''
+        put the records of CounterBatch to the output backend, they are
+        split by job and appended without counters objects
+        '''
+        c = 0
+        for batch in merge_batches(batches):
+            for (job_id, job_batch) in batch.iter_jobs():
+                self._get_job_stat(job_id).append_batch(job_batch)
+            c += len(batch)
+        LOG.info("HDF5: Pushed %s metrics" % c)
+        self._appended(c)
+
+    @property
+    def tick_interval(self):
+        return self.flush_interval
+
+    def tick(self):
+        '''
+        Flush the rows appended flush_interval seconds ago when nothing was
+        pushed since
+        '''
+        if self.unflushed_rows and \
+                time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _appended(self, rows):
+        self.unflushed_rows += rows
+        if self.unflushed_rows >= self.flush_rows:
+            self.flush()
+        else:
+            self.tick()
+
 
 class FileAccess(object):
     '''
@@ -653,7 +563,8 @@ class JobFile(object):
         'RAPLstats_default': HDF5RAPLStatsCounters,
         'perfhwstats_default': HDF5PerfhwCounters,
         'jobprocstats_default': JobprocstatsCounters,
-        'ipmipowerstats_default': IpmipowerstatsCounters
+        'ipmipowerstats_default': IpmipowerstatsCounters,
+        'cgroupstats_default': HDF5CgroupstatsCounters
     }
     path_level = 4
 
@@ -718,7 +629,7 @@ class JobFile(object):
             self.job_file.create_group(root, group_name)
 
 
-    def _init_job_table_if_needed(self, metric_backend):
+    def _init_job_table_if_needed(self, metric_backend, counters_class=None):
 
         group_name = "job_%s" % self.job_id
         group_path = "/%s" % group_name
@@ -734,10 +645,16 @@ class JobFile(object):
                 )
 
             job_metric_hdf5_class = self.hdf5_counters[metric_backend]
+            description = job_metric_hdf5_class.get_table_description()
+            if counters_class is not None and \
+                    counters_class._subset_of is not None:
+                # the table only has the columns sent by the nodes
+                description = subset_table_description(description,
+                                                       counters_class)
             self.job_file.create_table(
                 group_path,
                 table_name,
-                job_metric_hdf5_class.get_table_description(),
+                description,
                 "Metrics for the Job %s" % self.job_id
             )
             self.job_table[metric_backend] = self.job_file.get_node(table_path)
@@ -749,16 +666,35 @@ class JobFile(object):
             
 
     def append_stats(self, stats):
+        '''
+        Append the counters of the job, with one append per table. The rows
+        are flushed by the output backend.
+        '''
+        if self.job_file is None:
+            self._init_job_file_if_needed()
+        # (metric backend, counters class) -> counters
+        groups = OrderedDict()
         for stat in stats:
-            metric_backend = stat.metric_backend
-            if self.job_file is None:
-                self._init_job_file_if_needed()
-
+            groups.setdefault((stat.metric_backend, type(stat)),
+                              []).append(stat)
+        for ((metric_backend, counters_class), c_list) in groups.items():
             if metric_backend not in self.job_table:
-                self._init_job_table_if_needed(metric_backend)
-
-            row = self.job_table[metric_backend].row
+                self._init_job_table_if_needed(metric_backend,
+                                               counters_class)
+            table = self.job_table[metric_backend]
             job_metric_hdf5_class = self.hdf5_counters[metric_backend]
-            job_metric_hdf5_class.to_row(row, stat)
-            row.append()
-            self.job_table[metric_backend].flush()
+            table.append(to_records(job_metric_hdf5_class, table, c_list))
+
+    def append_batch(self, batch):
+        '''
+        Append the records of a CounterBatch of the job
+        '''
+        if self.job_file is None:
+            self._init_job_file_if_needed()
+        metric_backend = batch.counters_class.__metric_name__
+        if metric_backend not in self.job_table:
+            self._init_job_table_if_needed(metric_backend,
+                                           batch.counters_class)
+        table = self.job_table[metric_backend]
+        job_metric_hdf5_class = self.hdf5_counters[metric_backend]
+        table.append(batch_records(job_metric_hdf5_class, table, batch))
@@ -6,16 +6,22 @@ import argparse
 import signal
 import sys
 import copy
+import math
 import time
 
 from colmet import VERSION
-from colmet.common.backends.zeromq import ZMQInputBackend
+from colmet.collector.output import (OutputQueue, count_counters,
+                                     parse_queue_policies, queue_policy)
 from colmet.common.backends.base import StdoutBackend
-from colmet.common.exceptions import Error, NoneValueError
+from colmet.common.exceptions import Error
+from colmet.common.metrics import clear_missing_metrics
 
 
 LOG = logging.getLogger()
 
+# Maximum number of messages read before checking the flush conditions
+DRAIN_MESSAGES = 1000
+
 
 class Task(object):
 
@@ -23,30 +29,62 @@ class Task(object):
         self.name = name
         self.options = options
         self.output_backends = []
+        # one queue per output backend
+        self.output_queues = []
         self.init_output_backends()
+        from colmet.common.backends.zeromq import ZMQInputBackend
         self.input_backend = ZMQInputBackend(self.options)
+        # counters, or CounterBatch when the output backends take them
         self.counters_list = []
+        self.queued_counters = 0
         self.buffer_size = self.options.buffer_size
+        # the counters are flushed when there are buffer_size of them or
+        # flush_interval seconds after the first one was received
+        if self.options.flush_interval is not None:
+            self.flush_interval = self.options.flush_interval / 1000.
+        else:
+            self.flush_interval = self.options.sampling_period
+        self.flush_deadline = None
+        self.flushes = 0
+        self.flushed_counters = 0
+        self.running = True
 
     def init_output_backends(self):
+        for output_queue in self.output_queues:
+            output_queue.close()
         for backend in self.output_backends:
             backend.close()
             del backend
         self.output_backends[:] = []
+        self.output_queues[:] = []
         options = copy.deepcopy(self.options)
+        backends = []
         if options.hdf5_filepath is not None:
             if not options.hdf5_filepath.endswith(".hdf5"):
                 options.hdf5_filepath = "%s.%s.hdf5" % \
                     (options.hdf5_filepath, int(time.time()))
             from colmet.collector.hdf5 import HDF5OutputBackend
-            self.output_backends.append(HDF5OutputBackend(options))
+            backends.append(HDF5OutputBackend(options))
         if self.options.enable_stdout_backend:
-            self.output_backends.append(StdoutBackend(options))
+            backends.append(StdoutBackend(options))
         if self.options.elastic_host is not None:
             from colmet.collector.elasticsearch import ElasticsearchOutputBackend
-            self.output_backends.append(ElasticsearchOutputBackend(options))
-        for backend in self.output_backends:
+            backends.append(ElasticsearchOutputBackend(options))
+        for backend in backends:
             backend.open()
+            self.add_output_backend(backend)
+
+    def add_output_backend(self, backend):
+        '''
+        Add an opened output backend, pushed from its own queue
+        '''
+        self.output_backends.append(backend)
+        policy = queue_policy(self.options.output_queue_policy,
+                              backend.get_backend_name(),
+                              self.options.output_spill_dir)
+        self.output_queues.append(OutputQueue(
+            backend, self.options.output_queue_size, policy,
+            self.options.output_spill_dir))
 
     def start(self):
         LOG.info("Starting %s" % self.name)
@@ -59,22 +97,32 @@ class Task(object):
         except:
             self.close_backends()
             raise
+        self.close_backends()
+
+    def use_batches(self):
+        '''
+        Return True when the received records can be pushed as CounterBatch,
+        without counters objects: all the output backends take them
+        '''
+        return bool(self.output_backends) and \
+            hasattr(self.input_backend, 'pull_batches') and \
+            all(hasattr(backend, 'push_batches')
+                for backend in self.output_backends)
 
     def push(self):
-        for backend in self.output_backends:
-            if len(self.counters_list) > 0:
-                try:
-                    backend.push(self.counters_list)
-                    LOG.debug("%s metrics have been pushed with %s"
-                          % (len(self.counters_list),
-                             backend.get_backend_name()))
-                except (NoneValueError, TypeError):
-                    LOG.debug("Values for metrics are not there.")
+        if self.counters_list:
+            self.flushes += 1
+            self.flushed_counters += self.queued_counters
+            for output_queue in self.output_queues:
+                output_queue.put(list(self.counters_list))
         del self.counters_list[:]
+        self.queued_counters = 0
 
     def close_backends(self):
         self.input_backend.close()
         self.push()
+        for output_queue in self.output_queues:
+            output_queue.close()
         for backend in self.output_backends:
             backend.close()
 
@@ -87,30 +135,89 @@ class Task(object):
         LOG.info("Reloading %s" % self.name)
         self.push()
         self.init_output_backends()
-
-    def sleep(self):
-        # absolute time is used and based on seconds since 1970-01-01 00:00:00
-        # UTC
-        now = time.time()
-        time_towait = (((now // self.options.sampling_period) + 1) *
-                       self.options.sampling_period - now)
-        time.sleep(time_towait)
+        # the packages of the counters classes may have been installed
+        clear_missing_metrics()
+
+    def get_stats(self):
+        '''
+        Return the counts of the input backend, the number of counters
+        waiting to be flushed, the number of flushes and of flushed counters
+        '''
+        stats = self.input_backend.get_stats()
+        stats.update({'queued_counters': self.queued_counters,
+                      'flushes': self.flushes,
+                      'flushed_counters': self.flushed_counters,
+                      'outputs': dict((output_queue.name,
+                                       output_queue.get_stats())
+                                      for output_queue in self.output_queues)})
+        return stats
+
+    def log_stats(self):
+        stats = self.get_stats()
+        LOG.info("%(name)s: %(received_messages)s messages received "
+                 "(%(received_counters)s counters), %(invalid_messages)s "
+                 "invalid, %(unsynced_messages)s waiting for a keyframe, "
+                 "%(missed_messages)s missed, %(queued_counters)s counters "
+                 "queued, %(flushed_counters)s flushed in %(flushes)s times"
+                 % dict(stats, name=self.name))
+        for (backend_name, output_stats) in sorted(stats['outputs'].items()):
+            LOG.info("%(name)s: %(backend_name)s backend: %(pushed_counters)s "
+                     "counters pushed (%(throughput).0f counters/s), "
+                     "%(queued_batches)s batches queued, lag %(lag).1f s, "
+                     "%(dropped_counters)s counters dropped, "
+                     "%(spilled_counters)s spilled, %(failed_pushes)s failed "
+                     "pushes" % dict(output_stats, name=self.name,
+                                     backend_name=backend_name))
+
+    def stop(self):
+        self.running = False
 
     def loop(self):
-        while True:
+        '''
+        Wait for the messages of the nodes and flush the counters to the
+        output backends when there are buffer_size of them or flush_interval
+        after the first one was received. The output backends pushed from
+        the loop have their tick called at least every tick_interval seconds
+        '''
+        stats_period = self.options.stats_period
+        next_stats = time.time() + stats_period if stats_period > 0 \
+            else float('inf')
+        use_batches = self.use_batches()
+        if use_batches:
+            LOG.info("%s: the records are pushed as batches" % self.name)
+        while self.running:
             now = time.time()
-            LOG.debug("Gathering the metrics")
-            self.counters_list = \
-                self.input_backend.pull(self.options.buffer_size)
-
-            LOG.debug("%s metrics have been pulled from zeromq" %
-                      len(self.counters_list))
+            if self.counters_list:
+                timeout = min(self.flush_deadline, next_stats) - now
+            else:
+                timeout = min(next_stats - now, self.flush_interval)
+            timeout = min([timeout] + [output_queue.tick_interval
+                                       for output_queue in self.output_queues
+                                       if output_queue.thread is None and
+                                       output_queue.tick_interval is not None])
+            if self.input_backend.wait(max(0, int(math.ceil(timeout * 1000)))):
+                if use_batches:
+                    counters_list = \
+                        self.input_backend.pull_batches(DRAIN_MESSAGES)
+                else:
+                    counters_list = self.input_backend.pull(DRAIN_MESSAGES)
+                count = count_counters(counters_list)
+                LOG.debug("%s metrics have been pulled from zeromq" % count)
+                if counters_list and not self.counters_list:
+                    self.flush_deadline = time.time() + self.flush_interval
+                self.counters_list.extend(counters_list)
+                self.queued_counters += count
 
-            LOG.debug("time to take measure: %s sec" % (time.time() - now))
-
-            self.push()
-            # sleep to next sampling
-            self.sleep()
+            now = time.time()
+            if self.queued_counters >= self.buffer_size or \
+                    (self.counters_list and now >= self.flush_deadline):
+                self.push()
+                LOG.debug("time to flush: %s sec" % (time.time() - now))
+            for output_queue in self.output_queues:
+                output_queue.tick()
+            if now >= next_stats:
+                self.log_stats()
+                next_stats = now + stats_period
 
 #
 # Main program
@@ -133,13 +240,61 @@ def main():
 
     parser.add_argument('-s', '--sample-period', type=float,
                         dest='sampling_period', default=5,
-                        help='Sampling period of measuring in seconds')
+                        help='Maximum time in seconds the received counters '
+                             'are kept before being pushed to the output '
+                             'backends, when --flush-interval is not set')
 
-    parser.add_argument('--buffer-size', dest='buffer_size', default=100,
+    parser.add_argument('--buffer-size', dest='buffer_size', default=10000,
                         help='Defines the maximum number of counters that '
                              'colmet should queue in memory before pushing '
                              'it to output backend', type=int)
 
+    parser.add_argument('--flush-interval', dest='flush_interval', type=int,
+                        default=None,
+                        help='Maximum time in milliseconds the received '
+                             'counters are kept before being pushed to the '
+                             'output backends')
+
+    parser.add_argument('--stats-period', dest='stats_period', type=float,
+                        default=60,
+                        help='Period in seconds of the log of the number of '
+                             'messages received, dropped and queued (0 to '
+                             'disable it)')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='Number of processes decoding and writing the '
+                             'counters, the jobs are shared between them. '
+                             'With more than one, --hdf5-filepath is split '
+                             'into N files, one per worker: name.<i>.hdf5 '
+                             '(colmet.hdf5 becomes colmet.0.hdf5, '
+                             'colmet.1.hdf5...)')
+
+    parser.add_argument('--output-queue-size', dest='output_queue_size',
+                        type=int, default=16,
+                        help='Maximum number of batches of counters queued '
+                             'for each output backend, pushed by its own '
+                             'thread (0 to push them from the collector '
+                             'loop)')
+
+    parser.add_argument('--output-queue-policy', dest='output_queue_policy',
+                        default=None,
+                        help='What happens to a new batch when the queue of '
+                             'an output backend is full: block (wait for '
+                             'room), drop-oldest (drop the oldest batch) or '
+                             'spill (write the new one in '
+                             '--output-spill-dir), for every backend or as a '
+                             'comma separated list of backend:policy, ex: '
+                             "'hdf5:block,elasticsearch:spill'. By default "
+                             'hdf5 blocks, the other backends spill when '
+                             'there is a spill directory and drop the oldest '
+                             'batch otherwise')
+
+    parser.add_argument('--output-spill-dir', dest='output_spill_dir',
+                        default=None,
+                        help='Directory of the batches spilled by the spill '
+                             'policy or not pushed when the collector stops, '
+                             'they are pushed at the next start')
+
     parser.add_argument("--enable-stdout-backend", action='store_true',
                         help='Prints the metrics on STDOUT',
                         dest='enable_stdout_backend', default=False)
@@ -164,6 +319,11 @@ def main():
                             " period.  Positive values specify an upper bound"
                             " for the  linger period in milliseconds.")
 
+    group.add_argument("--zeromq-compression-dict", action='append',
+                       dest='zeromq_compression_dicts', default=[],
+                       help="Preset dictionary used by the nodes to compress"
+                            " their messages, can be given several times")
+
     group = parser.add_argument_group('HDF5')
 
     group.add_argument("--hdf5-filepath", dest='hdf5_filepath', default=None,
@@ -180,6 +340,17 @@ def main():
                             '"zlib" (the default), "lzo", "bzip2" and "blosc" '
                             'are supported.')
 
+    group.add_argument("--hdf5-flush-rows", type=int,
+                       dest='hdf5_flush_rows', default=100000,
+                       help='Number of rows appended to the HDF5 tables '
+                            'before they are written to the file')
+
+    group.add_argument("--hdf5-flush-interval", type=float,
+                       dest='hdf5_flush_interval', default=5,
+                       help='Maximum time in seconds the appended rows are '
+                            'kept in memory before they are written to the '
+                            'file')
+
     group = parser.add_argument_group('Elasticsearch')
 
     group.add_argument("--elastic-host", dest='elastic_host', default=None,
@@ -201,6 +372,14 @@ def main():
     if args.hdf5_filepath is None and args.enable_stdout_backend is False and args.elastic_host is None:
         parser.error("You need to provide at least one output backend "
                      "[hdf5|stdout|elasticsearch]")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        policies = parse_queue_policies(args.output_queue_policy)
+    except ValueError as e:
+        parser.error(str(e))
+    if 'spill' in policies.values() and args.output_spill_dir is None:
+        parser.error("The spill policy needs --output-spill-dir")
 
     # Set the logging value (always display CRITICAL and ERROR)
     logging.basicConfig(
@@ -211,6 +390,9 @@ def main():
 
     # run
     try:
+        if args.workers > 1:
+            from colmet.collector.pipeline import Pipeline
+            sys.exit(Pipeline(sys.argv[0], args).start())
         Task(sys.argv[0], args).start()
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,385 @@
+'''
+Queues of the output backends of the collector.
+
+Each output backend is pushed by its own thread from a bounded queue of
+batches of counters, so a slow or unavailable backend does not delay the
+other ones nor the reading of the messages of the nodes. When the queue of a
+backend is full, the policy decides what happens to a new batch:
+- block: the collector waits for room in the queue (the nodes messages queue
+  up in zeromq, then are dropped by their high water mark)
+- drop-oldest: the oldest batch of the queue is dropped
+- spill: the batch is written in the spill directory and pushed when the
+  queue is empty again, in order
+Each backend has its own policy. By default the HDF5 queue blocks, its files
+must not miss rows, and the other backends must not delay it: they spill when
+there is a spill directory and drop the oldest batch otherwise.
+
+A backend with a tick method (and its tick_interval in seconds) has it called
+at least every tick_interval seconds by its thread, or by the collector loop
+when the size is 0, even when nothing is pushed.
+
+A batch which raises OutputBackendUnavailableError stays at the head of the
+queue and is pushed again after a delay growing up to MAX_RETRY_DELAY. The
+batches still queued when the collector stops are written in the spill
+directory when there is one, and pushed at the next start.
+
+The batches are lists of counters, or of CounterBatch when all the output
+backends have push_batches (they are spilled as counters).
+
+A spill file holds the time the batch was queued, the number of wire format 2
+messages (one per host) and each message preceded by its length.
+'''
+import collections
+import logging
+import os
+import re
+import struct
+import threading
+import time
+
+from colmet.common.batch import CounterBatch
+from colmet.common.exceptions import (NoneValueError,
+                                      OutputBackendUnavailableError)
+from colmet.common.metrics.base import BaseCounters
+
+LOG = logging.getLogger()
+
+QUEUE_POLICIES = ['block', 'drop-oldest', 'spill']
+
+# Backends blocking the collector when their queue is full by default
+LOSSLESS_BACKENDS = ['hdf5']
+
+# Delays in seconds before pushing again a batch to an unavailable backend
+MIN_RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+_spill_header = struct.Struct("<dI")
+_spill_length = struct.Struct("<I")
+
+
+def parse_queue_policies(value):
+    '''
+    Return the policies of a comma separated list of backend:policy by
+    backend name, a policy without backend name (key None) is the one of the
+    other backends
+    '''
+    policies = {}
+    if not value:
+        return policies
+    for item in value.split(','):
+        (name, _, policy) = item.strip().rpartition(':')
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown queue policy %s" % policy)
+        policies[name or None] = policy
+    return policies
+
+
+def queue_policy(value, backend_name, spill_dir=None):
+    '''
+    Return the policy of the queue of a backend from the value of
+    --output-queue-policy, or its default policy
+    '''
+    policies = parse_queue_policies(value)
+    if backend_name in policies:
+        return policies[backend_name]
+    if None in policies:
+        return policies[None]
+    if backend_name in LOSSLESS_BACKENDS:
+        return 'block'
+    if spill_dir is not None:
+        return 'spill'
+    return 'drop-oldest'
+
+
+def is_batch_list(counters_list):
+    return bool(counters_list) and isinstance(counters_list[0], CounterBatch)
+
+
+def count_counters(counters_list):
+    '''
+    Return the number of counters of a list of counters or of CounterBatch
+    '''
+    if is_batch_list(counters_list):
+        return sum(len(batch) for batch in counters_list)
+    return len(counters_list)
+
+
+class OutputQueue(object):
+    '''
+    Output backend pushed from a bounded queue of batches of counters by its
+    own thread, or directly by the collector when the size is 0
+    '''
+
+    def __init__(self, backend, size=0, policy='block', spill_dir=None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown queue policy %s" % policy)
+        if policy == 'spill' and spill_dir is None:
+            raise ValueError("The spill policy needs a spill directory")
+        self.backend = backend
+        self.name = backend.get_backend_name()
+        self.size = size
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.tick_interval = getattr(backend, 'tick_interval', None) \
+            if hasattr(backend, 'tick') else None
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        # (time queued, counters_list), oldest first
+        self.batches = collections.deque()
+        # (time queued, path) of the spilled batches, oldest first
+        self.spilled = collections.deque()
+        self.spill_sequence = 0
+        self.closing = False
+        # time the batch being pushed was queued
+        self.pushing = None
+        # set when closing, interrupts the wait before a retry
+        self.stopping = threading.Event()
+        self.retry_delay = 0
+        self.pushes = 0
+        self.pushed_counters = 0
+        self.push_time = 0.
+        self.dropped_counters = 0
+        self.spilled_counters = 0
+        self.failed_pushes = 0
+        if spill_dir is not None:
+            self._load_spilled()
+        self.thread = None
+        if size > 0:
+            self.thread = threading.Thread(target=self.run,
+                                           name="output %s" % self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, counters_list):
+        '''
+        Queue a batch of counters, or push it when the queue size is 0
+        '''
+        if self.thread is None:
+            try:
+                self._push(counters_list)
+            except OutputBackendUnavailableError as err:
+                self.failed_pushes += 1
+                self.dropped_counters += count_counters(counters_list)
+                err.show()
+            return
+        with self.lock:
+            if self.policy == 'spill' and \
+                    (self.spilled or len(self.batches) >= self.size):
+                # the spilled batches are older than the new one
+                self._spill(time.time(), counters_list)
+                self.not_empty.notify()
+                return
+            while len(self.batches) >= self.size:
+                if self.policy == 'drop-oldest':
+                    (_, dropped) = self.batches.popleft()
+                    self.dropped_counters += count_counters(dropped)
+                    LOG.warning("The queue of the %s backend is full, %s "
+                                "counters dropped"
+                                % (self.name, count_counters(dropped)))
+                else:
+                    self.not_full.wait()
+            self.batches.append((time.time(), counters_list))
+            self.not_empty.notify()
+
+    def tick(self):
+        '''
+        Call the tick of the backend when it is pushed by the collector, the
+        thread calls it itself
+        '''
+        if self.thread is None and self.tick_interval is not None:
+            self._tick()
+
+    def _tick(self):
+        try:
+            self.backend.tick()
+        except Exception as e:
+            LOG.error("The tick of the %s backend failed: %r" % (self.name, e))
+
+    def close(self):
+        '''
+        Push the queued batches (spill them if the backend is unavailable)
+        and stop the thread
+        '''
+        if self.thread is not None:
+            with self.lock:
+                self.closing = True
+                self.not_empty.notify()
+            self.stopping.set()
+            self.thread.join()
+
+    def get_stats(self):
+        '''
+        Return the number of queued batches and counters, the lag (age of the
+        oldest batch not pushed, in seconds), the counts of pushed, dropped and
+        spilled counters, of failed pushes and the throughput of the backend
+        (counters per second spent in push)
+        '''
+        with self.lock:
+            oldest = [batches[0][0] for batches in (self.batches, self.spilled)
+                      if batches]
+            if self.pushing is not None:
+                oldest.append(self.pushing)
+            lag = time.time() - min(oldest) if oldest else 0.
+            return {'queued_batches': len(self.batches) + len(self.spilled),
+                    'queued_counters': sum(count_counters(counters_list) for
+                                           (_, counters_list) in self.batches),
+                    'lag': lag,
+                    'pushes': self.pushes,
+                    'pushed_counters': self.pushed_counters,
+                    'dropped_counters': self.dropped_counters,
+                    'spilled_counters': self.spilled_counters,
+                    'failed_pushes': self.failed_pushes,
+                    'throughput': self.pushed_counters / self.push_time
+                    if self.push_time else 0.}
+
+    def run(self):
+        while True:
+            path = None
+            with self.lock:
+                while not self.batches and not self.spilled and \
+                        not self.closing:
+                    if not self.not_empty.wait(self.tick_interval):
+                        break
+                # the oldest batch first, queued or spilled
+                if self.spilled and \
+                        (not self.batches or
+                         self.spilled[0][0] <= self.batches[0][0]):
+                    (queued, path) = self.spilled.popleft()
+                elif self.batches:
+                    (queued, counters_list) = self.batches.popleft()
+                    self.not_full.notify()
+                elif self.closing:
+                    return
+                else:
+                    # nothing queued during tick_interval
+                    queued = None
+                self.pushing = queued
+            if queued is None:
+                self._tick()
+                continue
+            if path is not None:
+                counters_list = self._read_spilled(path)
+            try:
+                self._push(counters_list)
+            except OutputBackendUnavailableError as err:
+                self.failed_pushes += 1
+                err.show()
+                # the batch is pushed again first
+                with self.lock:
+                    self.pushing = None
+                    if path is None:
+                        self.batches.appendleft((queued, counters_list))
+                    else:
+                        self.spilled.appendleft((queued, path))
+                if self._wait_retry():
+                    continue
+                # closing while the backend is unavailable
+                self._spill_queue()
+                return
+            except Exception as e:
+                # the thread must not die with a bad batch
+                LOG.error("The %s backend failed to push %s counters: %r"
+                          % (self.name, count_counters(counters_list), e))
+            self.retry_delay = 0
+            with self.lock:
+                self.pushing = None
+            if path is not None:
+                os.remove(path)
+
+    def _push(self, counters_list):
+        start = time.time()
+        try:
+            if is_batch_list(counters_list):
+                self.backend.push_batches(counters_list)
+            else:
+                self.backend.push(counters_list)
+            LOG.debug("%s metrics have been pushed with %s"
+                      % (count_counters(counters_list), self.name))
+        except (NoneValueError, TypeError):
+            LOG.debug("Values for metrics are not there.")
+        self.push_time += time.time() - start
+        self.pushes += 1
+        self.pushed_counters += count_counters(counters_list)
+
+    def _wait_retry(self):
+        '''
+        Wait before pushing a batch again, return False if the queue is
+        closing
+        '''
+        self.retry_delay = min(max(self.retry_delay * 2, MIN_RETRY_DELAY),
+                               MAX_RETRY_DELAY)
+        self.stopping.wait(self.retry_delay)
+        return not self.stopping.is_set()
+
+    def _spill_queue(self):
+        with self.lock:
+            if self.spill_dir is None:
+                dropped = sum(count_counters(counters_list)
+                              for (_, counters_list) in self.batches)
+                self.dropped_counters += dropped
+                LOG.error("%s counters not pushed to the %s backend are "
+                          "dropped" % (dropped, self.name))
+            else:
+                for (queued, counters_list) in self.batches:
+                    self._spill(queued, counters_list)
+            self.batches.clear()
+
+    def _spill_prefix(self):
+        return os.path.join(self.spill_dir, "%s-" % self.name)
+
+    def _spill(self, queued, counters_list):
+        '''
+        Write a batch in the spill directory, with the lock held
+        '''
+        if is_batch_list(counters_list):
+            counters_list = [counters for batch in counters_list
+                             for counters in batch.to_counters()]
+        by_host = collections.OrderedDict()
+        for counters in counters_list:
+            by_host.setdefault(counters.hostname, []).append(counters)
+        path = "%s%012d.spill" % (self._spill_prefix(), self.spill_sequence)
+        self.spill_sequence += 1
+        with open(path, 'wb') as spill_file:
+            spill_file.write(_spill_header.pack(queued, len(by_host)))
+            for host_list in by_host.values():
+                raw = BaseCounters.pack_batch(host_list)
+                spill_file.write(_spill_length.pack(len(raw)))
+                spill_file.write(raw)
+        self.spilled.append((queued, path))
+        self.spilled_counters += len(counters_list)
+
+    def _read_spilled(self, path):
+        with open(path, 'rb') as spill_file:
+            raw = spill_file.read()
+        (_, count) = _spill_header.unpack_from(raw, 0)
+        offset = _spill_header.size
+        counters_list = []
+        for _ in range(count):
+            (length,) = _spill_length.unpack_from(raw, offset)
+            offset += _spill_length.size
+            counters_list.extend(BaseCounters.unpack_batch(
+                memoryview(raw)[offset:offset + length]))
+            offset += length
+        return counters_list
+
+    def _load_spilled(self):
+        '''
+        Queue the batches spilled by a previous collector
+        '''
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        name_re = re.compile(r"%s-(\d+)\.spill$" % re.escape(self.name))
+        for filename in sorted(os.listdir(self.spill_dir)):
+            match = name_re.match(filename)
+            if match is None:
+                continue
+            path = os.path.join(self.spill_dir, filename)
+            with open(path, 'rb') as spill_file:
+                (queued, _) = _spill_header.unpack(
+                    spill_file.read(_spill_header.size))
+            self.spilled.append((queued, path))
+            self.spill_sequence = int(match.group(1)) + 1
+        if self.spilled:
+            LOG.info("%s batches spilled for the %s backend"
+                     % (len(self.spilled), self.name))
@@ -0,0 +1,402 @@
+'''
+Sharded collector pipeline (colmet-collector --workers N).
+
+The receiver (the main process) binds the URI of the nodes and routes each
+message to one of the N worker processes by the hash of its hostname, so the
+delta encoded streams of a node (wire format 3) are always decoded by the same
+worker. A worker runs the ingest loop of the collector (Task) with its own
+output backends: it decodes the messages, forwards the counters of the jobs
+owned by another worker to it (in the wire format 2) and writes the counters
+of its own jobs. A job is owned by the worker job_id % N, so its HDF5 group is
+written by one worker; the counters of the node (job 0) are sharded by
+hostname. The workers receive the messages of the receiver and of their peers
+on ipc sockets in a temporary directory.
+'''
+import collections
+import copy
+import errno
+import logging
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import time
+import zlib
+
+import multiprocessing
+import numpy
+import zmq
+
+from colmet.collector.main import DRAIN_MESSAGES, Task
+from colmet.common.backends.zeromq import ZMQInputBackend
+from colmet.common.compression import Decompressor, load_dictionary
+from colmet.common.exceptions import Error
+from colmet.common.metrics.base import BaseCounters
+
+
+LOG = logging.getLogger()
+
+# Period in milliseconds the receiver checks its workers and the signals
+RECEIVER_POLL_PERIOD = 1000
+
+
+def host_shard(hostname, workers):
+    return zlib.crc32(hostname.encode('utf-8')) % workers
+
+
+def job_shard(counters, workers):
+    '''
+    Return the worker writing the counters
+    '''
+    if counters.job_id:
+        return counters.job_id % workers
+    return host_shard(counters.hostname, workers)
+
+
+def worker_endpoints(directory, workers):
+    return ['ipc://%s' % os.path.join(directory, 'worker-%s' % index)
+            for index in range(workers)]
+
+
+def worker_options(options, index, endpoints):
+    '''
+    Return the options of a worker: it binds its endpoint and writes its own
+    HDF5 file and spill directory
+    '''
+    options = copy.deepcopy(options)
+    options.zeromq_bind_uri = endpoints[index]
+    if options.output_spill_dir is not None:
+        options.output_spill_dir = os.path.join(options.output_spill_dir,
+                                                str(index))
+    if options.hdf5_filepath is not None:
+        (root, ext) = os.path.splitext(options.hdf5_filepath)
+        if ext == ".hdf5":
+            options.hdf5_filepath = "%s.%s.hdf5" % (root, index)
+        else:
+            options.hdf5_filepath = "%s.%s" % (options.hdf5_filepath, index)
+    return options
+
+
+class ShardedZMQInputBackend(ZMQInputBackend):
+    '''
+    Input backend of a worker, it keeps the counters of its shard and
+    forwards the other ones to their worker
+    '''
+
+    def __init__(self, options, index, endpoints):
+        ZMQInputBackend.__init__(self, options)
+        self.index = index
+        self.endpoints = endpoints
+        self.forwarded_counters = 0
+
+    def open(self):
+        ZMQInputBackend.open(self)
+        self.peers = {}
+        # worker -> (message, count) not sent yet
+        self.pending = {}
+        for (index, endpoint) in enumerate(self.endpoints):
+            if index == self.index:
+                continue
+            peer = self.context.socket(zmq.PUSH)
+            peer.setsockopt(zmq.LINGER, self.options.zeromq_linger)
+            # the workers send to each other without waiting, a blocking
+            # send could block two workers sending to each other at the same
+            # time: the messages beyond the high water mark are kept until
+            # the peer can receive them
+            peer.setsockopt(zmq.SNDHWM, self.options.zeromq_hwm)
+            peer.connect(endpoint)
+            self.peers[index] = peer
+            self.pending[index] = collections.deque()
+
+    def close(self):
+        # give the peers the linger time to receive the messages which are
+        # still pending (without limit when it is -1)
+        linger = self.options.zeromq_linger
+        deadline = time.time() + linger / 1000.
+        while self._pending_counters() > 0:
+            timeout = None if linger < 0 else (deadline - time.time()) * 1000
+            if timeout is not None and timeout <= 0:
+                break
+            poller = zmq.Poller()
+            for (shard, pending) in self.pending.items():
+                if pending:
+                    poller.register(self.peers[shard], zmq.POLLOUT)
+            if poller.poll(timeout):
+                for shard in self.peers:
+                    self._flush_peer(shard)
+        lost = self._pending_counters()
+        if lost > 0:
+            LOG.warning("%s counters not forwarded to the workers" % lost)
+        for peer in self.peers.values():
+            peer.close()
+        ZMQInputBackend.close(self)
+
+    def wait(self, timeout=None):
+        '''
+        Wait for a message during timeout milliseconds (without limit when
+        None), return True if one can be pulled. The pending messages are
+        sent to the peers as soon as they can receive them meanwhile
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout / 1000.
+        while True:
+            events = dict(self.poller.poll(timeout))
+            for (shard, peer) in self.peers.items():
+                if events.get(peer, 0) & zmq.POLLOUT:
+                    self._flush_peer(shard)
+            if events.get(self.socket, 0) & zmq.POLLIN:
+                return True
+            if timeout is not None:
+                timeout = (deadline - time.time()) * 1000
+                if timeout <= 0:
+                    return False
+
+    def get_stats(self):
+        stats = ZMQInputBackend.get_stats(self)
+        stats['forwarded_counters'] = self.forwarded_counters
+        stats['pending_forwarded_counters'] = self._pending_counters()
+        return stats
+
+    def _pending_counters(self):
+        return sum(count for pending in self.pending.values()
+                   for (_, count) in pending)
+
+    def _flush_peer(self, shard):
+        '''
+        Send the pending messages of a worker until its queue is full, wait
+        for it to be writable while some are left
+        '''
+        pending = self.pending[shard]
+        peer = self.peers[shard]
+        while pending:
+            (raw, count) = pending[0]
+            try:
+                peer.send(raw, zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            pending.popleft()
+            self.forwarded_counters += count
+        if pending:
+            self.poller.register(peer, zmq.POLLOUT)
+        elif peer in dict(self.poller.sockets):
+            self.poller.unregister(peer)
+
+    def _send_peer(self, shard, raw, count):
+        '''
+        Forward a message of count counters to a worker, keep it in order
+        after the pending ones when the queue of the worker is full
+        '''
+        self.pending[shard].append((raw, count))
+        self._flush_peer(shard)
+
+    def pull(self, buffer_size=1000):
+        workers = len(self.endpoints)
+        counters_list = []
+        # (worker, hostname) -> counters
+        forwarded = {}
+        for counters in ZMQInputBackend.pull(self, buffer_size):
+            shard = job_shard(counters, workers)
+            if shard == self.index:
+                counters_list.append(counters)
+            else:
+                forwarded.setdefault((shard, counters.hostname),
+                                     []).append(counters)
+        for ((shard, _), shard_list) in forwarded.items():
+            self._send_peer(shard, BaseCounters.pack_batch(shard_list),
+                            len(shard_list))
+        return counters_list
+
+    def pull_batches(self, buffer_size=1000):
+        workers = len(self.endpoints)
+        batches = []
+        for batch in ZMQInputBackend.pull_batches(self, buffer_size):
+            shards = batch_shards(batch, workers)
+            for shard in numpy.unique(shards).tolist():
+                shard_batch = batch.select(shards == shard)
+                if shard == self.index:
+                    batches.append(shard_batch)
+                else:
+                    self._forward_batch(shard, shard_batch)
+        return batches
+
+    def _forward_batch(self, shard, batch):
+        if batch.counters_class._subset_of is None:
+            # the records of a CounterBatch have the wire format 1
+            self._send_peer(shard, batch.tobytes(), len(batch))
+        else:
+            # the subsets need the wire format 2, one message per host
+            by_host = {}
+            for counters in batch.to_counters():
+                by_host.setdefault(counters.hostname, []).append(counters)
+            for host_list in by_host.values():
+                self._send_peer(shard, BaseCounters.pack_batch(host_list),
+                                len(host_list))
+
+
+def batch_shards(batch, workers):
+    '''
+    Return the worker writing each record of a CounterBatch, see job_shard
+    '''
+    job_ids = batch['job_id']
+    shards = job_ids % workers
+    node = job_ids == 0
+    if node.any():
+        (hostnames, inverse) = numpy.unique(batch['hostname'][node],
+                                            return_inverse=True)
+        host_shards = numpy.array([zlib.crc32(hostname) % workers
+                                   for hostname in hostnames.tolist()],
+                                  dtype=shards.dtype)
+        shards[node] = host_shards[inverse]
+    return shards
+
+
+def run_worker(name, options, index, endpoints):
+    # the receiver stops the workers, they must not get the SIGINT of the
+    # terminal
+    os.setpgrp()
+    options = worker_options(options, index, endpoints)
+    task = Task("%s worker %s" % (name, index), options)
+    task.input_backend = ShardedZMQInputBackend(options, index, endpoints)
+    try:
+        task.start()
+    except Error as err:
+        err.show()
+        raise SystemExit(1)
+
+
+class Pipeline(object):
+    '''
+    Receiver of the sharded collector, it starts and stops the workers
+    '''
+
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        self.workers = []
+        self.running = True
+        # exit code of the collector, 1 when a worker died
+        self.exitcode = 0
+        self.routed_messages = 0
+        self.invalid_messages = 0
+
+    def start(self):
+        LOG.info("Starting %s with %s workers"
+                 % (self.name, self.options.workers))
+        directory = tempfile.mkdtemp(prefix='colmet-collector-')
+        try:
+            endpoints = worker_endpoints(directory, self.options.workers)
+            # the workers are forked before the zeromq context is created
+            for index in range(self.options.workers):
+                worker = multiprocessing.Process(
+                    target=run_worker,
+                    args=(self.name, self.options, index, endpoints))
+                worker.start()
+                self.workers.append(worker)
+            signal.signal(signal.SIGINT, self.terminate)
+            signal.signal(signal.SIGTERM, self.terminate)
+            signal.signal(signal.SIGHUP, self.reload)
+            self.open(endpoints)
+            try:
+                self.loop()
+            finally:
+                self.close()
+        finally:
+            self.stop_workers()
+            shutil.rmtree(directory, ignore_errors=True)
+        return self.exitcode
+
+    def open(self, endpoints):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PULL)
+        self.socket.setsockopt(zmq.LINGER, self.options.zeromq_linger)
+        self.socket.setsockopt(zmq.RCVHWM, self.options.zeromq_hwm)
+        self.socket.bind(self.options.zeromq_bind_uri)
+        self.decompressor = Decompressor(
+            [load_dictionary(path)
+             for path in self.options.zeromq_compression_dicts or []])
+        self.outputs = []
+        for endpoint in endpoints:
+            output = self.context.socket(zmq.PUSH)
+            output.setsockopt(zmq.LINGER, self.options.zeromq_linger)
+            output.setsockopt(zmq.SNDHWM, self.options.zeromq_hwm)
+            output.connect(endpoint)
+            self.outputs.append(output)
+
+    def close(self):
+        for output in self.outputs:
+            output.close()
+        self.socket.close()
+        self.context.term()
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join()
+
+    def terminate(self, *args, **kwargs):
+        LOG.info("Terminating %s" % self.name)
+        self.running = False
+
+    def reload(self, *args, **kwargs):
+        LOG.info("Reloading %s" % self.name)
+        for worker in self.workers:
+            os.kill(worker.pid, signal.SIGHUP)
+
+    def route(self, frames):
+        '''
+        Send a message to the worker of its host, the compressed messages
+        are decompressed
+        '''
+        try:
+            if len(frames) == 1:
+                raw = frames[0].buffer
+            else:
+                raw = self.decompressor.decompress(frames[0].buffer,
+                                                   frames[1].buffer)
+            hostname = BaseCounters.get_hostname_from_raw(raw)
+        except (struct.error, ValueError, IndexError) as e:
+            self.invalid_messages += 1
+            LOG.error("Message dropped: %s" % e)
+            return
+        self.outputs[host_shard(hostname, len(self.outputs))].send(
+            raw, copy=False)
+        self.routed_messages += 1
+
+    def log_stats(self):
+        LOG.info("%s: %s messages routed, %s invalid"
+                 % (self.name, self.routed_messages, self.invalid_messages))
+
+    def loop(self):
+        stats_period = self.options.stats_period
+        next_stats = time.time() + stats_period if stats_period > 0 \
+            else float('inf')
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while self.running:
+            try:
+                ready = poller.poll(RECEIVER_POLL_PERIOD)
+            except zmq.ZMQError as e:
+                # interrupted by a signal
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            if ready:
+                try:
+                    for _ in range(DRAIN_MESSAGES):
+                        self.route(self.socket.recv_multipart(zmq.NOBLOCK,
+                                                              copy=False))
+                except zmq.Again:
+                    pass
+            for worker in self.workers:
+                if not worker.is_alive():
+                    LOG.error("The worker %s of %s exited with the code %s"
+                              % (worker.pid, self.name, worker.exitcode))
+                    self.exitcode = 1
+                    self.running = False
+            now = time.time()
+            if now >= next_stats:
+                self.log_stats()
+                next_stats = now + stats_period
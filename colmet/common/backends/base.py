@@ -33,6 +33,8 @@ class InputBaseBackend(BaseBackend):
     def __init__(self, options):
         super(InputBaseBackend, self).__init__(options)
         self.job_id_list = []
+        # jobs running on the node, shared by the backends (set by the node)
+        self.job_registry = None
 
     def pull(self, request, timestamp):
         raise NotImplementedError()
@@ -10,8 +10,11 @@ import struct
 LOG = logging.getLogger()
 
 from colmet.common.metrics.base import BaseCounters
+from colmet.common.compression import (Compressor, Decompressor,
+                                       load_dictionary)
 
 from colmet.common.backends.base import InputBaseBackend, OutputBaseBackend
+from colmet.common.exceptions import Error
 
 try:
     _snd_hwm = zmq.SNDHWM
@@ -34,21 +37,50 @@ class ZMQInputBackend(InputBaseBackend):
           self.socket.setsockopt(zmq.RCVHWM, self.options.zeromq_hwm)
         LOG.debug("Use the bind URI '%s'" % self.options.zeromq_bind_uri)
         self.socket.bind(self.options.zeromq_bind_uri)
+        from colmet.common.delta import DeltaDecoder
+        # state of the delta encoded streams of the nodes (wire format 3)
+        self.decoder = DeltaDecoder()
+        self.decompressor = Decompressor(
+            [load_dictionary(path)
+             for path in self.options.zeromq_compression_dicts or []])
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        # messages and counters received, messages which could not be
+        # decoded
+        self.received_messages = 0
+        self.received_counters = 0
+        self.invalid_messages = 0
 
     def close(self):
         self.socket.close()
         self.context.term()
 
+    def wait(self, timeout=None):
+        '''
+        Wait for a message during timeout milliseconds (without limit when
+        None), return True if one can be pulled
+        '''
+        return bool(self.poller.poll(timeout))
+
+    def get_stats(self):
+        '''
+        Return the counts of the received messages, the invalid ones, the
+        messages of the wire format 3 dropped until a keyframe and the ones
+        missed (sequence gaps)
+        '''
+        return {'received_messages': self.received_messages,
+                'received_counters': self.received_counters,
+                'invalid_messages': self.invalid_messages,
+                'unsynced_messages': self.decoder.dropped,
+                'missed_messages': self.decoder.missed}
+
     def pull(self, buffer_size=1000):
-        counters_list = []
-        try:
-            for i in range(buffer_size):
-                raw = self.socket.recv(zmq.NOBLOCK, copy=False)
-                counters_list.extend(BaseCounters.unpack_to_list(raw.bytes))
-                del raw
-        except zmq.ZMQError as e:
-            if e.errno != zmq.EAGAIN:
-                raise e
+        '''
+        Return the counters of the messages received, at most buffer_size
+        messages are read
+        '''
+        counters_list = self._receive(buffer_size, self._unpack_counters)
+        self.received_counters += len(counters_list)
         LOG.debug("%s counters received" % len(counters_list))
         if len(self.job_id_list) > 0:
             counters_list = [metric for metric in counters_list
@@ -58,6 +90,58 @@ class ZMQInputBackend(InputBaseBackend):
 
         return counters_list
 
+    def pull_batches(self, buffer_size=1000):
+        '''
+        Return the records of the messages received as CounterBatch (views
+        on the messages of the wire format 1), without counters objects
+        '''
+        import numpy as np
+        batches = self._receive(buffer_size, self._unpack_batches)
+        self.received_counters += sum(len(batch) for batch in batches)
+        if len(self.job_id_list) > 0:
+            batches = [batch.select(np.isin(batch['job_id'],
+                                            self.job_id_list))
+                       for batch in batches]
+        return [batch for batch in batches if len(batch)]
+
+    def _unpack_counters(self, raw):
+        return BaseCounters.unpack_to_list(raw, decoder=self.decoder)
+
+    def _unpack_batches(self, raw):
+        from colmet.common.batch import CounterBatch
+        return CounterBatch.from_raw(raw, self.decoder)
+
+    def _receive(self, buffer_size, unpack):
+        '''
+        Return the items unpacked from the messages received, at most
+        buffer_size messages are read
+        '''
+        items = []
+        try:
+            for i in range(buffer_size):
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                self.received_messages += 1
+                try:
+                    if len(frames) == 1:
+                        # the counters are views on the frame until they are
+                        # unpacked
+                        raw = frames[0].buffer
+                    else:
+                        # compressed message: header frame + payload frame
+                        raw = self.decompressor.decompress(frames[0].buffer,
+                                                           frames[1].buffer)
+                    items.extend(unpack(raw))
+                except (struct.error, ValueError, Error) as e:
+                    self.invalid_messages += 1
+                    LOG.error("Message dropped: %s" % e)
+                    continue
+                finally:
+                    raw = frames = None
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EAGAIN:
+                raise e
+        return items
+
 
 class ZMQOutputBackend(OutputBaseBackend):
     '''
@@ -73,6 +157,19 @@ class ZMQOutputBackend(OutputBaseBackend):
         self.socket.setsockopt(_snd_hwm, self.options.zeromq_hwm)
         self.socket.connect(self.options.zeromq_uri)
         LOG.debug("Use the URI '%s'" % self.options.zeromq_uri)
+        self.encoder = None
+        if self.options.wire_format == 3:
+            from colmet.common.delta import DeltaEncoder
+            self.encoder = DeltaEncoder(self.options.keyframe_interval)
+        self.compressor = None
+        if self.options.zeromq_compression != 'none':
+            dictionary = None
+            if self.options.zeromq_compression_dict is not None:
+                dictionary = load_dictionary(
+                    self.options.zeromq_compression_dict)
+            self.compressor = Compressor(self.options.zeromq_compression,
+                                         self.options.zeromq_compression_level,
+                                         dictionary)
 
     def close(self):
         self.socket.close()
@@ -84,7 +181,12 @@ class ZMQOutputBackend(OutputBaseBackend):
         '''
         if len(counters_list) > 0:
             try:
-                raw = BaseCounters.pack_from_list(counters_list)
-                self.socket.send(raw)
-            except struct.error as e:
+                raw = BaseCounters.pack_from_list(counters_list,
+                                                  self.options.wire_format,
+                                                  self.encoder)
+                if self.compressor is None:
+                    self.socket.send(raw)
+                else:
+                    self.socket.send_multipart(self.compressor.compress(raw))
+            except (struct.error, ValueError) as e:
                 LOG.error("An error occurred during packet creation : %s" % e)
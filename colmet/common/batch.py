@@ -0,0 +1,244 @@
+'''
+Batches of counters held in numpy structured arrays.
+
+A CounterBatch holds the records of one counters class in an array whose
+dtype is derived from the struct format of the class: the columns are
+accessed by counter name and the accumulation functions are vectorized,
+instead of going through one python object per record.
+'''
+import numpy as np
+
+from colmet.common.metrics.base import (BaseCounters, BATCH_MAGIC,
+                                        DELTA_BATCH_VERSION)
+
+# struct code -> numpy type, the strings ('<n>s') are mapped to 'S<n>'
+_numpy_types = {
+    'H': '<u2',
+    'I': '<u4',
+    'Q': '<u8',
+    'q': '<i8',
+    'f': '<f4',
+    'd': '<f8',
+}
+
+# counters class -> numpy dtype
+_dtypes = {}
+
+
+def numpy_type(struct_code):
+    if struct_code.endswith('s'):
+        return 'S' + struct_code[:-1]
+    return _numpy_types[struct_code]
+
+
+def get_dtype(counters_class):
+    '''
+    Return the numpy dtype of the packed records of a counters class, it
+    has the layout of the version 1 wire format
+    '''
+    dtype = _dtypes.get(counters_class)
+    if dtype is None:
+        fields = []
+        for key in counters_class._fmt_header_ordered_keys:
+            h_type = counters_class._header_definitions[key][0]
+            fields.append((key, numpy_type(h_type.struct_code)))
+        for key in counters_class._fmt_counter_ordered_keys:
+            c_type = counters_class._counter_definitions[key][0]
+            fields.append((key, numpy_type(c_type.struct_code)))
+        dtype = _dtypes[counters_class] = np.dtype(fields)
+        assert dtype.itemsize == counters_class._fmt_length
+    return dtype
+
+
+def merge_batches(batches):
+    '''
+    Return the records of the batches in one batch per counters class
+    '''
+    by_class = {}
+    for batch in batches:
+        by_class.setdefault(batch.counters_class, []).append(batch.array)
+    return [CounterBatch(counters_class,
+                         arrays[0] if len(arrays) == 1
+                         else np.concatenate(arrays))
+            for (counters_class, arrays) in by_class.items()]
+
+
+class CounterBatch(object):
+    '''
+    Records of one counters class in a numpy structured array
+    '''
+
+    def __init__(self, counters_class, array):
+        self.counters_class = counters_class
+        self.array = array
+
+    @classmethod
+    def from_buffer(cls, counters_class, raw, count=-1, offset=0):
+        '''
+        Return the batch of count records packed at offset of raw, the array
+        is a view on raw
+        '''
+        return cls(counters_class, np.frombuffer(raw, get_dtype(counters_class),
+                                                 count, offset))
+
+    @classmethod
+    def from_counters(cls, counters_class, counters_list):
+        raw = BaseCounters.pack_from_list(counters_list)
+        return cls.from_buffer(counters_class, bytes(raw))
+
+    @classmethod
+    def from_raw(cls, raw, decoder=None):
+        '''
+        Return the batches (one per counters class, in order of appearance)
+        of a message in any wire format, the version 3 needs the DeltaDecoder
+        of the streams
+        '''
+        raw = memoryview(raw)
+        if raw.format != 'B':
+            raw = raw.cast('B')
+        if bytes(raw[0:len(BATCH_MAGIC)]) == BATCH_MAGIC:
+            if raw[len(BATCH_MAGIC)] == DELTA_BATCH_VERSION:
+                if decoder is None:
+                    raise ValueError("The wire format 3 needs a delta "
+                                     "decoder")
+                return decoder.decode_batches(raw)
+            return cls._from_batch(raw)
+
+        # runs of consecutive records of the same class, made of
+        # (counters class, offset, count)
+        runs = []
+        offset = 0
+        length = len(raw)
+        while offset < length:
+            counters_class = BaseCounters.get_counters_class_from_raw(raw,
+                                                                      offset)
+            if runs and runs[-1][0] is counters_class:
+                runs[-1][2] += 1
+            else:
+                runs.append([counters_class, offset, 1])
+            offset += counters_class._fmt_length
+
+        arrays_by_class = {}
+        for (counters_class, start, count) in runs:
+            arrays_by_class.setdefault(counters_class, []).append(
+                np.frombuffer(raw, get_dtype(counters_class), count, start))
+        return [cls(counters_class,
+                    arrays[0] if len(arrays) == 1 else np.concatenate(arrays))
+                for (counters_class, arrays) in arrays_by_class.items()]
+
+    @classmethod
+    def _from_batch(cls, raw):
+        batches = {}
+        for (hostname, jobs, strings, counters_class, schema, payload) in \
+                BaseCounters.iter_batch_sections(raw):
+            records = np.frombuffer(payload,
+                                    cls._record_dtype(counters_class, schema))
+            array = np.zeros(len(records), get_dtype(counters_class))
+            array['metric_backend'] = schema.metric_name.encode('utf-8')
+            array['hostname'] = hostname.encode('utf-8')
+            array['job_id'] = np.array(jobs, dtype='<u8')[records['_job']]
+            encoded = np.array([string.encode('utf-8') for string in strings]
+                               or [b""])
+            for (_, key, is_string) in schema.fields:
+                if is_string:
+                    array[key] = encoded[records[key]]
+                else:
+                    array[key] = records[key]
+            batches.setdefault(counters_class, []).append(array)
+        return [cls(counters_class,
+                    arrays[0] if len(arrays) == 1 else np.concatenate(arrays))
+                for (counters_class, arrays) in batches.items()]
+
+    @staticmethod
+    def _record_dtype(counters_class, schema):
+        dtype = get_dtype(counters_class)
+        fields = [('_job', '<u4')]
+        for (_, key, is_string) in schema.fields:
+            fields.append((key, '<u4' if is_string else dtype[key]))
+        return np.dtype(fields)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, name):
+        '''
+        Return the column of a header or counter (bytes for the strings)
+        '''
+        return self.array[name]
+
+    @property
+    def names(self):
+        return self.array.dtype.names
+
+    def select(self, mask):
+        '''
+        Return the batch of the records selected by a boolean or index array
+        '''
+        return CounterBatch(self.counters_class, self.array[mask])
+
+    def iter_jobs(self):
+        '''
+        Yield (job_id, batch of the records of the job), in order of job_id
+        '''
+        job_ids = self.array['job_id']
+        order = np.argsort(job_ids, kind='stable')
+        (jobs, starts) = np.unique(job_ids[order], return_index=True)
+        ends = list(starts[1:]) + [len(order)]
+        for (job_id, start, end) in zip(jobs.tolist(), starts, ends):
+            yield (job_id, self.select(order[start:end]))
+
+    def tobytes(self):
+        '''
+        Return the records in the version 1 wire format
+        '''
+        return self.array.tobytes()
+
+    def to_counters(self):
+        '''
+        Return the records as counters objects
+        '''
+        raw = memoryview(self.tobytes())
+        size = self.counters_class._fmt_length
+        return [self.counters_class(raw=raw[offset:offset + size])
+                for offset in range(0, len(raw), size)]
+
+    def accumulate(self, other, destination=None, coeff=1):
+        '''
+        Return destination updated record per record from
+        operator(self, other), the headers are the ones of self. A new batch
+        is created when destination is None.
+        '''
+        if len(other) != len(self):
+            raise ValueError("The batches have different lengths (%s, %s)"
+                             % (len(self), len(other)))
+        if destination is None:
+            destination = CounterBatch(self.counters_class, self.array.copy())
+        elif destination is not self:
+            for key in self.counters_class._fmt_header_ordered_keys:
+                destination.array[key] = self.array[key]
+
+        for (name, (_, _, acc_fn, _, _, _)) in \
+                self.counters_class._counter_definitions.items():
+            s_column = self.array[name]
+            o_column = other.array[name]
+            if acc_fn == 'add':
+                if coeff == 1:
+                    column = s_column + o_column
+                elif coeff == -1:
+                    column = s_column - o_column
+                else:
+                    column = s_column + coeff * o_column.astype(np.float64)
+            elif acc_fn == 'min':
+                column = np.minimum(s_column, o_column)
+            elif acc_fn == 'max':
+                column = np.maximum(s_column, o_column)
+            else:
+                column = s_column
+            destination.array[name] = column
+        return destination
+
+    def delta(self, other, destination=None):
+        '''
+        Return destination updated with self - other
+        '''
+        return self.accumulate(other, destination, coeff=-1)
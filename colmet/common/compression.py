@@ -0,0 +1,176 @@
+'''
+Compression of the messages sent to the collector.
+
+A compressed message is sent as two zeromq frames: a header frame followed by
+the compressed payload. The uncompressed messages keep a single frame, so the
+collector accepts the messages of compressed and uncompressed nodes on the
+same socket. The header frame is:
+- COMPRESSION_MAGIC and the header version (u8)
+- the codec (u8, see CODECS)
+- the id of the preset dictionary (u32 crc32, 0 without dictionary)
+- the length of the uncompressed payload (u32)
+
+The preset dictionaries (zlib only, lzma has none) are files of bytes often
+found in the messages, built with train_dictionary from recorded traffic.
+The nodes and the collector must load the same file.
+'''
+import struct
+import zlib
+from collections import Counter
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+COMPRESSION_MAGIC = b"\0CMZ"
+COMPRESSION_HEADER_VERSION = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+# codec name -> codec id, the available ones
+CODECS = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB}
+if lzma is not None:
+    CODECS['lzma'] = CODEC_LZMA
+
+_codec_errors = (zlib.error,)
+if lzma is not None:
+    _codec_errors += (lzma.LZMAError,)
+
+# zlib uses the last 32 KiB of the preset dictionary
+MAX_DICTIONARY_SIZE = 32768
+
+# Largest uncompressed message accepted by the collector
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+_compression_header = struct.Struct("<4sBBII")
+
+
+def dictionary_id(dictionary):
+    '''
+    Return the id of a preset dictionary, never 0
+    '''
+    return zlib.crc32(dictionary) or 1
+
+
+def load_dictionary(path):
+    with open(path, 'rb') as dictionary_file:
+        return dictionary_file.read()[-MAX_DICTIONARY_SIZE:]
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE, segment=16):
+    '''
+    Return a preset dictionary made of the segments of bytes the most
+    repeated in the sample messages, the most frequent ones at the end where
+    they are the cheapest to reference
+    '''
+    counts = Counter()
+    for sample in samples:
+        sample = bytes(sample)
+        for offset in range(0, len(sample) - segment + 1, segment // 2):
+            counts[sample[offset:offset + segment]] += 1
+    chunks = []
+    length = 0
+    for (chunk, count) in counts.most_common():
+        if count < 2 or length + len(chunk) > size:
+            break
+        chunks.append(chunk)
+        length += len(chunk)
+    return b"".join(reversed(chunks))
+
+
+class Compressor(object):
+    '''
+    Compression of the messages of a node
+    '''
+
+    def __init__(self, codec='zlib', level=None, dictionary=None):
+        if codec not in CODECS or codec == 'none':
+            raise ValueError("Unsupported compression codec %s" % codec)
+        if dictionary and codec != 'zlib':
+            raise ValueError("The preset dictionaries need zlib")
+        self.codec = CODECS[codec]
+        self.level = level
+        self.dictionary = dictionary or None
+        self.dictionary_id = dictionary_id(dictionary) if dictionary else 0
+
+    def compress(self, raw):
+        '''
+        Return the header and the payload frames of a message
+        '''
+        raw = memoryview(raw)
+        if raw.format != 'B':
+            raw = raw.cast('B')
+        if self.codec == CODEC_ZLIB:
+            level = -1 if self.level is None else self.level
+            if self.dictionary is None:
+                compressor = zlib.compressobj(level)
+            else:
+                compressor = zlib.compressobj(level, zdict=self.dictionary)
+            payload = compressor.compress(raw) + compressor.flush()
+        else:
+            payload = lzma.compress(raw, preset=self.level)
+        header = _compression_header.pack(COMPRESSION_MAGIC,
+                                          COMPRESSION_HEADER_VERSION,
+                                          self.codec, self.dictionary_id,
+                                          len(raw))
+        return (header, payload)
+
+
+class Decompressor(object):
+    '''
+    Decompression of the messages of the nodes
+    '''
+
+    def __init__(self, dictionaries=()):
+        # dictionary id -> preset dictionary
+        self.dictionaries = dict((dictionary_id(dictionary), dictionary)
+                                 for dictionary in dictionaries)
+
+    def decompress(self, header, payload):
+        '''
+        Return the message of a header frame and its payload frame. The
+        output is bounded by the length of the header, a payload inflating
+        beyond it is rejected without being decompressed further.
+        '''
+        try:
+            (magic, version, codec, dict_id, length) = \
+                _compression_header.unpack(bytes(header))
+        except struct.error:
+            raise ValueError("Invalid compression header")
+        if magic != COMPRESSION_MAGIC or \
+                version != COMPRESSION_HEADER_VERSION:
+            raise ValueError("Unsupported compression header")
+        if codec == CODEC_NONE:
+            return payload
+        if length > MAX_MESSAGE_LENGTH:
+            raise ValueError("The message has %s bytes, more than %s"
+                             % (length, MAX_MESSAGE_LENGTH))
+        try:
+            if codec == CODEC_ZLIB:
+                if dict_id:
+                    if dict_id not in self.dictionaries:
+                        raise ValueError("Unknown compression dictionary %08x"
+                                         % dict_id)
+                    decompressor = zlib.decompressobj(
+                        zdict=self.dictionaries[dict_id])
+                else:
+                    decompressor = zlib.decompressobj()
+            elif codec == CODEC_LZMA and lzma is not None:
+                decompressor = lzma.LZMADecompressor()
+            else:
+                raise ValueError("Unsupported compression codec %s" % codec)
+            # one more byte than expected tells a longer message
+            raw = decompressor.decompress(payload, length + 1)
+        except _codec_errors as e:
+            raise ValueError("Invalid compressed payload: %s" % e)
+        if len(raw) > length:
+            raise ValueError("The message has more than %s bytes" % length)
+        if not decompressor.eof:
+            raise ValueError("Truncated compressed payload")
+        if len(raw) != length:
+            raise ValueError("The message has %s bytes instead of %s"
+                             % (len(raw), length))
+        return raw
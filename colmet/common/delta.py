@@ -0,0 +1,432 @@
+'''
+Delta encoded stream of counters, the version 3 wire format.
+
+The messages of a node are a stream: each record is encoded against the
+previous record of the same (job, metric) pair sent by the node, the
+integers as the zigzag varint of their difference, the floats and the
+dictionary indexes of the strings as plain varints. The counters only
+growing by a few units per period take one or two bytes instead of eight.
+
+Every keyframe_interval messages, a keyframe encodes the records against
+zero and resets the state of the stream, so a collector started after the
+node, or having missed a message, resyncs at the next keyframe. The messages
+carry a sequence number to detect the missing ones.
+
+A message starts like the version 2 batches (BATCH_MAGIC, version 3), with:
+- the sequence number (u32) and the flags (u8, 1 for a keyframe)
+- the hostname, the job list and the string dictionary of version 2
+- the sections (u16 count): the metric name and the schema descriptor of
+  version 2, the schema id, the number of records, the payload length (u32),
+  then the payload.
+  The payload is made of one varint per field of BatchSchema, preceded by the
+  job index, for each record.
+
+The payloads are pure varint streams, decoded at once with numpy.
+'''
+import logging
+import struct
+
+import numpy as np
+
+from colmet.common.batch import CounterBatch, get_dtype
+from colmet.common.metrics.base import (BATCH_MAGIC, DELTA_BATCH_VERSION,
+                                        DEFAULT_KEYFRAME_INTERVAL,
+                                        BatchSchema, pack_batch_head,
+                                        unpack_batch_head, pack_section_name,
+                                        unpack_section_class)
+
+LOG = logging.getLogger()
+
+FLAG_KEYFRAME = 1
+
+_MASK64 = 2 ** 64 - 1
+_MASK32 = 2 ** 32 - 1
+
+_delta_header = struct.Struct("<4sBIB")
+_u16 = struct.Struct("<H")
+_section_header = struct.Struct("<III")
+
+# Kinds of the fields of the schemas
+INTEGER = 0
+FLOAT = 1
+DOUBLE = 2
+STRING = 3
+
+_float_bits = {
+    FLOAT: (struct.Struct("<f"), struct.Struct("<I"), np.uint32, np.float32),
+    DOUBLE: (struct.Struct("<d"), struct.Struct("<Q"), np.uint64, np.float64),
+}
+
+# counters class -> FieldKinds
+_field_kinds = {}
+
+
+class FieldKinds(object):
+    '''
+    Encoding of the fields of the BatchSchema of a counters class
+    '''
+
+    def __init__(self, counters_class):
+        self.schema = BatchSchema.get(counters_class)
+        definitions = dict(counters_class._header_definitions)
+        definitions.update(counters_class._counter_definitions)
+        self.kinds = []
+        self.signed = []
+        for (_, key, is_string) in self.schema.fields:
+            struct_code = definitions[key][0].struct_code
+            if is_string:
+                self.kinds.append(STRING)
+            elif struct_code == 'f':
+                self.kinds.append(FLOAT)
+            elif struct_code == 'd':
+                self.kinds.append(DOUBLE)
+            else:
+                self.kinds.append(INTEGER)
+            self.signed.append(struct_code == 'q')
+        # the columns encoded as differences
+        self.deltas = np.array([kind == INTEGER for kind in self.kinds],
+                               dtype=bool)
+
+    @staticmethod
+    def get(counters_class):
+        # the compact counters are encoded as the ones of their metric
+        if counters_class._compact_of is not None:
+            counters_class = counters_class._compact_of
+        field_kinds = _field_kinds.get(counters_class)
+        if field_kinds is None:
+            field_kinds = _field_kinds[counters_class] = \
+                FieldKinds(counters_class)
+        return field_kinds
+
+
+def write_uvarint(out, value):
+    '''
+    Append the varint of the unsigned value to the bytearray out
+    '''
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def zigzag(delta):
+    '''
+    Return the zigzag code of the difference of two uint64, taken modulo
+    2**64 as an int64
+    '''
+    delta &= _MASK64
+    if delta >> 63:
+        return ((_MASK64 - delta) << 1) | 1
+    return delta << 1
+
+
+def decode_uvarints(payload):
+    '''
+    Return the uint64 array of the varints of payload
+    '''
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    if data[-1] & 0x80:
+        raise ValueError("Truncated varint")
+    # the last byte of each varint has the high bit cleared
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > 10:
+        raise ValueError("Varint longer than 64 bits")
+    positions = np.arange(len(data)) - np.repeat(starts, lengths)
+    chunks = (data & 0x7f).astype(np.uint64) << \
+        (7 * positions).astype(np.uint64)
+    # the chunks do not overlap, their sum is their bitwise or
+    return np.add.reduceat(chunks, starts)
+
+
+def unzigzag(codes):
+    '''
+    Return the uint64 differences (modulo 2**64) of zigzag codes
+    '''
+    return (codes >> np.uint64(1)) ^ (-(codes & np.uint64(1)))
+
+
+def record_keys(schema, job_ids):
+    '''
+    Return the keys of the records of a section: a job can have several
+    records of the same metric (the ports of infinibandstats...), they are
+    told apart by their rank
+    '''
+    ranks = {}
+    keys = []
+    for job_id in job_ids:
+        rank = ranks.get(job_id, 0)
+        ranks[job_id] = rank + 1
+        keys.append((schema.schema_id, job_id, rank))
+    return keys
+
+
+class DeltaEncoder(object):
+    '''
+    Encoder of the stream of messages of a node
+    '''
+
+    def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        if keyframe_interval < 1:
+            raise ValueError("The keyframe interval must be positive")
+        self.keyframe_interval = keyframe_interval
+        self.sequence = 0
+        self.since_keyframe = 0
+        # (schema id, job_id, rank) -> values of the fields sent last
+        self.previous = {}
+
+    def encode(self, counters_list):
+        '''
+        Return the message of the counters of one host
+        '''
+        hostname = counters_list[0].hostname
+        keyframe = self.since_keyframe == 0
+        previous = {} if keyframe else self.previous
+        jobs = {}
+        strings = {}
+        # FieldKinds -> (job ids, values of the records)
+        sections = {}
+        for counters in counters_list:
+            if counters.hostname != hostname:
+                raise ValueError("A batch carries the metrics of one host "
+                                 "(%s, %s)" % (hostname, counters.hostname))
+            field_kinds = FieldKinds.get(type(counters))
+            values = []
+            for ((is_header, key, _), kind) in zip(field_kinds.schema.fields,
+                                                   field_kinds.kinds):
+                if is_header:
+                    value = counters._get_header(key)
+                else:
+                    value = counters._get_counter(key)
+                if value is None:
+                    raise ValueError("The counter %s of %s has no value"
+                                     % (key, counters.metric_backend))
+                if kind == INTEGER:
+                    value = int(value) & _MASK64
+                elif kind == STRING:
+                    value = strings.setdefault(value, len(strings))
+                else:
+                    (pack, unpack, _, _) = _float_bits[kind]
+                    value = unpack.unpack(pack.pack(value))[0]
+                values.append(value)
+            jobs.setdefault(counters.job_id, len(jobs))
+            if field_kinds not in sections:
+                sections[field_kinds] = ([], [])
+            (job_ids, records) = sections[field_kinds]
+            job_ids.append(counters.job_id)
+            records.append(values)
+
+        chunks = [_delta_header.pack(BATCH_MAGIC, DELTA_BATCH_VERSION,
+                                     self.sequence,
+                                     FLAG_KEYFRAME if keyframe else 0)]
+        chunks.extend(pack_batch_head(hostname, list(jobs), list(strings)))
+        chunks.append(_u16.pack(len(sections)))
+        state = {}
+        for (field_kinds, (job_ids, records)) in sections.items():
+            schema = field_kinds.schema
+            kinds = field_kinds.kinds
+            payload = bytearray()
+            for (key, values) in zip(record_keys(schema, job_ids), records):
+                write_uvarint(payload, jobs[key[1]])
+                reference = previous.get(key)
+                for (index, value) in enumerate(values):
+                    if kinds[index] == INTEGER:
+                        if reference is not None:
+                            value -= reference[index]
+                        value = zigzag(value)
+                    write_uvarint(payload, value)
+                state[key] = values
+            chunks.append(pack_section_name(schema))
+            chunks.append(_section_header.pack(schema.schema_id, len(records),
+                                               len(payload)))
+            chunks.append(bytes(payload))
+
+        if keyframe:
+            self.previous = state
+        else:
+            self.previous.update(state)
+        self.since_keyframe = (self.since_keyframe + 1) % \
+            self.keyframe_interval
+        self.sequence = (self.sequence + 1) & _MASK32
+        return b"".join(chunks)
+
+
+class DeltaDecoder(object):
+    '''
+    Decoder of the streams of messages of the nodes, the messages following a
+    missing one are dropped until the next keyframe of their node
+    '''
+
+    def __init__(self):
+        # hostname -> (sequence of the last message, values of the records)
+        self.streams = {}
+        # number of messages dropped while waiting for a keyframe
+        self.dropped = 0
+        # number of messages missing in the sequences of the nodes
+        self.missed = 0
+
+    def decode(self, raw):
+        '''
+        Return the counters of a message
+        '''
+        counters_list = []
+        for section in self._iter_sections(raw):
+            counters_list.extend(self._decode_section(*section))
+        return counters_list
+
+    def decode_batches(self, raw):
+        '''
+        Return the records of a message as CounterBatch, one per section
+        '''
+        return [self._decode_section_batch(*section)
+                for section in self._iter_sections(raw)]
+
+    def _iter_sections(self, raw):
+        '''
+        Yield (hostname, jobs, strings, counters class, field kinds, records,
+        payload, previous values) for each section of a message, the state of
+        the stream of the node is updated once all the sections are decoded
+        '''
+        raw = memoryview(raw)
+        (_, version, sequence, flags) = _delta_header.unpack_from(raw, 0)
+        if version != DELTA_BATCH_VERSION:
+            raise ValueError("Unsupported batch version %s" % version)
+        (hostname, jobs, strings, offset) = \
+            unpack_batch_head(raw, _delta_header.size)
+
+        stream = self.streams.pop(hostname, None)
+        if stream is not None and (sequence or not flags & FLAG_KEYFRAME):
+            # (a restarted node starts a new sequence with a keyframe)
+            self.missed += (sequence - stream[0] - 1) & _MASK32
+        if flags & FLAG_KEYFRAME:
+            previous = {}
+        elif stream is None or stream[0] != (sequence - 1) & _MASK32:
+            self.dropped += 1
+            LOG.debug("Message %s of %s dropped until the next keyframe"
+                      % (sequence, hostname))
+            return
+        else:
+            previous = stream[1]
+
+        jobs = np.array(jobs, dtype=np.uint64)
+        (count,) = _u16.unpack_from(raw, offset)
+        offset += _u16.size
+        for _ in range(count):
+            (metric_name, counters_class, offset) = \
+                unpack_section_class(raw, offset)
+            (schema_id, records, length) = _section_header.unpack_from(raw,
+                                                                       offset)
+            offset += _section_header.size
+            payload = raw[offset:offset + length]
+            offset += length
+
+            if counters_class is None:
+                continue
+            field_kinds = FieldKinds.get(counters_class)
+            if field_kinds.schema.schema_id != schema_id:
+                LOG.error("The counters of %s have a different schema on the "
+                          "node %s, %s records skipped"
+                          % (metric_name, hostname, records))
+                continue
+            yield (hostname, jobs, strings, counters_class, field_kinds,
+                   records, payload, previous)
+
+        self.streams[hostname] = (sequence, previous)
+
+    @staticmethod
+    def _decode_fields(jobs, field_kinds, records, payload, previous):
+        '''
+        Return the job ids and the matrix of the fields (u64 bits) of the
+        records of a section, previous is updated
+        '''
+        schema = field_kinds.schema
+        width = len(schema.fields)
+        values = decode_uvarints(payload)
+        if len(values) != records * (width + 1):
+            raise ValueError("The section of %s has %s values for %s records"
+                             % (schema.metric_name, len(values), records))
+        values = values.reshape(records, width + 1)
+        job_ids = jobs[values[:, 0]]
+        keys = record_keys(schema, job_ids.tolist())
+
+        references = np.zeros((records, width), dtype=np.uint64)
+        for (index, key) in enumerate(keys):
+            reference = previous.get(key)
+            if reference is not None:
+                references[index] = reference
+        fields = values[:, 1:]
+        fields = np.where(field_kinds.deltas, references + unzigzag(fields),
+                          fields)
+        for (key, row) in zip(keys, fields):
+            previous[key] = row
+        return (job_ids, fields)
+
+    @staticmethod
+    def _field_column(fields, field_kinds, index):
+        '''
+        Return the column of a field with its numpy type, the strings as
+        indexes in the dictionary
+        '''
+        column = fields[:, index]
+        kind = field_kinds.kinds[index]
+        if kind == INTEGER and field_kinds.signed[index]:
+            return column.view(np.int64)
+        if kind in (FLOAT, DOUBLE):
+            (_, _, bits, float_type) = _float_bits[kind]
+            return column.astype(bits).view(float_type)
+        return column
+
+    @staticmethod
+    def _decode_section(hostname, jobs, strings, counters_class, field_kinds,
+                        records, payload, previous):
+        (job_ids, fields) = DeltaDecoder._decode_fields(
+            jobs, field_kinds, records, payload, previous)
+        schema = field_kinds.schema
+        columns = []
+        for (index, kind) in enumerate(field_kinds.kinds):
+            column = DeltaDecoder._field_column(fields, field_kinds, index)
+            if kind == STRING:
+                columns.append([strings[i] for i in column.tolist()])
+            else:
+                columns.append(column.tolist())
+
+        metric_name = schema.metric_name
+        counters_list = []
+        for (job_id, record) in zip(job_ids.tolist(), zip(*columns)):
+            header_values = {'metric_backend': metric_name,
+                             'hostname': hostname,
+                             'job_id': job_id}
+            counter_values = {}
+            for ((is_header, key, _), value) in zip(schema.fields, record):
+                if is_header:
+                    header_values[key] = value
+                else:
+                    counter_values[key] = value
+            counters_list.append(
+                counters_class.from_values(header_values, counter_values))
+        return counters_list
+
+    @staticmethod
+    def _decode_section_batch(hostname, jobs, strings, counters_class,
+                              field_kinds, records, payload, previous):
+        (job_ids, fields) = DeltaDecoder._decode_fields(
+            jobs, field_kinds, records, payload, previous)
+        schema = field_kinds.schema
+        array = np.zeros(records, get_dtype(counters_class))
+        array['metric_backend'] = schema.metric_name.encode('utf-8')
+        array['hostname'] = hostname.encode('utf-8')
+        array['job_id'] = job_ids
+        encoded = np.array([string.encode('utf-8') for string in strings]
+                           or [b""])
+        for (index, (_, key, _)) in enumerate(schema.fields):
+            column = DeltaDecoder._field_column(fields, field_kinds, index)
+            if field_kinds.kinds[index] == STRING:
+                array[key] = encoded[column.astype(np.intp)]
+            else:
+                array[key] = column
+        return CounterBatch(counters_class, array)
@@ -131,6 +131,27 @@ class FileAlreadyOpenWithDifferentModeError(Error):
     )
 
 
+class CountersSubsetError(Error):
+    '''
+    The subset of counters of a backend cannot be sent
+    '''
+    desc = "Unable to send a subset of the counters of %s: %s"
+
+    def __init__(self, backend_name, reason):
+        Error.__init__(self, (backend_name, reason))
+
+
+class OutputBackendUnavailableError(Error):
+    '''
+    The output backend could not store the counters, they can be pushed again
+    later
+    '''
+    desc = "The output backend %s is unavailable: %s"
+
+    def __init__(self, backend_name, reason):
+        Error.__init__(self, (backend_name, reason))
+
+
 class TimeoutException(Exception):
     '''
     A simple class to handle timeout for the main colmet loop
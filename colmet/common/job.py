@@ -3,12 +3,30 @@ import time
 import os
 import socket
 import logging
+import threading
+from collections import namedtuple
 
 LOG = logging.getLogger()
 
 from .exceptions import NoJobFoundError
 
 
+# Tasks of a cgroup, with the ones added and removed since the previous read
+TaskList = namedtuple('TaskList', ['tids', 'added', 'removed'])
+
+# Number of updates the last totals of a task no more sampled are kept for
+# its exit notification, which is received by another thread
+FORGOTTEN_TASK_CYCLES = 2
+
+
+def is_per_process(input_backend):
+    '''
+    Return True if the tasks are fetched per thread group rather than per
+    thread (taskstats --taskstats-per-process option)
+    '''
+    return getattr(input_backend.options, 'taskstats_per_process', False)
+
+
 class Info(object):
     '''
     Base class for Information class that do the common initialization
@@ -32,11 +50,17 @@ class TaskInfo(Info):
     '''
     Represent Information corresponding to a task
     '''
-    def __init__(self, tid, input_backend):
+    def __init__(self, tid, input_backend, tgid=False):
         Info.__init__(self, input_backend)
         self.tid = tid
         self.mark = True
-        self.backend_request = self.counters_class.build_request(input_backend, tid)
+        if tgid:
+            # the task stands for the whole thread group 'tid'
+            self.backend_request = self.counters_class.build_request(
+                input_backend, tid, tgid=True)
+        else:
+            self.backend_request = self.counters_class.build_request(
+                input_backend, tid)
 
     def update_stats(self, timestamp, job_id, hostname):
         '''
@@ -44,6 +68,12 @@ class TaskInfo(Info):
         '''
         stats = self.counters_class.fetch(self.input_backend,
                                           self.backend_request)
+        self.set_stats(stats, timestamp, job_id, hostname)
+
+    def set_stats(self, stats, timestamp, job_id, hostname):
+        '''
+        Update the current metrics of the task from already fetched counters
+        '''
         if stats:
             if not self.stats_delta:
                 self.stats_total = stats
@@ -87,6 +117,7 @@ class ProcessInfo(Info):
         Info.__init__(self, input_backend)
         self.tgid = pid
         self.tasks = {}
+        self.per_process = is_per_process(input_backend)
         self.get_task(pid)
         self.mark = True
 
@@ -102,7 +133,7 @@ class ProcessInfo(Info):
         stats_delta.type = 'process'
         stats_delta.id = self.tgid
 
-        for tid, task in self.tasks.items():
+        for tid, task in list(self.tasks.items()):
             if task.mark:
                 msg = (
                     "Task %s no more exists."
@@ -138,6 +169,9 @@ class ProcessInfo(Info):
         '''
         Retrieve the list of tasks of the current process
         '''
+        if self.per_process:
+            # the whole thread group is fetched with one request
+            return [self.tgid]
         try:
             tids = list(map(int, os.listdir('/proc/%d/task' % self.tgid)))
         except OSError:
@@ -152,7 +186,7 @@ class ProcessInfo(Info):
         '''
         task = self.tasks.get(tid, None)
         if not task:
-            task = TaskInfo(tid, self.input_backend)
+            task = TaskInfo(tid, self.input_backend, tgid=self.per_process)
             self.tasks[tid] = task
         return task
 
@@ -164,70 +198,172 @@ class CGroupInfo(Info):
     def __init__(self, cgroup_path, input_backend):
         Info.__init__(self, input_backend)
         self.cgroup_path = cgroup_path
-        self.tasks = {}
+        self.per_process = is_per_process(input_backend)
+        # index of the tasks of every cgroup, maintained when the exited
+        # tasks are accounted from the taskstats exit notifications
+        self.task_index = getattr(input_backend, 'task_index', None)
+        # final stats of the tasks exited since the last update
+        self.exited_delta = None
+        # tid -> (update, last totals) of the tasks no more sampled whose
+        # exit has not been notified yet
+        self.forgotten = {}
+        self.updates = 0
+        # the counters of the tasks are kept in columns rather than in a
+        # TaskInfo per task, only the taskstats backend samples the tasks of
+        # a cgroup
+        self.task_columns = input_backend.create_task_columns(
+            self.per_process)
+        # the exit notifications are handled by another thread
+        self.lock = threading.Lock()
 
     def list_tids(self):
         '''
-        Return the list of tasks of the current process
+        Return the list of tasks of the current process, or the list of
+        processes (thread group ids) in per-process mode
+        '''
+        return self.read_tasks().tids
+
+    def read_tasks(self):
+        '''
+        Return the TaskList of the cgroup, from the task list snapshot of the
+        node cycle if the backend has a job registry
         '''
+        if self.per_process:
+            filename = 'cgroup.procs'
+        else:
+            filename = 'tasks'
+        # the tasks no more sampled waiting for their exit notification are
+        # not added again
+        tracked = set(self.task_columns.requests)
+        tracked.update(self.forgotten)
+        job_registry = getattr(self.input_backend, 'job_registry', None)
+        if job_registry is not None:
+            return job_registry.get_tasks(self.cgroup_path, filename,
+                                          tracked)
         try:
-            f_tasks = open(os.path.join(self.cgroup_path, 'tasks'), 'r')
+            f_tasks = open(os.path.join(self.cgroup_path, filename), 'r')
             pids = list(map(int, f_tasks.read().split()))
             f_tasks.close()
-        except OSError:
-            return []
-        except IOError:
-            return []
-        return pids
+        except (OSError, IOError):
+            pids = []
+        tids = set(pids)
+        return TaskList(pids, tids.difference(tracked),
+                        tracked.difference(tids))
 
-    def get_task(self, tid):
+    def forget_task(self, tid):
         '''
-        Return the task corresponding to the given tid
+        Stop tracking the task corresponding to the given tid. When the exits
+        are notified, its last totals are kept until its exit notification
+        or for FORGOTTEN_TASK_CYCLES updates.
         '''
-        task = self.tasks.get(tid, None)
-        if not task:
-            task = TaskInfo(tid, self.input_backend)
-            self.tasks[tid] = task
-        return task
+        last_stats = self.task_columns.forget(tid)
+        if self.task_index is not None:
+            if last_stats is not None:
+                self.forgotten[tid] = (self.updates, last_stats)
+            elif tid not in self.forgotten:
+                self._unindex_task(tid)
+
+    def release_tasks(self):
+        '''
+        Remove the tasks of the cgroup from the task index, when its job ends
+        '''
+        with self.lock:
+            if self.task_index is not None:
+                for (tid, owner) in list(self.task_index.items()):
+                    if owner is self:
+                        del self.task_index[tid]
+            self.forgotten.clear()
+
+    def _unindex_task(self, tid):
+        if self.task_index is not None and self.task_index.get(tid) is self:
+            del self.task_index[tid]
+
+    def _expire_forgotten(self):
+        for (tid, (updates, _)) in list(self.forgotten.items()):
+            if self.updates - updates >= FORGOTTEN_TASK_CYCLES:
+                del self.forgotten[tid]
+                self._unindex_task(tid)
+
+    def account_exit(self, tid, stats):
+        '''
+        Account the final metrics of an exited task: what it has consumed
+        since its last sample if it was tracked or has been forgotten
+        recently, everything otherwise.
+        '''
+        with self.lock:
+            last_stats = self.task_columns.forget(tid)
+            (_, forgotten_stats) = self.forgotten.pop(tid, (None, None))
+            if last_stats is None:
+                last_stats = forgotten_stats
+            self._unindex_task(tid)
+            if last_stats is not None:
+                if self.per_process:
+                    # the exit notification of a thread group lacks some
+                    # counters, they keep their last sampled value
+                    for name in getattr(self.counters_class,
+                                        'thread_group_missing', []):
+                        if getattr(stats, name) < getattr(last_stats, name):
+                            setattr(stats, name, getattr(last_stats, name))
+                exit_delta = self.counters_class()
+                stats.delta(last_stats, exit_delta)
+            else:
+                exit_delta = stats
+            if self.exited_delta is None:
+                self.exited_delta = exit_delta
+            else:
+                self.exited_delta.accumulate(exit_delta, self.exited_delta)
 
     def update_stats(self, timestamp, job_id, hostname):
         '''
         Update the current metrics for this cgroup.
         '''
+        with self.lock:
+            self._update_stats(timestamp, job_id, hostname)
+        return True
 
+    def _update_stats(self, timestamp, job_id, hostname):
         stats_delta = self.counters_class()
         stats_delta.type = 'cgroup'
         stats_delta.id = self.cgroup_path
 
-        if len(self.list_tids()) > 0:
-            for tid in self.list_tids():
-                task = self.get_task(tid)
-                task.update_stats(timestamp, job_id, hostname)
-
-            for tid, task in list(self.tasks.items()):
-                if task.mark:
-                    msg = (
-                        "Process/Task %s no more exists."
-                        "Removing from the Job %s"
-                        % (tid, self.cgroup_path)
-                    )
-                    LOG.debug(msg)
-                    del self.tasks[tid]
-                else:
-                    task.mark = True
-                    stats_delta.accumulate(task.stats_delta, stats_delta)
-
-            self.stats_delta = stats_delta
-            self.stats_total.accumulate(stats_delta, self.stats_total)
-
+        self.updates += 1
+        self._expire_forgotten()
+        task_list = self.read_tasks()
+        for tid in task_list.removed:
+            self.forget_task(tid)
+        tids = task_list.tids
+        if len(tids) > 0:
+            if self.task_index is not None:
+                for tid in task_list.added:
+                    self.task_index[tid] = self
+                    self.forgotten.pop(tid, None)
+            # the tasks found at the first update have run before colmet
+            # started or the job was found: their first sample is only the
+            # baseline of their next deltas
+            tasks_delta = self.task_columns.update(
+                tids, baseline=self.updates == 1)
+            if self.task_index is not None:
+                # the tasks which have not answered (exited meanwhile)
+                for (tid, last_stats) in self.task_columns.lost:
+                    self.forgotten[tid] = (self.updates, last_stats)
+            if tasks_delta is not None:
+                stats_delta.accumulate(tasks_delta, stats_delta)
             self.void_cpuset = False
 
         else:  # no task in this cgroup....
             LOG.info("no task in this cgroup")
             # raise VoidCpusetError
 
+        exited_delta = self.exited_delta
+        if exited_delta is not None:
+            stats_delta.accumulate(exited_delta, stats_delta)
+            self.exited_delta = None
+
+        if len(tids) > 0 or exited_delta is not None:
+            self.stats_delta = stats_delta
+            self.stats_total.accumulate(stats_delta, self.stats_total)
+
         Info.update_stats(self, timestamp, job_id, hostname)
-        return True
 
 
 class ProcStatsInfo(Info):
@@ -273,7 +409,8 @@ class Job(object):
 
         if input_backend.__backend_name__ == "perfhwstats"\
            or input_backend.__backend_name__ == "jobprocstats"\
-           or input_backend.__backend_name__ == "nvidiastats":
+           or input_backend.__backend_name__ == "nvidiastats"\
+           or input_backend.__backend_name__ == "cgroupstats":
             self.job_children.append(
                 OtherTaskInfo(job_id, input_backend)
             )
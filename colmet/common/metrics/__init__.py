@@ -1,13 +1,87 @@
-import pkgutil
+'''
+Registry of the counters classes.
 
-__path__ = pkgutil.extend_path(__path__, __name__)  # noqa
-for importer, modname, ispkg in pkgutil.walk_packages(path=__path__,
-                                                      prefix=__name__ + '.'):
-        __import__(modname)
+The classes are imported on first use: the metrics of colmet are found in
+COUNTERS_CLASSES, the ones of other packages are declared with entry points
+of the 'colmet.metrics' group, named after the metric:
+
+    entry_points={
+        'colmet.metrics': [
+            'mymetric_default = mypackage.metrics:MyMetricCounters',
+        ],
+    }
+'''
+import importlib
+import logging
 
 from colmet.common.exceptions import UnableToFindCounterClassError
 from .base import BaseCounters
 
+LOG = logging.getLogger()
+
+# Entry point group of the counters classes of other packages
+ENTRY_POINTS_GROUP = 'colmet.metrics'
+
+# metric name -> 'module:class' of the counters classes of colmet
+COUNTERS_CLASSES = {
+    'taskstats_default': 'colmet.common.metrics.taskstats:TaskstatsCounters',
+    'procstats_default': 'colmet.common.metrics.procstats:ProcstatsCounters',
+    'jobprocstats_default':
+        'colmet.common.metrics.jobprocstats:JobprocstatsCounters',
+    'perfhwstats_default':
+        'colmet.common.metrics.perfhwstats:PerfhwstatsCounters',
+    'RAPLstats_default': 'colmet.common.metrics.RAPLstats:RAPLstatsCounters',
+    'infinibandstats_default':
+        'colmet.common.metrics.infinibandstats:InfinibandstatsCounters',
+    'lustrestats_default':
+        'colmet.common.metrics.lustrestats:LustrestatsCounters',
+    'temperaturestats_default':
+        'colmet.common.metrics.temperaturestats:TemperaturestatsCounters',
+    'ipmipowerstats_default':
+        'colmet.common.metrics.ipmipowerstats:IpmipowerstatsCounters',
+    'nvidiastats_default':
+        'colmet.common.metrics.nvidiastats:NvidiastatsCounters',
+    'cgroupstats_default':
+        'colmet.common.metrics.cgroupstats:CgroupstatsCounters',
+}
+
+# metric name -> counters class, filled on first use
+counters_registry = {}
+
+# metric names without counters class, they are not looked up again (one
+# sender of an unknown metric must not cost a scan of the entry points per
+# message) until clear_missing_metrics is called, when the collector reloads
+missing_metrics = set()
+
+
+def load_object(path):
+    '''
+    Import and return the object of a 'module:name' path
+    '''
+    (module_name, _, name) = path.partition(':')
+    return getattr(importlib.import_module(module_name), name)
+
+
+def iter_entry_points(group):
+    '''
+    Return the entry points of a group, as (name, loader) pairs
+    '''
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return [(ep.name, ep.load)
+                for ep in pkg_resources.iter_entry_points(group)]
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=group)
+    else:
+        eps = eps.get(group, [])
+    return [(ep.name, ep.load) for ep in eps]
+
 
 def find_inheritors_counters(klass):
     subclasses = {}
@@ -16,14 +90,40 @@ def find_inheritors_counters(klass):
         parent = work.pop()
         for child in parent.__subclasses__():
             if child not in subclasses:
-                subclasses[child.__metric_name__] = child
+                # the compact and subset classes share the metric of their
+                # parent
+                if child._compact_of is None and child._subset_of is None:
+                    subclasses[child.__metric_name__] = child
                 work.append(child)
     return subclasses
 
-counters_registry = find_inheritors_counters(BaseCounters)
+
+def clear_missing_metrics():
+    '''
+    Look up again the metrics which had no counters class
+    '''
+    missing_metrics.clear()
 
 
 def get_counters_class(metric):
-    if metric in counters_registry:
-        return counters_registry[metric]
-    raise UnableToFindCounterClassError(metric)
+    counters_class = counters_registry.get(metric)
+    if counters_class is not None:
+        return counters_class
+    if metric in missing_metrics:
+        raise UnableToFindCounterClassError(metric)
+
+    if metric in COUNTERS_CLASSES:
+        counters_class = load_object(COUNTERS_CLASSES[metric])
+    else:
+        for (name, load) in iter_entry_points(ENTRY_POINTS_GROUP):
+            if name == metric:
+                counters_class = load()
+                break
+        else:
+            # the classes defined by an already imported module
+            counters_class = find_inheritors_counters(BaseCounters).get(metric)
+    if counters_class is None:
+        missing_metrics.add(metric)
+        raise UnableToFindCounterClassError(metric)
+    counters_registry[metric] = counters_class
+    return counters_class
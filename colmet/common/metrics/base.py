@@ -5,12 +5,16 @@ base functions to register/unregister counter and also pack/unpack data.
 '''
 from functools import reduce
 from datetime import datetime
-from ..exceptions import CounterAlreadyExistError, NoneValueError
+from ..exceptions import Error, CounterAlreadyExistError, NoneValueError
 
 
 import struct
+import logging
 import operator
 import ctypes
+import zlib
+
+LOG = logging.getLogger()
 
 ######################
 # Base counter types #
@@ -72,6 +76,166 @@ class String(BaseType):
     after_unpack = lambda self, value: value.rstrip(b"\0").decode('utf-8')
 
 
+#####################
+# Batch wire format #
+#####################
+
+# Version 1 is the concatenation of the packed counters. Version 2 starts
+# with BATCH_MAGIC (a metric name never starts with a NUL byte) and the
+# version, followed by:
+# - the hostname of the batch (u16 length + utf-8)
+# - the job list (u32 count + u64 job ids)
+# - the string dictionary (u32 count + u32 length/utf-8 strings)
+# - the sections (u16 count), one per counters class: the metric name
+#   (u8 length + utf-8), the schema descriptor, the schema id, the record
+#   width, the number of records, then the fixed width records. In a record
+#   the job_id is an index in the job list and the strings are indexes in the
+#   dictionary. The schema descriptor lists the counters of the subset classes
+#   (u16 count + u8 length/utf-8 names), its count is 0 for the counters
+#   class of the metric.
+# Version 3 is the delta encoded stream of colmet.common.delta, it needs the
+# state of the previous messages of the host.
+WIRE_FORMATS = [1, 2, 3]
+BATCH_MAGIC = b"\0CMT"
+BATCH_VERSION = 2
+DELTA_BATCH_VERSION = 3
+# Number of version 3 messages between two keyframes
+DEFAULT_KEYFRAME_INTERVAL = 60
+
+_batch_header = struct.Struct("<4sB")
+_u8 = struct.Struct("<B")
+_u16 = struct.Struct("<H")
+_u32 = struct.Struct("<I")
+_section_header = struct.Struct("<III")
+
+# counters class -> BatchSchema
+_batch_schemas = {}
+
+# Number of bytes read to find the metric name of a version 1 record
+METRIC_NAME_PROBE = 64
+
+# metric name (bytes) -> counters class, for the version 1 records
+_metric_classes = {}
+
+
+def pack_section_name(schema):
+    '''
+    Return the metric name and the schema descriptor of a section
+    '''
+    encoded_name = schema.metric_name.encode('utf-8')
+    return _u8.pack(len(encoded_name)) + encoded_name + schema.descriptor
+
+
+def unpack_section_class(raw, offset):
+    '''
+    Return (metric name, counters class, offset after them) of the section
+    at offset, the counters class is None when it is unknown
+    '''
+    from . import get_counters_class
+    (length,) = _u8.unpack_from(raw, offset)
+    offset += _u8.size
+    metric_name = bytes(raw[offset:offset + length]).decode('utf-8')
+    offset += length
+    (count,) = _u16.unpack_from(raw, offset)
+    offset += _u16.size
+    names = []
+    for _ in range(count):
+        (length,) = _u8.unpack_from(raw, offset)
+        offset += _u8.size
+        names.append(bytes(raw[offset:offset + length]).decode('utf-8'))
+        offset += length
+    try:
+        counters_class = get_counters_class(metric_name)
+        if names:
+            counters_class = subset_counters_class(counters_class, names)
+    except (Error, ValueError) as e:
+        LOG.error("Unknown counters of %s: %s" % (metric_name, e))
+        counters_class = None
+    return (metric_name, counters_class, offset)
+
+
+def pack_batch_head(hostname, jobs, strings):
+    '''
+    Return the chunks of the hostname, the job list and the string dictionary
+    of a batch, jobs and strings are ordered by index
+    '''
+    encoded_hostname = hostname.encode('utf-8')
+    chunks = [_u16.pack(len(encoded_hostname)), encoded_hostname,
+              _u32.pack(len(jobs)),
+              struct.pack("<%sQ" % len(jobs), *jobs),
+              _u32.pack(len(strings))]
+    for string in strings:
+        encoded = string.encode('utf-8')
+        chunks.append(_u32.pack(len(encoded)))
+        chunks.append(encoded)
+    return chunks
+
+
+def unpack_batch_head(raw, offset):
+    '''
+    Return (hostname, jobs, strings, offset after them) of the batch head
+    at offset
+    '''
+    (length,) = _u16.unpack_from(raw, offset)
+    offset += _u16.size
+    hostname = bytes(raw[offset:offset + length]).decode('utf-8')
+    offset += length
+    (count,) = _u32.unpack_from(raw, offset)
+    offset += _u32.size
+    jobs = struct.unpack_from("<%sQ" % count, raw, offset)
+    offset += 8 * count
+    (count,) = _u32.unpack_from(raw, offset)
+    offset += _u32.size
+    strings = []
+    for _ in range(count):
+        (length,) = _u32.unpack_from(raw, offset)
+        offset += _u32.size
+        strings.append(bytes(raw[offset:offset + length]).decode('utf-8'))
+        offset += length
+    return (hostname, jobs, strings, offset)
+
+
+class BatchSchema(object):
+    '''
+    Layout of the records of a counters class in the version 2 batches
+    '''
+
+    def __init__(self, counters_class):
+        self.metric_name = counters_class.__metric_name__
+        # (is_header, key, is_string) of the fields following the job index
+        self.fields = []
+        for key in counters_class._fmt_header_ordered_keys:
+            if key in ('metric_backend', 'hostname', 'job_id'):
+                continue
+            h_type = counters_class._header_definitions[key][0]
+            self.fields.append((True, key, isinstance(h_type, String)))
+        for key in counters_class._fmt_counter_ordered_keys:
+            c_type = counters_class._counter_definitions[key][0]
+            self.fields.append((False, key, isinstance(c_type, String)))
+        definitions = dict(counters_class._header_definitions)
+        definitions.update(counters_class._counter_definitions)
+        fmt = "<I" + "".join("I" if is_string
+                             else definitions[key][0].struct_code
+                             for (_, key, is_string) in self.fields)
+        self.record = struct.Struct(fmt)
+        # counter names of the subset classes
+        names = [name.encode('utf-8') for name in counters_class._subset or []]
+        self.descriptor = _u16.pack(len(names)) + b"".join(
+            _u8.pack(len(name)) + name for name in names)
+        self.schema_id = zlib.crc32(
+            ("%s:%s:%s" % (self.metric_name,
+                           ",".join(key for (_, key, _) in self.fields),
+                           counters_class._fmt)).encode('utf-8'))
+
+    @staticmethod
+    def get(counters_class):
+        schema = _batch_schemas.get(counters_class)
+        if schema is None:
+            schema = _batch_schemas[counters_class] = \
+                BatchSchema(counters_class)
+        return schema
+
+
 #####################
 # Base metric class #
 #####################
@@ -283,7 +447,21 @@ class MetaCountersType(type):
         c_key_list, c_fmt_code_list = zip(*counter_fmt_list) if len(counter_fmt_list) > 0 else ([], [])
 
         self._fmt = "<" + "".join(list(h_fmt_code_list)) + "".join(list(c_fmt_code_list))
-        self._fmt_length = struct.calcsize(self._fmt)
+        self._fmt_struct = struct.Struct(self._fmt)
+        self._fmt_length = self._fmt_struct.size
+
+        # name -> (type, struct, offset) of each header/counter, used to
+        # access the values of the packed counters
+        self._field_structs = {}
+        for (name, (f_type, _, _, f_offset)) in self._header_definitions.items():
+            self._field_structs[name] = (f_type,
+                                         struct.Struct("<" + f_type.struct_code),
+                                         f_offset)
+        for (name, definition) in self._counter_definitions.items():
+            (f_type, f_offset) = (definition[0], definition[5])
+            self._field_structs[name] = (f_type,
+                                         struct.Struct("<" + f_type.struct_code),
+                                         f_offset)
 
         self._fmt_header_ordered_keys = list(h_key_list)
         self._fmt_counter_ordered_keys = list(c_key_list)
@@ -303,6 +481,12 @@ class BaseCounters(object, metaclass=MetaCountersType):
 
     # __metaclass__ = MetaCountersType
     __metric_name__ = "base"
+    # counters class of a compact counters class (see compact_counters_class)
+    _compact_of = None
+    # counters class and counter names of a subset class (see
+    # subset_counters_class)
+    _subset_of = None
+    _subset = None
     _headers = [('metric_backend', String(255), 'string'),
                 ('hostname', String(255), 'string'),
                 ('job_id', UInt64(), 'count'),
@@ -316,16 +500,71 @@ class BaseCounters(object, metaclass=MetaCountersType):
     ################
 
     @staticmethod
-    def create_metric_from_raw(raw):
-        from . import get_counters_class
-        backend = struct.unpack('255s', raw[0:255])[0]
-        backend = backend.rstrip(b"\0")
-        counters_class = get_counters_class(backend.decode("utf-8"))
-        counters = counters_class(raw=raw[0:counters_class._fmt_length])
-        return counters
+    def get_counters_class_from_raw(raw, offset=0):
+        '''
+        Return the counters class of the version 1 record at offset of raw
+        '''
+        # the metric names are short, only their beginning is read to find
+        # the counters class
+        prefix = bytes(raw[offset:offset + METRIC_NAME_PROBE])
+        backend = prefix.split(b"\0", 1)[0]
+        if len(backend) == METRIC_NAME_PROBE:
+            backend = bytes(raw[offset:offset + 255]).rstrip(b"\0")
+        counters_class = _metric_classes.get(backend)
+        if counters_class is None:
+            from . import get_counters_class
+            counters_class = _metric_classes[backend] = \
+                get_counters_class(backend.decode("utf-8"))
+        return counters_class
 
     @staticmethod
-    def pack_from_list(counters_list):
+    def get_hostname_from_raw(raw):
+        '''
+        Return the hostname of a message of any wire format without
+        unpacking its counters
+        '''
+        raw = memoryview(raw)
+        if raw.format != 'B':
+            raw = raw.cast('B')
+        if bytes(raw[0:len(BATCH_MAGIC)]) == BATCH_MAGIC:
+            if raw[len(BATCH_MAGIC)] == DELTA_BATCH_VERSION:
+                from colmet.common.delta import _delta_header
+                offset = _delta_header.size
+            else:
+                offset = _batch_header.size
+            (length,) = _u16.unpack_from(raw, offset)
+            offset += _u16.size
+            return bytes(raw[offset:offset + length]).decode('utf-8')
+        # the records of a version 1 message all come from the same host
+        offset = BaseCounters._header_definitions['hostname'][3]
+        return bytes(raw[offset:offset + 255]).rstrip(b"\0").decode('utf-8')
+
+    @staticmethod
+    def create_metric_from_raw(raw, offset=0):
+        '''
+        Return the counters packed at offset of raw. When raw is a memoryview
+        the counters are a view on it, nothing is copied.
+        '''
+        counters_class = BaseCounters.get_counters_class_from_raw(raw, offset)
+        return counters_class(
+            raw=raw[offset:offset + counters_class._fmt_length])
+
+    @staticmethod
+    def pack_from_list(counters_list, wire_format=1, encoder=None):
+        '''
+        Pack the counters in a wire format, the version 3 needs the
+        DeltaEncoder of the stream
+        '''
+        if wire_format == 2:
+            return BaseCounters.pack_batch(counters_list)
+        if wire_format == 3:
+            if encoder is None:
+                raise ValueError("The wire format 3 needs a delta encoder")
+            return encoder.encode(counters_list)
+        for counters in counters_list:
+            if counters._subset_of is not None:
+                raise ValueError("The subsets of counters need the wire "
+                                 "format 2 or 3")
         length = reduce(operator.add, [counters._fmt_length for counters in counters_list])
         raw = ctypes.create_string_buffer(length)
         offset = 0
@@ -336,12 +575,28 @@ class BaseCounters(object, metaclass=MetaCountersType):
         return raw
 
     @staticmethod
-    def unpack_to_list(raw, unpack_counters=False):
+    def unpack_to_list(raw, unpack_counters=False, decoder=None):
+        '''
+        Unpack a message of any wire format. raw can be any buffer (bytes,
+        ctypes buffer, zmq frame buffer...): the counters are views on it
+        until they are unpacked. The version 3 messages need the DeltaDecoder
+        of the streams.
+        '''
+        raw = memoryview(raw)
+        if raw.format != 'B':
+            raw = raw.cast('B')
+        if bytes(raw[0:len(BATCH_MAGIC)]) == BATCH_MAGIC:
+            if raw[len(BATCH_MAGIC)] == DELTA_BATCH_VERSION:
+                if decoder is None:
+                    raise ValueError("The wire format 3 needs a delta "
+                                     "decoder")
+                return decoder.decode(raw)
+            return BaseCounters.unpack_batch(raw)
         length = len(raw)
         offset = 0
         counters_list = list()
         while(offset < length):
-            counters = BaseCounters.create_metric_from_raw(raw[offset:])
+            counters = BaseCounters.create_metric_from_raw(raw, offset)
             offset += counters._fmt_length
             counters_list.append(counters)
 
@@ -351,9 +606,120 @@ class BaseCounters(object, metaclass=MetaCountersType):
 
         return counters_list
 
+    @staticmethod
+    def pack_batch(counters_list):
+        '''
+        Pack the counters of one host in the version 2 batch format
+        '''
+        hostname = counters_list[0].hostname
+        jobs = {}
+        strings = {}
+        sections = {}
+        for counters in counters_list:
+            if counters.hostname != hostname:
+                raise ValueError("A batch carries the metrics of one host "
+                                 "(%s, %s)" % (hostname, counters.hostname))
+            schema = BatchSchema.get(type(counters))
+            values = [jobs.setdefault(counters.job_id, len(jobs))]
+            for (is_header, key, is_string) in schema.fields:
+                if is_header:
+                    value = counters._get_header(key)
+                else:
+                    value = counters._get_counter(key)
+                if is_string:
+                    value = strings.setdefault(value, len(strings))
+                values.append(value)
+            if schema not in sections:
+                sections[schema] = []
+            sections[schema].append(schema.record.pack(*values))
+
+        chunks = [_batch_header.pack(BATCH_MAGIC, BATCH_VERSION)]
+        chunks.extend(pack_batch_head(hostname, jobs, strings))
+        chunks.append(_u16.pack(len(sections)))
+        for (schema, records) in sections.items():
+            chunks.append(pack_section_name(schema))
+            chunks.append(_section_header.pack(schema.schema_id,
+                                               schema.record.size,
+                                               len(records)))
+            chunks.extend(records)
+        return b"".join(chunks)
+
+    @staticmethod
+    def iter_batch_sections(raw):
+        '''
+        Parse a version 2 batch, yield for each section (hostname, jobs,
+        strings, counters class, schema, records payload). The sections
+        whose schema differs from the local counters class are skipped.
+        '''
+        raw = memoryview(raw)
+        (_, version) = _batch_header.unpack_from(raw, 0)
+        if version != BATCH_VERSION:
+            raise ValueError("Unsupported batch version %s" % version)
+        (hostname, jobs, strings, offset) = \
+            unpack_batch_head(raw, _batch_header.size)
+        (count,) = _u16.unpack_from(raw, offset)
+        offset += _u16.size
+        for _ in range(count):
+            (metric_name, counters_class, offset) = \
+                unpack_section_class(raw, offset)
+            (schema_id, width, records) = _section_header.unpack_from(raw,
+                                                                      offset)
+            offset += _section_header.size
+            payload = raw[offset:offset + width * records]
+            offset += width * records
+
+            if counters_class is None:
+                continue
+            schema = BatchSchema.get(counters_class)
+            if schema.schema_id != schema_id:
+                LOG.error("The counters of %s have a different schema on the "
+                          "node %s, %s records skipped"
+                          % (metric_name, hostname, records))
+                continue
+            yield (hostname, jobs, strings, counters_class, schema, payload)
+
+    @staticmethod
+    def unpack_batch(raw):
+        '''
+        Unpack a version 2 batch
+        '''
+        counters_list = []
+        for (hostname, jobs, strings, counters_class, schema, payload) in \
+                BaseCounters.iter_batch_sections(raw):
+            metric_name = schema.metric_name
+            for values in schema.record.iter_unpack(payload):
+                header_values = {'metric_backend': metric_name,
+                                 'hostname': hostname,
+                                 'job_id': jobs[values[0]]}
+                counter_values = {}
+                for ((is_header, key, is_string), value) in \
+                        zip(schema.fields, values[1:]):
+                    if is_string:
+                        value = strings[value]
+                    if is_header:
+                        header_values[key] = value
+                    else:
+                        counter_values[key] = value
+                counters_list.append(
+                    counters_class.from_values(header_values, counter_values))
+        return counters_list
+
     #################
     # Class methods #
     #################
+    @classmethod
+    def from_values(cls, header_values, counter_values):
+        '''
+        Return unpacked counters holding the given dicts of values
+        '''
+        counters = cls.__new__(cls)
+        counters._header_values = header_values
+        counters._counter_values = counter_values
+        counters._packed = False
+        counters._view = False
+        counters._buf = None
+        return counters
+
     @classmethod
     def get_zero_counters(cls, timestamp=None, *args):
         raise TypeError(
@@ -388,32 +754,40 @@ class BaseCounters(object, metaclass=MetaCountersType):
             for c_name in list(self._counter_definitions):
                 self._set_counter(c_name, None)
 
+    def _set_field(self, key, value):
+        if self._view:
+            # the view on the received message is read only
+            self.unpack()
+            return False
+        (f_type, f_struct, f_offset) = self._field_structs[key]
+        value = f_type.before_pack(value)
+        if isinstance(value, str):
+            value = bytes(value, 'utf-8')
+        f_struct.pack_into(self._buf, f_offset, value)
+        return True
+
+    def _get_field(self, key):
+        (f_type, f_struct, f_offset) = self._field_structs[key]
+        return f_type.after_unpack(f_struct.unpack_from(self._buf, f_offset)[0])
+
     def _set_header(self, key, value):
-        if self._packed:
-            (h_type, _, _, h_offset) = self._header_definitions[key]
-            struct.pack_into(h_type.struct_code, self._buf, h_offset, h_type.before_pack(value))
-        else:
+        if not self._packed or not self._set_field(key, value):
             self._header_values[key] = value
 
     def _get_header(self, key):
         if self._packed:
-            (h_type, _, _, h_offset) = self._header_definitions[key]
-            return h_type.after_unpack(struct.unpack_from(h_type.struct_code, self._buf, h_offset)[0])
+            return self._get_field(key)
         else:
             return self._header_values[key]
 
     def _get_counter(self, key):
         if self._packed:
-            (c_type, _, _, _, _, c_offset) = self._counter_definitions[key]
-            return c_type.after_unpack(struct.unpack_from(c_type.struct_code, self._buf, c_offset)[0])
+            return self._get_field(key)
         else:
             return self._counter_values[key]
 
     def _set_counter(self, key, value):
-        if self._packed:
-            (c_type, _, _, _, _, c_offset) = self._counter_definitions[key]
-            struct.pack_into(c_type.struct_code, self._buf, c_offset, c_type.before_pack(value))
-        else:
+        if not self._packed or not self._set_field(key, value):
             self._counter_values[key] = value
 
     def __repr__(self):
@@ -455,6 +829,28 @@ class BaseCounters(object, metaclass=MetaCountersType):
     def get_metric_name(self):
         return self.__metric_name__
 
+    def is_complete(self):
+        '''
+        Return True if every counter has a value, the packed counters always
+        have one
+        '''
+        if self._packed:
+            return True
+        values = self._counter_values
+        return len(values) == len(self._counter_definitions) and \
+            None not in values.values()
+
+    def fill_missing(self):
+        '''
+        Set the counters without value to zero (empty string for the strings)
+        '''
+        if self._packed:
+            return
+        values = self._counter_values
+        for (name, definition) in self._counter_definitions.items():
+            if name not in values or values[name] is None:
+                values[name] = "" if isinstance(definition[0], String) else 0
+
     def pack(self):
         '''
         Convert the data into the packed form
@@ -474,6 +870,10 @@ class BaseCounters(object, metaclass=MetaCountersType):
 
         self.unpack_from(self._buf)
         self._packed = False
+        if self._view:
+            # release the received message
+            self._buf = None
+            self._view = False
 
     def pack_into(self, raw_buffer, offset=0):
         '''
@@ -492,14 +892,14 @@ class BaseCounters(object, metaclass=MetaCountersType):
 
         fmt_values = tuple(fmt_values_list)
 
-        struct.pack_into(self._fmt, raw_buffer, offset, *fmt_values)
+        self._fmt_struct.pack_into(raw_buffer, offset, *fmt_values)
 
 
     def unpack_from(self, raw_buffer, offset=0):
         '''
         Convert the data into the packed form from a specific buffer
         '''
-        fmt_values = struct.unpack_from(self._fmt, raw_buffer, offset)
+        fmt_values = self._fmt_struct.unpack_from(raw_buffer, offset)
         index = 0
         for key in self._fmt_header_ordered_keys:
             self._header_values[key] = self._header_definitions[key][0].after_unpack(fmt_values[index])
@@ -511,7 +911,7 @@ class BaseCounters(object, metaclass=MetaCountersType):
     def get_packed(self):
         if not self._packed:
             self.pack()
-        return self._buf[0:self._fmt_length]
+        return bytes(self._buf[0:self._fmt_length])
 
     def __init__(self, raw=None):
         self._counter_values = {}
@@ -524,9 +924,15 @@ class BaseCounters(object, metaclass=MetaCountersType):
                     % (len(raw), self._fmt_length)
                 )
             self._packed = True
-            self._buf = ctypes.create_string_buffer(raw)
+            # a memoryview (on a received message) is used as is
+            self._view = isinstance(raw, memoryview)
+            if self._view:
+                self._buf = raw
+            else:
+                self._buf = ctypes.create_string_buffer(raw)
         else:
             self._packed = False
+            self._view = False
             self._buf = None
             self.metric_backend = self.get_metric_name()
 
@@ -548,3 +954,259 @@ class BaseCounters(object, metaclass=MetaCountersType):
     def delta(self, other_stats, destination):
         """Update destination with self - other_stats"""
         return self.accumulate(other_stats, destination, coeff=-1)
+
+
+#######################
+# Compact counters    #
+#######################
+
+# Range of the values stored in the int64 buffer of the compact counters
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+_int64 = struct.Struct("q")
+
+# counters class -> compact counters class
+_compact_classes = {}
+
+
+class CompactValues(object):
+    '''
+    Mapping on the values of compact counters, for the code accessing
+    _counter_values/_header_values directly
+    '''
+    __slots__ = ('load', 'store', 'names')
+
+    def __init__(self, load, store, names):
+        self.load = load
+        self.store = store
+        self.names = names
+
+    def __getitem__(self, key):
+        return self.load(key)
+
+    def __setitem__(self, key, value):
+        self.store(key, value)
+
+    def __contains__(self, key):
+        return key in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+
+class CompactCounters(object):
+    '''
+    Methods of the compact counters classes (see compact_counters_class)
+    '''
+    __slots__ = ()
+
+    # Storage of the unpacked values, replacing the _counter_values and
+    # _header_values dicts of BaseCounters
+    def _load_counter(self, key):
+        index = self._counter_index[key]
+        if self._unset >> index & 1:
+            return None
+        others = self._others
+        if others is not None and index in others:
+            return others[index]
+        return _int64.unpack_from(self._values, index * 8)[0]
+
+    def _store_counter(self, key, value):
+        index = self._counter_index[key]
+        bit = 1 << index
+        others = self._others
+        if others is not None:
+            others.pop(index, None)
+        if value is None:
+            self._unset |= bit
+            return
+        self._unset &= ~bit
+        if type(value) is int and _INT64_MIN <= value <= _INT64_MAX:
+            _int64.pack_into(self._values, index * 8, value)
+        else:
+            # strings, floats and the integers out of the int64 range
+            if others is None:
+                others = self._others = {}
+            others[index] = value
+
+    def _load_header(self, key):
+        return getattr(self, self._header_slots[key])
+
+    def _store_header(self, key, value):
+        setattr(self, self._header_slots[key], value)
+
+    def _get_counter_values(self):
+        return CompactValues(self._load_counter, self._store_counter,
+                             self._fmt_counter_ordered_keys)
+
+    def _set_counter_values(self, values):
+        self._values = bytearray(8 * len(self._counter_index))
+        self._others = None
+        self._unset = (1 << len(self._counter_index)) - 1
+        for (key, value) in values.items():
+            self._store_counter(key, value)
+
+    def _get_header_values(self):
+        return CompactValues(self._load_header, self._store_header,
+                             self._fmt_header_ordered_keys)
+
+    def _set_header_values(self, values):
+        for slot in self._header_slots.values():
+            setattr(self, slot, None)
+        for (key, value) in values.items():
+            self._store_header(key, value)
+
+    # Accessors of BaseCounters
+    def _get_header(self, key):
+        if self._packed:
+            return self._get_field(key)
+        return getattr(self, self._header_slots[key])
+
+    def _set_header(self, key, value):
+        if not self._packed or not self._set_field(key, value):
+            setattr(self, self._header_slots[key], value)
+
+    def _get_counter(self, key):
+        if self._packed:
+            return self._get_field(key)
+        return self._load_counter(key)
+
+    def _set_counter(self, key, value):
+        if not self._packed or not self._set_field(key, value):
+            self._store_counter(key, value)
+
+    def is_complete(self):
+        return self._packed or not self._unset
+
+    def accumulate(self, other_stats, destination, coeff=1):
+        """Update destination from operator(self, other_stats)"""
+        if type(other_stats) is not type(self) or \
+                type(destination) is not type(self):
+            return BaseCounters.accumulate(self, other_stats, destination,
+                                           coeff)
+        for counters in [self, other_stats, destination]:
+            if counters._packed:
+                counters.unpack()
+
+        if not (self._unset or other_stats._unset
+                or self._others or other_stats._others):
+            # every value is in the int64 buffers
+            values_struct = self._values_struct
+            values = [acc_fn(x, y, coeff) for (acc_fn, x, y)
+                      in zip(self._accumulation_functions,
+                             values_struct.unpack(self._values),
+                             values_struct.unpack(other_stats._values))]
+            try:
+                destination._values = bytearray(values_struct.pack(*values))
+            except struct.error:
+                pass
+            else:
+                destination._others = None
+                destination._unset = 0
+                return
+
+        load_self = self._load_counter
+        load_other = other_stats._load_counter
+        store = destination._store_counter
+        for (name, acc_fn) in self._accumulations:
+            store(name, acc_fn(load_self(name), load_other(name), coeff))
+
+
+def compact_counters_class(counters_class):
+    '''
+    Return a class with the API of counters_class whose instances use
+    __slots__ and store the counters in an int64 buffer indexed by their
+    position in _fmt_counter_ordered_keys, and each header in its own slot,
+    rather than in dicts. It is
+    meant for the counters kept in large numbers by the node (several per
+    thread). It is not registered as the counters class of the metric.
+
+    The class does not derive from counters_class, whose instances have a
+    __dict__: it gets a copy of the attributes of counters_class and of its
+    bases. An instance is then a single object for the garbage collector,
+    the buffer is a bytearray which it does not track.
+    '''
+    compact_class = _compact_classes.get(counters_class)
+    if compact_class is None:
+        header_slots = dict(
+            (key, '_header_%s' % index) for (index, key)
+            in enumerate(counters_class._fmt_header_ordered_keys))
+        slots = ('_values', '_others', '_unset', '_packed', '_view',
+                 '_buf') + tuple(sorted(header_slots.values()))
+        attrs = {}
+        for klass in reversed(counters_class.__mro__[:-1]):
+            attrs.update((name, value) for (name, value)
+                         in klass.__dict__.items()
+                         if name not in ('__dict__', '__weakref__')
+                         and name not in slots)
+        attrs.update((name, value) for (name, value)
+                     in CompactCounters.__dict__.items()
+                     if callable(value))
+        attrs.update({
+            '__slots__': slots,
+            '__module__': counters_class.__module__,
+            '_compact_of': counters_class,
+            '_counter_values': property(CompactCounters._get_counter_values,
+                                        CompactCounters._set_counter_values),
+            '_header_values': property(CompactCounters._get_header_values,
+                                       CompactCounters._set_header_values),
+            '_counter_index': dict(
+                (key, index) for (index, key)
+                in enumerate(counters_class._fmt_counter_ordered_keys)),
+            '_header_slots': header_slots,
+            '_values_struct': struct.Struct(
+                '%sq' % len(counters_class._fmt_counter_ordered_keys)),
+            '_accumulations': [
+                (key, counters_class._counter_accumulation_functions[
+                    counters_class._counter_definitions[key][2]])
+                for key in counters_class._fmt_counter_ordered_keys],
+        })
+        attrs['_accumulation_functions'] = [
+            acc_fn for (_, acc_fn) in attrs['_accumulations']]
+        compact_class = _compact_classes[counters_class] = \
+            type('Compact' + counters_class.__name__, (object,), attrs)
+    return compact_class
+
+
+#######################
+# Subsets of counters #
+#######################
+
+# (counters class, counter names) -> subset counters class
+_subset_classes = {}
+
+
+def subset_counters_class(counters_class, names):
+    '''
+    Return a class of the metric of counters_class having only the given
+    counters, it is used to send and store a part of the counters of a
+    metric. The subsets are described in the version 2 and 3 batches and are
+    not registered as the counters class of the metric.
+    '''
+    if counters_class._compact_of is not None:
+        counters_class = counters_class._compact_of
+    if counters_class._subset_of is not None:
+        counters_class = counters_class._subset_of
+    unknown = set(names) - set(counters_class._counter_definitions)
+    if unknown:
+        raise ValueError("%s has no counter %s"
+                         % (counters_class.__metric_name__,
+                            ", ".join(sorted(unknown))))
+    names = tuple(key for key in counters_class._fmt_counter_ordered_keys
+                  if key in names)
+    subset_class = _subset_classes.get((counters_class, names))
+    if subset_class is None:
+        subset_class = type(counters_class)(
+            'Subset' + counters_class.__name__, (counters_class,),
+            {'__module__': counters_class.__module__,
+             '_subset_of': counters_class,
+             '_subset': names})
+        for key in list(subset_class._counter_definitions):
+            if key not in names:
+                del subset_class._counter_definitions[key]
+        subset_class._update_struct_fmt()
+        _subset_classes[(counters_class, names)] = subset_class
+    return subset_class
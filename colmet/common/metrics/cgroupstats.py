@@ -0,0 +1,79 @@
+import logging
+
+LOG = logging.getLogger()
+
+from .base import Int64, BaseCounters
+
+
+class CgroupstatsCounters(BaseCounters):
+    __metric_name__ = 'cgroupstats_default'
+
+    counters_cgroupstats = {
+        # 'key': ( type, repr, acc, description )
+        # cpu.stat (cgroup v2) or cpuacct.usage/cpuacct.stat (cgroup v1)
+        'cpu_usage_usec': (Int64(), 'usec', 'none', 'CPU time'),
+        'cpu_user_usec': (Int64(), 'usec', 'none', 'User CPU time'),
+        'cpu_system_usec': (Int64(), 'usec', 'none', 'System CPU time'),
+        'cpu_nr_throttled': (Int64(), 'count', 'none',
+                             'Nb of periods throttled'),
+        'cpu_throttled_usec': (Int64(), 'usec', 'none', 'Throttled time'),
+        # memory.current/memory.peak (cgroup v2) or
+        # memory.usage_in_bytes/memory.max_usage_in_bytes (cgroup v1)
+        'memory_current': (Int64(), 'bytes', 'none', 'Memory usage'),
+        'memory_peak': (Int64(), 'bytes', 'none', 'Peak memory usage'),
+        # memory.stat
+        'memory_anon': (Int64(), 'bytes', 'none', 'Anonymous memory'),
+        'memory_file': (Int64(), 'bytes', 'none', 'Page cache memory'),
+        'memory_shmem': (Int64(), 'bytes', 'none', 'Shared memory'),
+        'memory_pgfault': (Int64(), 'count', 'none', 'Page faults'),
+        'memory_pgmajfault': (Int64(), 'count', 'none', 'Major page faults'),
+        # io.stat (cgroup v2) or blkio.throttle.io_service_bytes and
+        # blkio.throttle.io_serviced (cgroup v1), summed over the devices
+        'io_rbytes': (Int64(), 'bytes', 'none', 'Bytes read'),
+        'io_wbytes': (Int64(), 'bytes', 'none', 'Bytes written'),
+        'io_rios': (Int64(), 'count', 'none', 'Read operations'),
+        'io_wios': (Int64(), 'count', 'none', 'Write operations'),
+    }
+
+    counters_cgroupstats_to_get = [
+        'cpu_usage_usec',
+        'cpu_user_usec',
+        'cpu_system_usec',
+        'cpu_nr_throttled',
+        'cpu_throttled_usec',
+        'memory_current',
+        'memory_peak',
+        'memory_anon',
+        'memory_file',
+        'memory_shmem',
+        'memory_pgfault',
+        'memory_pgmajfault',
+        'io_rbytes',
+        'io_wbytes',
+        'io_rios',
+        'io_wios',
+    ]
+
+    _counters = []
+    for c_name in counters_cgroupstats_to_get:
+        (c_type, c_repr, c_acc, c_descr) = counters_cgroupstats[c_name]
+        _counters.append((c_name, c_type, c_repr, c_acc, c_descr))
+
+    @classmethod
+    def get_zero_counters(cls):
+        return cls(cgroupstats_buffer=None, raw=None)
+
+    @classmethod
+    def fetch(cls, cgroupstats_backend, job_id):
+        return cgroupstats_backend.get_cgroup_stats(job_id)
+
+    def __init__(self, cgroupstats_buffer=None, raw=None):
+        BaseCounters.__init__(self, raw=raw)
+        if raw is not None:
+            pass
+        elif cgroupstats_buffer is None:
+            self._empty_fill()
+        else:
+            for name in CgroupstatsCounters._counter_definitions:
+                # counters not provided by the cgroup version are set to -1
+                self._counter_values[name] = cgroupstats_buffer.get(name, -1)
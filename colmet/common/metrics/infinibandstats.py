@@ -14,6 +14,7 @@ class InfinibandstatsCounters(BaseCounters):
         'portRcvData': (Int64(), 'bytes', 'none', 'portRcvData'),
         'portXmitPkts': (Int64(), 'count', 'none', 'portXmitPkts'),
         'portRcvPkts': (Int64(), 'count', 'none', 'portRcvPkts'),
+        'port': (String(255), 'string', 'none', 'port'),
         'involved_jobs': (String(8192), 'string', 'none', 'involved_jobs')
         }
         
@@ -22,6 +23,7 @@ class InfinibandstatsCounters(BaseCounters):
         'portRcvData',
         'portXmitPkts',
         'portRcvPkts',
+        'port',
         'involved_jobs'
     ]
 
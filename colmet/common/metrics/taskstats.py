@@ -250,6 +250,27 @@ class TaskstatsCounters(BaseCounters):
         'freepages_delay_total',
     ]
 
+    # Counters the kernel leaves to zero in the replies and exit
+    # notifications of thread groups (fill_stats_for_tgid)
+    thread_group_missing = [
+        'ac_btime',
+        'ac_utime',
+        'ac_stime',
+        'ac_minflt',
+        'ac_majflt',
+        'coremem',
+        'virtmem',
+        'read_char',
+        'write_char',
+        'read_syscalls',
+        'write_syscalls',
+        'read_bytes',
+        'write_bytes',
+        'cancelled_write_bytes',
+        'ac_utimescaled',
+        'ac_stimescaled',
+    ]
+
     _counters = []
     for c_name in counters_taskstats_to_get:
         (_, c_type, c_repr, c_acc, c_descr) = counters_taskstats[c_name]
@@ -264,8 +285,8 @@ class TaskstatsCounters(BaseCounters):
         return taskstat_backend.get_task_stats(request)
 
     @classmethod
-    def build_request(cls, taskstats_backend, tid):
-        return taskstats_backend.build_request(tid)
+    def build_request(cls, taskstats_backend, tid, tgid=False):
+        return taskstats_backend.build_request(tid, tgid)
 
     def __init__(self, taskstats_buffer=None, raw=None):
         BaseCounters.__init__(self, raw=raw)
@@ -279,4 +300,4 @@ class TaskstatsCounters(BaseCounters):
                 (c_offset, c_type, _, _, _) = packed_values
                 data = taskstats_buffer[c_offset:c_offset + c_type.length]
                 unpacked_struct = struct.unpack(c_type.struct_code, data)
-                self._counter_values[name] = unpacked_struct[0]
+                self._set_counter(name, unpacked_struct[0])
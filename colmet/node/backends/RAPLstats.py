@@ -1,9 +1,6 @@
 import os
-import re
 import ctypes
 import time
-import json
-import glob
 
 from colmet.common.backends.base import InputBaseBackend
 from colmet.common.job import Job
@@ -14,7 +11,7 @@ class RAPLstatsBackend(InputBaseBackend):
     __backend_name__ = "RAPLstats"
 
     def open(self):
-        self.RAPLstats = RAPLstats(self.options)
+        self.RAPLstats = RAPLstats(self.options, self.job_registry)
         # job with id equal to 0 is the fictive job to gather nodes' monitoring
         # measures
         self.job_0 = Job(self, 0, self.options)
@@ -36,8 +33,9 @@ class RAPLstatsBackend(InputBaseBackend):
 
 class RAPLstats(object):
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry):
         self.options = option
+        self.job_registry = job_registry
 
         lib_path = os.getenv('LIB_RAPL_PATH', "/usr/lib/lib_rapl.so")
         self.raplLib = ctypes.cdll.LoadLibrary(lib_path)
@@ -76,18 +74,6 @@ class RAPLstats(object):
             metric_name = "no_counter,,"
             metrics_mapping.write("counter_" + str(i + 1) + "," + str(metric_name) + "\n")
 
-    def get_running_jobs(self):
-        job_ids=[]
-        if os.path.exists("/dev/cpuset/oar"):
-            cwd = os.getcwd()
-            os.chdir("/dev/cpuset/oar")
-            for file in glob.glob("*_*"):
-                m = re.search('.*_(\d+)',file)
-                if m is not None:
-                    job_ids.append(int(m.group(1)))
-            os.chdir(cwd)
-        return job_ids
-
     def get_stats(self):
         RAPLstats_data = {}
 
@@ -107,7 +93,7 @@ class RAPLstats(object):
             RAPLstats_data["counter_" + str(i+1)] = -1
 
         self.oldEnergy = energy
-        jobs=json.dumps(self.get_running_jobs())
+        jobs=self.job_registry.snapshot.involved_jobs
         RAPLstats_data['involved_jobs'] = jobs
 
         return RAPLstatsCounters(RAPLstats_buffer=RAPLstats_data)
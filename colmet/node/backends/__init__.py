@@ -0,0 +1,44 @@
+'''
+Registry of the input backends of colmet-node.
+
+The backends are imported when they are enabled: the ones of colmet are
+found in INPUT_BACKENDS, the ones of other packages are declared with entry
+points of the 'colmet.node_backends' group, named after the backend:
+
+    entry_points={
+        'colmet.node_backends': [
+            'mybackend = mypackage.backend:MyBackend',
+        ],
+    }
+'''
+from colmet.common.metrics import load_object, iter_entry_points
+
+# Entry point group of the input backends of other packages
+ENTRY_POINTS_GROUP = 'colmet.node_backends'
+
+# backend name -> 'module:class' of the input backends of colmet
+INPUT_BACKENDS = {
+    'taskstats': 'colmet.node.backends.taskstats:TaskstatsBackend',
+    'procstats': 'colmet.node.backends.procstats:ProcstatsBackend',
+    'jobprocstats': 'colmet.node.backends.jobprocstats:JobprocstatsBackend',
+    'perfhwstats': 'colmet.node.backends.perfhwstats:PerfhwstatsBackend',
+    'RAPLstats': 'colmet.node.backends.RAPLstats:RAPLstatsBackend',
+    'infinibandstats':
+        'colmet.node.backends.infinibandstats:InfinibandstatsBackend',
+    'lustrestats': 'colmet.node.backends.lustrestats:LustrestatsBackend',
+    'temperaturestats':
+        'colmet.node.backends.temperaturestats:TemperaturestatsBackend',
+    'ipmipowerstats':
+        'colmet.node.backends.ipmipowerstats:IpmipowerstatsBackend',
+    'nvidiastats': 'colmet.node.backends.nvidiastats:NvidiastatsBackend',
+    'cgroupstats': 'colmet.node.backends.cgroupstats:CgroupstatsBackend',
+}
+
+
+def get_input_backend_class(name):
+    if name in INPUT_BACKENDS:
+        return load_object(INPUT_BACKENDS[name])
+    for (ep_name, load) in iter_entry_points(ENTRY_POINTS_GROUP):
+        if ep_name == name:
+            return load()
+    raise ValueError("Unknown input backend %s" % name)
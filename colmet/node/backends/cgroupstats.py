@@ -0,0 +1,289 @@
+import os
+import copy
+import logging
+
+from colmet.common.metrics.cgroupstats import CgroupstatsCounters
+from colmet.common.exceptions import JobNeedToBeDefinedError
+from colmet.common.backends.base import InputBaseBackend
+from colmet.common.job import Job
+
+LOG = logging.getLogger()
+
+
+class CgroupstatsBackend(InputBaseBackend):
+    '''
+    Per job metrics read from the accounting files of the job cgroup: the
+    cost is one read per file and per job, whatever the number of tasks.
+    '''
+    __backend_name__ = "cgroupstats"
+
+    def open(self):
+        self.jobs = {}
+        self.filenames = {}
+
+        self.cgroupstats = CgroupStats(self.options)
+        if len(self.job_id_list) < 1 \
+                and self.options.cpuset_rootpath == []:
+            raise JobNeedToBeDefinedError()
+        if len(self.job_id_list) == 1:
+            job_id = self.job_id_list[0]
+            self.jobs[job_id] = Job(self, job_id, self.options)
+        else:
+            for i, job_id in enumerate(self.job_id_list):
+                self.jobs[job_id] = Job(self, job_id, self.options)
+
+    def close(self):
+        self.cgroupstats.close()
+
+    def get_cgroup_stats(self, job_id):
+        if str(job_id) in self.filenames:
+            return self.cgroupstats.get_stats(self.filenames[str(job_id)])
+
+    def pull(self):
+        values = list(self.jobs.values())
+        for job in values:
+            job.update_stats()
+        return [job.get_stats() for job in values]
+
+    def get_counters_class(self):
+        return CgroupstatsCounters
+
+    def create_options_job_cgroups(self, cgroups):
+        # options are duplicated to allow modification per jobs, here
+        # cgroups parametter
+        options = copy.copy(self.options)
+        options.cgroups = cgroups
+        return options
+
+    def update_job_list(self):
+        """Used to maintained job list upto date by adding new jobs and
+        removing ones to monitor accordingly to the job registry of the node.
+        """
+        snapshot = self.job_registry.snapshot
+        job_ids = snapshot.job_ids
+        monitored_job_ids = set(self.job_id_list)
+        ended_filenames = self.filenames
+        self.filenames = snapshot.filenames
+
+        # Add new jobs
+        for job_id in (job_ids - monitored_job_ids):
+            job_path = snapshot.job_path(job_id)
+            options = self.create_options_job_cgroups([job_path])
+            self.jobs[job_id] = Job(self, int(job_id), options)
+
+        # Del ended jobs
+        for job_id in (monitored_job_ids - job_ids):
+            self.cgroupstats.close_job(ended_filenames[job_id])
+            del self.jobs[job_id]
+
+        # udpate job_id list to monitor
+        self.job_id_list = list(job_ids)
+
+
+# Accounting files of the cgroup v2 unified hierarchy
+CGROUP_V2_FILES = ['cpu.stat', 'memory.current', 'memory.peak',
+                   'memory.stat', 'io.stat']
+
+# Accounting files of the cgroup v1 hierarchies, by controller. The cpu,
+# memory and blkio hierarchies are found by replacing the cpuset component
+# of the job cgroup path.
+CGROUP_V1_FILES = [
+    ('cpuacct', 'cpuacct.usage'),
+    ('cpuacct', 'cpuacct.stat'),
+    ('cpu', 'cpu.stat'),
+    ('memory', 'memory.usage_in_bytes'),
+    ('memory', 'memory.max_usage_in_bytes'),
+    ('memory', 'memory.stat'),
+    ('blkio', 'blkio.throttle.io_service_bytes'),
+    ('blkio', 'blkio.throttle.io_serviced'),
+]
+
+# memory.stat keys, the cgroup v1 ones include the descendant cgroups
+MEMORY_STAT_V2 = {'anon': 'memory_anon', 'file': 'memory_file',
+                  'shmem': 'memory_shmem', 'pgfault': 'memory_pgfault',
+                  'pgmajfault': 'memory_pgmajfault'}
+MEMORY_STAT_V1 = {'total_rss': 'memory_anon', 'total_cache': 'memory_file',
+                  'total_shmem': 'memory_shmem',
+                  'total_pgfault': 'memory_pgfault',
+                  'total_pgmajfault': 'memory_pgmajfault'}
+
+# Largest accounting file read (io.stat has one line per device)
+CGROUP_READ_SIZE = 65536
+
+
+class CgroupStats(object):
+    '''
+    Read the accounting files of the job cgroups. The files are opened once
+    per job and read again with pread at each sample. The files missing when
+    the job is opened (e.g. a controller enabled after the job has started)
+    are opened again at the next samples.
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        # job filename -> {accounting filename: file descriptor}
+        self.job_fds = {}
+        # job filename -> {accounting filename: path} of the files which
+        # could not be opened
+        self.job_missing = {}
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+
+    def close(self):
+        for job_filename in list(self.job_fds):
+            self.close_job(job_filename)
+
+    def close_job(self, job_filename):
+        self.job_missing.pop(job_filename, None)
+        for fd in self.job_fds.pop(job_filename, {}).values():
+            os.close(fd)
+
+    def open_job(self, job_filename):
+        cpuset_rootpath = self.options.cpuset_rootpath[0]
+        job_path = os.path.join(cpuset_rootpath, job_filename)
+        fds = {}
+        missing = {}
+        if os.path.exists(os.path.join(job_path, 'cgroup.controllers')):
+            for filename in CGROUP_V2_FILES:
+                self._open(fds, missing, filename,
+                           os.path.join(job_path, filename))
+        else:
+            for controller, filename in CGROUP_V1_FILES:
+                path = os.path.join(self.controller_path(job_path, controller),
+                                    filename)
+                self._open(fds, missing, filename, path)
+        self.job_fds[job_filename] = fds
+        self.job_missing[job_filename] = missing
+        return fds
+
+    def open_missing(self, job_filename):
+        '''
+        Try again to open the accounting files of a job which were missing
+        '''
+        fds = self.job_fds[job_filename]
+        missing = self.job_missing[job_filename]
+        for filename, path in list(missing.items()):
+            try:
+                fds[filename] = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            del missing[filename]
+            LOG.info("cgroupstats: %s is now available" % path)
+
+    @staticmethod
+    def controller_path(job_path, controller):
+        '''
+        Return the path of the job cgroup in the hierarchy of `controller`,
+        e.g. /dev/oar_cgroups_links/memory/oar/user_42 for the memory one.
+        '''
+        components = job_path.split(os.sep)
+        for i in reversed(range(len(components))):
+            if components[i] == 'cpuset':
+                components[i] = controller
+                return os.sep.join(components)
+        return job_path
+
+    @staticmethod
+    def _open(fds, missing, filename, path):
+        try:
+            fds[filename] = os.open(path, os.O_RDONLY)
+        except OSError:
+            missing[filename] = path
+            LOG.debug("cgroupstats: %s is not available" % path)
+
+    def get_stats(self, job_filename):
+        fds = self.job_fds.get(job_filename)
+        if fds is None:
+            fds = self.open_job(job_filename)
+        elif self.job_missing[job_filename]:
+            self.open_missing(job_filename)
+
+        contents = {}
+        for filename, fd in fds.items():
+            try:
+                contents[filename] = os.pread(fd, CGROUP_READ_SIZE, 0).decode()
+            except OSError:
+                LOG.warning("cgroupstats: error reading %s of %s "
+                            "(disapeared?)" % (filename, job_filename))
+                self.close_job(job_filename)
+                return
+
+        if 'cpu.stat' in contents and 'memory.current' in contents:
+            cgroupstats_data = self.parse_v2(contents)
+        else:
+            cgroupstats_data = self.parse_v1(contents)
+        return CgroupstatsCounters(cgroupstats_buffer=cgroupstats_data)
+
+    @staticmethod
+    def parse_keys(content):
+        '''Parse the flat keyed files (cpu.stat, memory.stat...)'''
+        values = {}
+        for line in content.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                values[fields[0]] = int(fields[1])
+        return values
+
+    def parse_v2(self, contents):
+        data = {}
+        cpu = self.parse_keys(contents['cpu.stat'])
+        for key in ['usage_usec', 'user_usec', 'system_usec',
+                    'nr_throttled', 'throttled_usec']:
+            if key in cpu:
+                data['cpu_' + key] = cpu[key]
+        data['memory_current'] = int(contents['memory.current'])
+        if 'memory.peak' in contents:
+            data['memory_peak'] = int(contents['memory.peak'])
+        memory = self.parse_keys(contents.get('memory.stat', ''))
+        for key, name in MEMORY_STAT_V2.items():
+            if key in memory:
+                data[name] = memory[key]
+        if 'io.stat' in contents:
+            for key in ['rbytes', 'wbytes', 'rios', 'wios']:
+                data['io_' + key] = 0
+            # 8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0
+            for line in contents['io.stat'].splitlines():
+                for field in line.split()[1:]:
+                    key, _, value = field.partition('=')
+                    if 'io_' + key in data:
+                        data['io_' + key] += int(value)
+        return data
+
+    def parse_v1(self, contents):
+        data = {}
+        if 'cpuacct.usage' in contents:
+            data['cpu_usage_usec'] = int(contents['cpuacct.usage']) // 1000
+        if 'cpuacct.stat' in contents:
+            cpuacct = self.parse_keys(contents['cpuacct.stat'])
+            tick_usec = 1000000 // self.clock_ticks
+            data['cpu_user_usec'] = cpuacct.get('user', 0) * tick_usec
+            data['cpu_system_usec'] = cpuacct.get('system', 0) * tick_usec
+        if 'cpu.stat' in contents:
+            cpu = self.parse_keys(contents['cpu.stat'])
+            if 'nr_throttled' in cpu:
+                data['cpu_nr_throttled'] = cpu['nr_throttled']
+            if 'throttled_time' in cpu:
+                data['cpu_throttled_usec'] = cpu['throttled_time'] // 1000
+        if 'memory.usage_in_bytes' in contents:
+            data['memory_current'] = int(contents['memory.usage_in_bytes'])
+        if 'memory.max_usage_in_bytes' in contents:
+            data['memory_peak'] = int(contents['memory.max_usage_in_bytes'])
+        memory = self.parse_keys(contents.get('memory.stat', ''))
+        for key, name in MEMORY_STAT_V1.items():
+            if key in memory:
+                data[name] = memory[key]
+        for filename, prefix in [('blkio.throttle.io_service_bytes', 'bytes'),
+                                 ('blkio.throttle.io_serviced', 'ios')]:
+            if filename not in contents:
+                continue
+            data['io_r' + prefix] = 0
+            data['io_w' + prefix] = 0
+            # 8:0 Read 4096 / 8:0 Write 0 / ... / Total 4096
+            for line in contents[filename].splitlines():
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                if fields[1] == 'Read':
+                    data['io_r' + prefix] += int(fields[2])
+                elif fields[1] == 'Write':
+                    data['io_w' + prefix] += int(fields[2])
+        return data
@@ -53,6 +53,7 @@ class GeNlMessage(Message):
         hdr = _genl_hdr_parse(packet[:4])
 
         genlmsg = GeNlMessage(msg.type, hdr.cmd, [], msg.flags)
+        genlmsg.seq = msg.seq
         genlmsg.attrs = parse_attributes(packet[4:])
         genlmsg.version = hdr.version
 
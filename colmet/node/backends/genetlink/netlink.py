@@ -232,6 +232,7 @@ class Connection:
                 err = OSError("Netlink error: %s (%d)" % (
                                                      os.strerror(errno), errno))
                 err.errno = errno
+                err.seq = seq
                 raise err
         return msg
     def seq(self):
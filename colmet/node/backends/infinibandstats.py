@@ -1,27 +1,26 @@
 import os
 import re
-import glob
-import json
+import time
+import socket
+import logging
 
 from subprocess import check_output, STDOUT, CalledProcessError
 
 from colmet.common.backends.base import InputBaseBackend
-from colmet.common.job import Job
 from colmet.common.metrics.infinibandstats import InfinibandstatsCounters
 
+LOG = logging.getLogger()
 
 
 class InfinibandstatsBackend(InputBaseBackend):
     __backend_name__ = "infinibandstats"
 
     def open(self):
-        self.infinibandstats = InfinibandStats(self.options)
-        # job with id equal to 0 is the fictive job to gather nodes' monitoring
-        # measures
-        self.job_0 = Job(self, 0, self.options)
+        self.infinibandstats = InfinibandStats(self.options, self.job_registry)
+        self.hostname = socket.gethostname()
 
     def close(self):
-        pass
+        self.infinibandstats.close()
 
     def get_infinibandstats(self):
         counters = self.infinibandstats.get_stats()
@@ -31,28 +30,49 @@ class InfinibandstatsBackend(InputBaseBackend):
         return InfinibandstatsCounters
 
     def pull(self):
-        self.job_0.update_stats()
-        return self.job_0.get_stats()
+        # one record per port, associated to the fictive job 0 gathering the
+        # nodes' monitoring measures
+        counters_list = self.get_infinibandstats()
+        timestamp = int(time.time())
+        for counters in counters_list:
+            counters.timestamp = timestamp
+            counters.job_id = 0
+            counters.hostname = self.hostname
+        return counters_list
 
 
 class InfinibandStats(object):
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry, sysfs_root=None):
         self.options = option
+        self.job_registry = job_registry
+        if self.options.omnipath:
+            data_multiplier = 8
+        else:
+            data_multiplier = 4
+        self.ports = SysfsInfinibandPorts(sysfs_root or SYSFS_INFINIBAND,
+                                          data_multiplier)
+        if not self.ports.ports:
+            LOG.info("infinibandstats: no port found in sysfs, using "
+                     "perfquery")
 
-    def get_running_jobs(self):
-        job_ids=[]
-        if os.path.exists("/dev/cpuset/oar"):
-            cwd = os.getcwd()
-            os.chdir("/dev/cpuset/oar")
-            for file in glob.glob("*_*"):
-                m = re.search('.*_(\d+)',file)
-                if m is not None:
-                    job_ids.append(int(m.group(1)))
-            os.chdir(cwd)
-        return job_ids
+    def close(self):
+        self.ports.close()
 
     def get_stats(self):
+        jobs=self.job_registry.snapshot.involved_jobs
+        if not self.ports.ports:
+            return [self.get_perfquery_stats(jobs)]
+
+        counters_list = []
+        for port, infinibandstats_data in self.ports.read():
+            infinibandstats_data['port'] = port
+            infinibandstats_data['involved_jobs'] = jobs
+            counters_list.append(InfinibandstatsCounters(
+                infinibandstats_buffer=infinibandstats_data))
+        return counters_list
+
+    def get_perfquery_stats(self, jobs):
 
         if self.options.omnipath:
             mult_const = 8
@@ -93,7 +113,112 @@ class InfinibandStats(object):
         else:
             infinibandstats_data['portRcvPkts'] = -1
     
-        jobs=json.dumps(self.get_running_jobs())
+        infinibandstats_data['port'] = ''
         infinibandstats_data['involved_jobs'] = jobs
 
         return InfinibandstatsCounters(infinibandstats_buffer=infinibandstats_data)
+
+
+SYSFS_INFINIBAND = "/sys/class/infiniband"
+
+# counter -> (file of the counters directory, file of the hw_counters one).
+# The data counters of the counters directory are in words of 4 bytes (8 with
+# Omni-Path), the hw_counters ones are in bytes.
+PORT_COUNTERS = [
+    ('portXmitData', 'port_xmit_data', 'tx_bytes'),
+    ('portRcvData', 'port_rcv_data', 'rx_bytes'),
+    ('portXmitPkts', 'port_xmit_packets', 'tx_pkts'),
+    ('portRcvPkts', 'port_rcv_packets', 'rx_pkts'),
+]
+PORT_DATA_COUNTERS = ['portXmitData', 'portRcvData']
+
+
+class InfinibandPort(object):
+    '''
+    Counters of a port, read from sysfs with file descriptors kept open. The
+    hardware counters wrap around (32 or 64 bits), their deltas are summed
+    into monotonic totals.
+    '''
+
+    def __init__(self, name, path, data_multiplier):
+        self.name = name
+        # counter -> (file descriptor, multiplier)
+        self.files = {}
+        self.previous = {}
+        self.totals = {}
+        for counter, filename, hw_filename in PORT_COUNTERS:
+            multiplier = 1
+            if counter in PORT_DATA_COUNTERS:
+                multiplier = data_multiplier
+            for counter_path in [os.path.join(path, 'counters', filename),
+                                 os.path.join(path, 'hw_counters',
+                                              hw_filename)]:
+                try:
+                    self.files[counter] = (os.open(counter_path, os.O_RDONLY),
+                                           multiplier)
+                    break
+                except OSError:
+                    pass
+                multiplier = 1
+
+    def close(self):
+        for fd, _ in self.files.values():
+            os.close(fd)
+        self.files = {}
+
+    def read(self):
+        infinibandstats_data = {}
+        for counter, _, _ in PORT_COUNTERS:
+            if counter not in self.files:
+                infinibandstats_data[counter] = -1
+                continue
+            fd, multiplier = self.files[counter]
+            try:
+                value = int(os.pread(fd, 64, 0))
+            except (OSError, ValueError) as e:
+                LOG.warning("infinibandstats: cannot read %s of %s: %s"
+                            % (counter, self.name, e))
+                infinibandstats_data[counter] = -1
+                continue
+            previous = self.previous.get(counter)
+            if previous is None:
+                total = value
+            else:
+                delta = value - previous
+                if delta < 0:
+                    delta += 2 ** 32 if previous < 2 ** 32 else 2 ** 64
+                total = self.totals[counter] + delta
+            self.previous[counter] = value
+            self.totals[counter] = total
+            infinibandstats_data[counter] = multiplier * total
+        return infinibandstats_data
+
+
+class SysfsInfinibandPorts(object):
+    '''
+    All the ports of all the HCAs found in /sys/class/infiniband
+    '''
+
+    def __init__(self, root=SYSFS_INFINIBAND, data_multiplier=4):
+        self.ports = []
+        try:
+            hcas = sorted(os.listdir(root))
+        except OSError:
+            hcas = []
+        for hca in hcas:
+            ports_path = os.path.join(root, hca, 'ports')
+            try:
+                ports = sorted(os.listdir(ports_path), key=int)
+            except (OSError, ValueError):
+                continue
+            for port in ports:
+                self.ports.append(InfinibandPort(
+                    "%s/%s" % (hca, port), os.path.join(ports_path, port),
+                    data_multiplier))
+
+    def close(self):
+        for port in self.ports:
+            port.close()
+
+    def read(self):
+        return [(port.name, port.read()) for port in self.ports]
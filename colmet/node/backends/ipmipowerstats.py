@@ -1,7 +1,4 @@
-import os
 import re
-import glob
-import json
 
 from subprocess import check_output, STDOUT, CalledProcessError
 
@@ -15,7 +12,7 @@ class IpmipowerstatsBackend(InputBaseBackend):
     __backend_name__ = "ipmipowerstats"
 
     def open(self):
-        self.ipmipowerstats = IpmipowerStats(self.options)
+        self.ipmipowerstats = IpmipowerStats(self.options, self.job_registry)
         # job with id equal to 0 is the fictive job to gather nodes' monitoring
         # measures
         self.job_0 = Job(self, 0, self.options)
@@ -37,20 +34,9 @@ class IpmipowerstatsBackend(InputBaseBackend):
 
 class IpmipowerStats(object):
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry):
         self.options = option
-
-    def get_running_jobs(self):
-        job_ids=[]
-        if os.path.exists("/dev/cpuset/oar"):
-            cwd = os.getcwd()
-            os.chdir("/dev/cpuset/oar")
-            for file in glob.glob("*_*"):
-                m = re.search('.*_(\d+)',file)
-                if m is not None:
-                    job_ids.append(int(m.group(1)))
-            os.chdir(cwd)
-        return job_ids
+        self.job_registry = job_registry
 
     def get_stats(self):
 
@@ -69,7 +55,7 @@ class IpmipowerStats(object):
         else:
             ipmipowerstats_data['average_power_consumption'] = -1
     
-        jobs=json.dumps(self.get_running_jobs())
+        jobs=self.job_registry.snapshot.involved_jobs
         ipmipowerstats_data['involved_jobs'] = jobs
 
         return IpmipowerstatsCounters(ipmipowerstats_buffer=ipmipowerstats_data)
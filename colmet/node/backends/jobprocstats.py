@@ -14,6 +14,9 @@ from colmet.common.job import Job
 
 LOG = logging.getLogger()
 
+# Size of the reads of the /proc/<pid> files
+PROC_READ_SIZE = 16384
+
 
 class JobprocstatsBackend(InputBaseBackend):
     __backend_name__ = "jobprocstats"
@@ -22,7 +25,7 @@ class JobprocstatsBackend(InputBaseBackend):
         self.jobs = {}
         self.filenames = {}
 
-        self.jobprocstats = jobprocStats(self.options)
+        self.jobprocstats = jobprocStats(self.options, self.job_registry)
         if len(self.job_id_list) < 1 \
                 and self.options.cpuset_rootpath == []:
             raise JobNeedToBeDefinedError()
@@ -58,31 +61,23 @@ class JobprocstatsBackend(InputBaseBackend):
 
     def update_job_list(self):
         """Used to maintained job list upto date by adding new jobs and
-        removing ones to monitor accordingly to cpuset_rootpath and
-        regex_job_id.
+        removing ones to monitor accordingly to the job registry of the node.
         """
-        cpuset_rootpath = self.options.cpuset_rootpath[0]
-        regex_job_id = self.options.regex_job_id[0]
-
-        job_ids = set([])
-        # self.filenames = {}
-        for filename in os.listdir(cpuset_rootpath):
-            jid = re.findall(regex_job_id, filename)
-            if len(jid) > 0:
-                job_ids.add(jid[0])
-                self.filenames[jid[0]] = filename
-
+        snapshot = self.job_registry.snapshot
+        job_ids = snapshot.job_ids
         monitored_job_ids = set(self.job_id_list)
+        ended_filenames = self.filenames
+        self.filenames = snapshot.filenames
 
         # Add new jobs
         for job_id in (job_ids - monitored_job_ids):
-            job_path = cpuset_rootpath + "/" + self.filenames[job_id]
+            job_path = snapshot.job_path(job_id)
             options = self.create_options_job_cgroups([job_path])
             self.jobs[job_id] = Job(self, int(job_id), options)
 
         # Del ended jobs
         for job_id in (monitored_job_ids - job_ids):
-            del self.filenames[job_id]
+            self.jobprocstats.close_job(ended_filenames[job_id])
             del self.jobs[job_id]
 
         # udpate job_id list to monitor
@@ -91,11 +86,38 @@ class JobprocstatsBackend(InputBaseBackend):
 
 class jobprocStats(object):
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry):
         self.options = option
+        self.job_registry = job_registry
         self.isInit = False
         self.jobprocvalues = None
-        
+        # job filename -> {pid: {filename: file descriptor}}, the /proc files
+        # are kept open while the pid is in the job
+        self.pid_fds = {}
+
+    def read_pid_file(self, pid_fds, pid, filename):
+        fds = pid_fds.setdefault(pid, {})
+        try:
+            if filename not in fds:
+                fds[filename] = os.open("/proc/%d/%s" % (pid, filename),
+                                        os.O_RDONLY)
+            return os.pread(fds[filename], PROC_READ_SIZE, 0).decode()
+        except OSError:
+            LOG.debug("jobprocstats: error reading /proc/%d/%s "
+                      "(pid disapeared?)", pid, filename)
+            self.close_pid(pid_fds, pid)
+            return ""
+
+    @staticmethod
+    def close_pid(pid_fds, pid):
+        for fd in pid_fds.pop(pid, {}).values():
+            os.close(fd)
+
+    def close_job(self, job_filename):
+        pid_fds = self.pid_fds.pop(job_filename, {})
+        for pid in list(pid_fds):
+            self.close_pid(pid_fds, pid)
+
     def get_stats(self, job_filename):
 
           jobprocstats_data={}
@@ -104,64 +126,37 @@ class jobprocStats(object):
               if name not in jobprocstats_data.keys():
                   jobprocstats_data[name]=0
 
-          # Get the list of pids
+          # Get the list of pids, the files of the ended ones are closed
           cpuset_rootpath = self.options.cpuset_rootpath[0]
-          f=cpuset_rootpath + "/" + job_filename + "/tasks"
-          try:
-              pids=list(open(f))
-          except:
-              LOG.warning("jobprocstats: error reading file %s (disapeared?)", f)
-              pids=[]
- 
+          pid_fds = self.pid_fds.setdefault(job_filename, {})
+          task_list = self.job_registry.get_tasks(
+              cpuset_rootpath + "/" + job_filename, tracked=pid_fds)
+          for pid in task_list.removed:
+              self.close_pid(pid_fds, pid)
+
           # Sum the metrics
-          for pid in pids:
-              pid=pid.strip('\n')
+          for pid in task_list.tids:
               # Iostats
-              f="/proc/"+pid+"/io"
-              contents=""
-              if os.path.isfile(f):
-                      try:
-                          iostats=open(f)
-                          contents = iostats.read()
-                      except:
-                          LOG.warning("jobprocstats: error reading file %s", f)
-                      else:
-                          iostats.close()
-
-                      for line in contents.splitlines():
-                          (key,val) = line.split(": ")
-                          if key in jobprocstats_data.keys():
-                              jobprocstats_data[key]+=int(val)
-                          else:
-                              jobprocstats_data[key]=int(val)
-              else:
-                  LOG.debug("jobprocstats: file %s does not exists (pid disapeared?)!",f) 
+              contents = self.read_pid_file(pid_fds, pid, "io")
+              for line in contents.splitlines():
+                  (key,val) = line.split(": ")
+                  if key in jobprocstats_data.keys():
+                      jobprocstats_data[key]+=int(val)
+                  else:
+                      jobprocstats_data[key]=int(val)
 
               # pid stats
-              f="/proc/"+pid+"/status"
-              contents=""
-              if os.path.isfile(f):
-                      try:
-                          status=open(f)
-                          contents = status.read()
-                      except:
-                          LOG.warning("jobprocstats: error reading file %s", f)
-                      else:
-                          status.close()
-
-                      for line in contents.splitlines():
-                          try:
-                              line=line.replace('kB','')
-                              line=line.replace('\t','')
-                              line=line.replace(' ','')
-                              (key,val) = re.split(":\t*",line)
-                          except:
-                              pass
-                          else:
-                              if key in jobprocstats_data.keys():
-                                  jobprocstats_data[key]+=int(val)
-              else:
-                  LOG.debug("jobprocstats: file %s does not exists (pid disapeared?)!",f) 
-
+              contents = self.read_pid_file(pid_fds, pid, "status")
+              for line in contents.splitlines():
+                  try:
+                      line=line.replace('kB','')
+                      line=line.replace('\t','')
+                      line=line.replace(' ','')
+                      (key,val) = re.split(":\t*",line)
+                  except:
+                      pass
+                  else:
+                      if key in jobprocstats_data.keys():
+                          jobprocstats_data[key]+=int(val)
 
           return JobprocstatsCounters(jobprocstats_buffer=jobprocstats_data)
@@ -1,6 +1,4 @@
-import os
 import re
-import json
 
 import glob
 
@@ -13,7 +11,7 @@ class LustrestatsBackend(InputBaseBackend):
     __backend_name__ = "lustrestats"
 
     def open(self):
-        self.lustrestats = LustreStats(self.options)
+        self.lustrestats = LustreStats(self.options, self.job_registry)
         # job with id equal to 0 is the fictive job to gather nodes' monitoring
         # measures
         self.job_0 = Job(self, 0, self.options)
@@ -51,20 +49,9 @@ class LustreStats(object):
     Fourth = sum of all the read/write requests in bytes, the quantity of data read/written.
     '''
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry):
         self.options = option
-
-    def get_running_jobs(self):                    
-        job_ids=[]                                 
-        if os.path.exists("/dev/cpuset/oar"):      
-            cwd = os.getcwd()                      
-            os.chdir("/dev/cpuset/oar")            
-            for file in glob.glob("*_*"):          
-                m = re.search('.*_(\d+)',file)     
-                if m is not None:                  
-                    job_ids.append(int(m.group(1)))
-            os.chdir(cwd)                          
-        return job_ids                             
+        self.job_registry = job_registry
 
     def get_stats(self):
 
@@ -90,7 +77,7 @@ class LustreStats(object):
                             'lustre_nb_write': lustre_nb_write, 'lustre_bytes_write': lustre_bytes_write
         }
          
-        jobs=json.dumps(self.get_running_jobs())
+        jobs=self.job_registry.snapshot.involved_jobs
         lustrestats_data['involved_jobs'] = jobs
                
         return LustrestatsCounters(lustrestats_buffer=lustrestats_data)
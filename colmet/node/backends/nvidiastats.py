@@ -1,12 +1,13 @@
 import os
-import re
 import copy
 import errno
 import struct
 import time
 import logging
-
-from subprocess import check_output, STDOUT, CalledProcessError
+import ctypes
+import threading
+import subprocess
+from collections import namedtuple
 
 from colmet.common.metrics.nvidiastats import NvidiastatsCounters
 from colmet.common.exceptions import (NoEnoughPrivilegeError,
@@ -24,7 +25,10 @@ class NvidiastatsBackend(InputBaseBackend):
         self.jobs = {}
         self.filenames = {}
 
-        self.nvidiastats = nvidiaStats(self.options)
+        # one sampler for all the jobs of the node
+        self.gpu_sampler = open_gpu_sampler(self.options)
+        self.nvidiastats = nvidiaStats(self.options, self.job_registry,
+                                       self.gpu_sampler)
         if len(self.job_id_list) < 1 \
                 and self.options.cpuset_rootpath == []:
             raise JobNeedToBeDefinedError()
@@ -36,13 +40,15 @@ class NvidiastatsBackend(InputBaseBackend):
                 self.jobs[job_id] = Job(self, job_id, self.options)
 
     def close(self):
-        pass
+        self.gpu_sampler.close()
 
     def get_nvidia_stats(self, job_id):
         if str(job_id) in self.filenames:
             return self.nvidiastats.get_stats(self.filenames[str(job_id)])
 
     def pull(self):
+        # the GPUs are sampled once per cycle, whatever the number of jobs
+        self.nvidiastats.gpus = self.gpu_sampler.sample()
         values=list(self.jobs.values())
         for job in values:
             job.update_stats()
@@ -60,95 +66,296 @@ class NvidiastatsBackend(InputBaseBackend):
 
     def update_job_list(self):
         """Used to maintained job list upto date by adding new jobs and
-        removing ones to monitor accordingly to cpuset_rootpath and
-        regex_job_id.
+        removing ones to monitor accordingly to the job registry of the node.
         """
-        cpuset_rootpath = self.options.cpuset_rootpath[0]
-        regex_job_id = self.options.regex_job_id[0]
-
-        job_ids = set([])
-        #self.filenames = {}
-        for filename in os.listdir(cpuset_rootpath):
-            jid = re.findall(regex_job_id, filename)
-            if len(jid) > 0:
-                job_ids.add(jid[0])
-                self.filenames[jid[0]] = filename
-
+        snapshot = self.job_registry.snapshot
+        job_ids = snapshot.job_ids
         monitored_job_ids = set(self.job_id_list)
+        self.filenames = snapshot.filenames
 
         # Add new jobs
         for job_id in (job_ids - monitored_job_ids):
-            job_path = cpuset_rootpath + "/" + self.filenames[job_id]
+            job_path = snapshot.job_path(job_id)
             options = self.create_options_job_cgroups([job_path])
             self.jobs[job_id] = Job(self, int(job_id), options)
 
         # Del ended jobs
         for job_id in (monitored_job_ids - job_ids):
-            del self.filenames[job_id]
             del self.jobs[job_id]
 
         # udpate job_id list to monitor
         self.job_id_list = list(job_ids)
 
 
+# GPU metrics, in the units of nvidia-smi (W, Celsius, %, MiB)
+GPU_COUNTER_NAMES = ["power", "temperature", "utilization-gpu",
+                     "utilization-memory", "memory-total", "memory-free",
+                     "memory-used"]
+
+# State of the GPUs of the node at a sampling:
+# - pid_gpus: pid -> set of the uuids of the GPUs used by the process
+# - gpu_metrics: uuid -> {counter name: value}
+GPUSnapshot = namedtuple('GPUSnapshot', ['pid_gpus', 'gpu_metrics'])
+
+
 class nvidiaStats(object):
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry, gpu_sampler):
         self.options = option
-        self.isInit = False
-        self.nvidiavalues = None
-        
+        self.job_registry = job_registry
+        self.gpus = gpu_sampler.sample()
+
     def get_stats(self, job_filename):
 
           nvidiastats_data={}
-          counter_names=["uuid","power","temperature","utilization-gpu","utilization-memory","memory-total","memory-free","memory-used"] 
-          for name in counter_names:                                                                               
-              if name not in nvidiastats_data.keys() and name != "uuid":
-                  nvidiastats_data[name]=0
+          for name in GPU_COUNTER_NAMES:
+              nvidiastats_data[name]=0
 
           # Get the list of pids
           cpuset_rootpath = self.options.cpuset_rootpath[0]
-          f=cpuset_rootpath + "/" + job_filename + "/tasks"
-          try:
-              pids=list(open(f))
-          except:
-              LOG.warning("nvidiastats: error reading file %s (disapeared?)", f)
-              pids=[]
-          
-          # Get the nvidia running processes
-          try:
-              processes = check_output(["/usr/bin/nvidia-smi", "--query-compute-apps=pid,gpu_uuid","--format=csv"])
-              processes = processes.decode("utf-8")
-          except CalledProcessError as e:
-              print("Error calling nvidia-smi --query-compute-apps: ", e.returncode)
-          gpu_pids={}
-          for line in processes.splitlines():
-              (p,i)=line.split(', ')
-              gpu_pids[p]=i
+          pids = self.job_registry.get_tasks(
+              cpuset_rootpath + "/" + job_filename).tids
 
           # Get the list of GPU devices used by the pids
           gpus=set()
           for pid in pids:
-              pid=pid.strip('\n')
-              if pid in gpu_pids.keys():
-                  gpus.add(gpu_pids[pid])
-
-          # Get the nvidia metrics
-          try:
-              nvmetrics = check_output(["/usr/bin/nvidia-smi", "--query-gpu=uuid,power.draw,temperature.gpu,utilization.gpu,utilization.memory,memory.total,memory.free,memory.used", "--format=csv"])
-              nvmetrics = nvmetrics.decode("utf-8")
-          except CalledProcessError as e:
-              print("Error calling nvidia-smi --query-gpu: ", e.returncode)
-          gpu_metrics={}
-          for line in nvmetrics.splitlines():
-              line=re.sub(' W| %| GiB| MiB| KiB','',line)
-              values=line.split(', ')
-              data=dict(zip(counter_names,values))
-              if data["uuid"] in gpus:
-                  for name in counter_names:
-                      if name == "temperature":
-                          nvidiastats_data[name]=int(float(data[name]))
-                      elif name != "uuid":
-                          nvidiastats_data[name]+=int(float(data[name]))
+              gpus.update(self.gpus.pid_gpus.get(pid, ()))
+
+          for uuid in gpus:
+              data = self.gpus.gpu_metrics.get(uuid)
+              if data is None:
+                  continue
+              for name in GPU_COUNTER_NAMES:
+                  if name == "temperature":
+                      nvidiastats_data[name]=data[name]
+                  else:
+                      nvidiastats_data[name]+=data[name]
 
           return NvidiastatsCounters(nvidiastats_buffer=nvidiastats_data)
+
+
+def open_gpu_sampler(options):
+    '''
+    Return the NVML sampler if the NVML library can be loaded, a sampler
+    reading long running nvidia-smi processes otherwise
+    '''
+    lib_path = os.getenv('LIB_NVML_PATH', "libnvidia-ml.so.1")
+    try:
+        return NvmlSampler(ctypes.cdll.LoadLibrary(lib_path))
+    except (OSError, AttributeError, NvmlError) as e:
+        LOG.info("nvidiastats: NVML is not available (%s), using %s"
+                 % (e, options.nvidia_smi))
+    return NvidiaSmiSampler(options.nvidia_smi,
+                            int(options.sampling_period * 1000))
+
+
+#
+# NVML
+#
+
+NVML_SUCCESS = 0
+NVML_ERROR_INSUFFICIENT_SIZE = 7
+NVML_TEMPERATURE_GPU = 0
+NVML_DEVICE_UUID_BUFFER_SIZE = 96
+
+
+class NvmlError(Exception):
+    pass
+
+
+class NvmlUtilization(ctypes.Structure):
+    _fields_ = [('gpu', ctypes.c_uint), ('memory', ctypes.c_uint)]
+
+
+class NvmlMemory(ctypes.Structure):
+    _fields_ = [('total', ctypes.c_ulonglong), ('free', ctypes.c_ulonglong),
+                ('used', ctypes.c_ulonglong)]
+
+
+class NvmlProcessInfo(ctypes.Structure):
+    # nvmlProcessInfo_t of nvmlDeviceGetComputeRunningProcesses_v2/_v3
+    _fields_ = [('pid', ctypes.c_uint), ('usedGpuMemory', ctypes.c_ulonglong),
+                ('gpuInstanceId', ctypes.c_uint),
+                ('computeInstanceId', ctypes.c_uint)]
+
+
+class NvmlProcessInfoV1(ctypes.Structure):
+    # nvmlProcessInfo_t of nvmlDeviceGetComputeRunningProcesses
+    _fields_ = [('pid', ctypes.c_uint), ('usedGpuMemory', ctypes.c_ulonglong)]
+
+
+class NvmlSampler(object):
+    '''
+    Sample the GPUs with the NVML library (the one nvidia-smi relies on),
+    without any process to spawn.
+    '''
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.check(lib.nvmlInit_v2())
+        count = ctypes.c_uint()
+        self.check(lib.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+        self.devices = []
+        for index in range(count.value):
+            handle = ctypes.c_void_p()
+            self.check(lib.nvmlDeviceGetHandleByIndex_v2(
+                index, ctypes.byref(handle)))
+            uuid = ctypes.create_string_buffer(NVML_DEVICE_UUID_BUFFER_SIZE)
+            self.check(lib.nvmlDeviceGetUUID(handle, uuid,
+                                             NVML_DEVICE_UUID_BUFFER_SIZE))
+            self.devices.append((uuid.value.decode(), handle))
+        for name, struct_type in [
+                ('nvmlDeviceGetComputeRunningProcesses_v3', NvmlProcessInfo),
+                ('nvmlDeviceGetComputeRunningProcesses_v2', NvmlProcessInfo),
+                ('nvmlDeviceGetComputeRunningProcesses', NvmlProcessInfoV1)]:
+            if hasattr(lib, name):
+                self.get_processes = getattr(lib, name)
+                self.process_info = struct_type
+                break
+        LOG.info("nvidiastats: %d GPUs sampled with NVML" % len(self.devices))
+
+    @staticmethod
+    def check(ret):
+        if ret != NVML_SUCCESS:
+            raise NvmlError("NVML error %d" % ret)
+
+    def close(self):
+        self.lib.nvmlShutdown()
+
+    def running_processes(self, handle):
+        count = ctypes.c_uint(0)
+        ret = self.get_processes(handle, ctypes.byref(count), None)
+        while ret == NVML_ERROR_INSUFFICIENT_SIZE:
+            # processes may start between the two calls
+            count = ctypes.c_uint(count.value + 8)
+            infos = (self.process_info * count.value)()
+            ret = self.get_processes(handle, ctypes.byref(count), infos)
+            if ret == NVML_SUCCESS:
+                return [infos[i].pid for i in range(count.value)]
+        self.check(ret)
+        return []
+
+    def sample(self):
+        pid_gpus = {}
+        gpu_metrics = {}
+        for uuid, handle in self.devices:
+            try:
+                for pid in self.running_processes(handle):
+                    pid_gpus.setdefault(pid, set()).add(uuid)
+                power = ctypes.c_uint()
+                temperature = ctypes.c_uint()
+                utilization = NvmlUtilization()
+                memory = NvmlMemory()
+                self.check(self.lib.nvmlDeviceGetPowerUsage(
+                    handle, ctypes.byref(power)))
+                self.check(self.lib.nvmlDeviceGetTemperature(
+                    handle, NVML_TEMPERATURE_GPU, ctypes.byref(temperature)))
+                self.check(self.lib.nvmlDeviceGetUtilizationRates(
+                    handle, ctypes.byref(utilization)))
+                self.check(self.lib.nvmlDeviceGetMemoryInfo(
+                    handle, ctypes.byref(memory)))
+            except NvmlError as e:
+                LOG.warning("nvidiastats: cannot sample the GPU %s: %s"
+                            % (uuid, e))
+                continue
+            gpu_metrics[uuid] = {
+                "power": power.value // 1000,
+                "temperature": temperature.value,
+                "utilization-gpu": utilization.gpu,
+                "utilization-memory": utilization.memory,
+                "memory-total": memory.total >> 20,
+                "memory-free": memory.free >> 20,
+                "memory-used": memory.used >> 20,
+            }
+        return GPUSnapshot(pid_gpus, gpu_metrics)
+
+
+#
+# nvidia-smi
+#
+
+NVIDIA_SMI_APPS_QUERY = "pid,gpu_uuid"
+NVIDIA_SMI_GPU_QUERY = ("uuid,power.draw,temperature.gpu,utilization.gpu,"
+                        "utilization.memory,memory.total,memory.free,"
+                        "memory.used")
+
+
+class NvidiaSmiLoop(object):
+    '''
+    A nvidia-smi process printing a query every `loop_ms` milliseconds. The
+    CSV header starts each report, the last complete one is kept.
+    '''
+
+    def __init__(self, nvidia_smi, query, loop_ms):
+        self.command = [nvidia_smi, query, "--format=csv,nounits",
+                        "--loop-ms=%d" % loop_ms]
+        self.lines = []
+        self.report = None
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        universal_newlines=True)
+        self.thread = threading.Thread(target=self.read_reports)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_reports(self):
+        header = None
+        for line in self.process.stdout:
+            line = line.strip()
+            if header is None:
+                header = line
+            if line == header:
+                if self.lines:
+                    self.report = self.lines
+                self.lines = []
+            elif line:
+                self.lines.append(line)
+        LOG.warning("nvidiastats: %s has exited" % " ".join(self.command))
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class NvidiaSmiSampler(object):
+    '''
+    Sample the GPUs with two nvidia-smi processes running in loop mode (one
+    per query, nvidia-smi cannot loop over both), started once.
+    '''
+
+    def __init__(self, nvidia_smi, loop_ms):
+        self.apps = NvidiaSmiLoop(nvidia_smi, "--query-compute-apps=" +
+                                  NVIDIA_SMI_APPS_QUERY, loop_ms)
+        self.gpus = NvidiaSmiLoop(nvidia_smi, "--query-gpu=" +
+                                  NVIDIA_SMI_GPU_QUERY, loop_ms)
+
+    def close(self):
+        self.apps.close()
+        self.gpus.close()
+
+    def sample(self):
+        pid_gpus = {}
+        for line in self.apps.report or []:
+            try:
+                (pid, uuid) = line.split(', ')
+                pid_gpus.setdefault(int(pid), set()).add(uuid)
+            except ValueError:
+                pass
+        gpu_metrics = {}
+        for line in self.gpus.report or []:
+            values = line.split(', ')
+            gpu_metrics[values[0]] = dict(
+                (name, smi_value(value))
+                for name, value in zip(GPU_COUNTER_NAMES, values[1:]))
+        return GPUSnapshot(pid_gpus, gpu_metrics)
+
+
+def smi_value(value):
+    '''
+    Return the integer value of a nvidia-smi field, -1 for the [N/A] and
+    [Not Supported] ones
+    '''
+    try:
+        return int(float(value))
+    except ValueError:
+        return -1
@@ -1,5 +1,4 @@
 import os
-import re
 import errno
 import struct
 import time
@@ -66,35 +65,26 @@ class PerfhwstatsBackend(InputBaseBackend):
 
     def update_job_list(self):
         """Used to maintained job list upto date by adding new jobs and
-        removing ones to monitor accordingly to cpuset_rootpath and
-        regex_job_id.
+        removing ones to monitor accordingly to the job registry of the node.
         """
-        cpuset_rootpath = self.options.cpuset_rootpath[0]
-        regex_job_id = self.options.regex_job_id[0]
-
-        job_ids = set([])
-        # self.filenames = {}
-        for filename in os.listdir(cpuset_rootpath):
-            jid = re.findall(regex_job_id, filename)
-            if len(jid) > 0:
-                job_ids.add(jid[0])
-                self.filenames[jid[0]] = filename
-
+        snapshot = self.job_registry.snapshot
+        job_ids = snapshot.job_ids
         monitored_job_ids = set(self.job_id_list)
+        ended_filenames = self.filenames
+        self.filenames = snapshot.filenames
         # Add new jobs
         for job_id in (job_ids - monitored_job_ids):
-            job_path = cpuset_rootpath + "/" + self.filenames[job_id]
+            job_path = snapshot.job_path(job_id)
             options = self.create_options_job_cgroups([job_path])
             self.jobs[job_id] = Job(self, int(job_id), options)
         # Del ended jobs
 
         for job_id in (monitored_job_ids - job_ids):
             global perfhwlib
-            job_name = self.filenames[job_id]
+            job_name = ended_filenames[job_id]
             job_name_buffer = ctypes.create_string_buffer(b"/oar/" + bytes(job_name, 'utf-8'))
             job_id_p = ctypes.c_char_p(ctypes.addressof(job_name_buffer))
             perfhwlib.remove_cgroup(job_id_p)
-            del self.filenames[job_id]
             del self.jobs[job_id]
         # udpate job_id list to monitor
         self.job_id_list = list(job_ids)
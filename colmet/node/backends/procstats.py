@@ -1,7 +1,5 @@
 import os
 import re
-import json
-import glob
 
 from colmet.common.backends.base import InputBaseBackend
 from colmet.common.job import Job
@@ -12,7 +10,7 @@ class ProcstatsBackend(InputBaseBackend):
     __backend_name__ = "procstats"
 
     def open(self):
-        self.procstats = ProcStats(self.options)
+        self.procstats = ProcStats(self.options, self.job_registry)
         # job with id equal to 0 is the fictive job to gather nodes' monitoring
         # measures
         self.job_0 = Job(self, 0, self.options)
@@ -53,8 +51,9 @@ NUMADIR = "/sys/devices/system/node"
 
 class ProcStats(object):
 
-    def __init__(self, option):
+    def __init__(self, option, job_registry):
         self.options = option
+        self.job_registry = job_registry
 
         self.f_uptime = open("/proc/uptime", "r")
         self.f_meminfo = open("/proc/meminfo", "r")
@@ -85,18 +84,6 @@ class ProcStats(object):
                 raise
         return numastats
 
-    def get_running_jobs(self):
-        job_ids=[]
-        if os.path.exists("/dev/cpuset/oar"):
-            cwd = os.getcwd()
-            os.chdir("/dev/cpuset/oar")
-            for file in glob.glob("*_*"):
-                m = re.search('.*_(\d+)',file)
-                if m is not None:
-                    job_ids.append(int(m.group(1)))
-            os.chdir(cwd)
-        return job_ids
-
     def get_stats(self):
         # proc.uptime
         procstats_data = {}
@@ -165,7 +152,7 @@ class ProcStats(object):
             procstats_data['loadavg_runnable'] = float(m.group(4))
             procstats_data['loadavg_total_threads'] = float(m.group(5))
 
-        jobs=json.dumps(self.get_running_jobs())
+        jobs=self.job_registry.snapshot.involved_jobs
         procstats_data['involved_jobs'] = jobs
 
         return ProcstatsCounters(procstats_buffer=procstats_data)
@@ -1,11 +1,16 @@
 import os
-import re
 import errno
+import asyncore
+import socket
 import struct
 import copy
 import logging
 
+import numpy as np
+from numpy.lib import recfunctions
+
 from colmet.common.metrics.taskstats import TaskstatsCounters
+from colmet.common.metrics.base import compact_counters_class
 from colmet.common.exceptions import (NoEnoughPrivilegeError,
                                       JobNeedToBeDefinedError)
 from colmet.common.backends.base import InputBaseBackend
@@ -13,6 +18,10 @@ from colmet.common.job import Job
 
 LOG = logging.getLogger()
 
+# The counters kept for every thread of the jobs (total, delta and the
+# last fetch) are compact ones
+CompactTaskstatsCounters = compact_counters_class(TaskstatsCounters)
+
 
 class TaskstatsBackend(InputBaseBackend):
 
@@ -20,8 +29,19 @@ class TaskstatsBackend(InputBaseBackend):
 
     def open(self):
         self.jobs = {}
+        # tid -> CGroupInfo, used to account the exited tasks to their job
+        self.task_index = None
+        self.exit_listener = None
 
         self.taskstats_nl = TaskStatsNetlink(self.options)
+        if getattr(self.options, 'taskstats_per_process', False):
+            LOG.warning("taskstats: coremem and virtmem are not available "
+                        "per process, they are zero")
+        if getattr(self.options, 'taskstats_exit_events', False):
+            self.task_index = {}
+            self.exit_listener = TaskStatsExitListener(
+                self.options, self.account_task_exit,
+                lambda tid: tid in self.task_index)
 
         if len(self.job_id_list) < 1 \
                 and self.options.cpuset_rootpath == []:
@@ -34,15 +54,35 @@ class TaskstatsBackend(InputBaseBackend):
                 self.jobs[job_id] = Job(self, job_id, self.options)
 
     def close(self):
-        pass
+        if self.exit_listener is not None:
+            self.exit_listener.close()
+
+    def account_task_exit(self, tid, ppid, counters):
+        '''
+        Called for each exited task: its final stats are accounted to the
+        job of the task, or to the job of its parent if the task has
+        started and exited between two samples.
+        '''
+        owner = self.task_index.get(tid)
+        if owner is None:
+            owner = self.task_index.get(ppid)
+        if owner is not None:
+            owner.account_exit(tid, counters)
 
-    def build_request(self, pid):
-        return self.taskstats_nl.build_request(pid)
+    def build_request(self, pid, tgid=False):
+        return self.taskstats_nl.build_request(pid, tgid)
 
     def get_task_stats(self, request):
         counters = self.taskstats_nl.get_single_task_stats(request)
         return counters
 
+    def get_tasks_payloads(self, requests):
+        return self.taskstats_nl.get_tasks_stats(requests,
+                                                 decode=taskstats_payload)
+
+    def create_task_columns(self, tgid=False):
+        return TaskstatsColumns(self, tgid)
+
     def pull(self):
         values=list(self.jobs.values())
         for job in values:
@@ -51,7 +91,7 @@ class TaskstatsBackend(InputBaseBackend):
         return [job.get_stats() for job in values]
 
     def get_counters_class(self):
-        return TaskstatsCounters
+        return CompactTaskstatsCounters
 
     def create_options_job_cgroups(self, cgroups):
         # options are duplicated to allow modification per jobs, here
@@ -62,30 +102,24 @@ class TaskstatsBackend(InputBaseBackend):
 
     def update_job_list(self):
         """Used to maintained job list upto date by adding new jobs and
-        removing ones to monitor accordingly to cpuset_rootpath and
-        regex_job_id.
+        removing ones to monitor accordingly to the job registry of the node.
         """
-        cpuset_rootpath = self.options.cpuset_rootpath[0]
-        regex_job_id = self.options.regex_job_id[0]
-
-        job_ids = set([])
-        filenames = {}
-        for filename in os.listdir(cpuset_rootpath):
-            jid = re.findall(regex_job_id, filename)
-            if len(jid) > 0:
-                job_ids.add(jid[0])
-                filenames[jid[0]] = filename
-
+        snapshot = self.job_registry.snapshot
+        job_ids = snapshot.job_ids
         monitored_job_ids = set(self.job_id_list)
         # Add new jobs
         for job_id in (job_ids - monitored_job_ids):
-            job_path = cpuset_rootpath + "/" + filenames[job_id]
+            job_path = snapshot.job_path(job_id)
             options = self.create_options_job_cgroups([job_path])
             self.jobs[job_id] = Job(self, int(job_id), options)
         # Del ended jobs
 
         for job_id in (monitored_job_ids - job_ids):
-            del self.jobs[job_id]
+            job = self.jobs.pop(job_id)
+            # the tids of the ended job may be reused by other jobs
+            for child in job.get_children():
+                if hasattr(child, 'release_tasks'):
+                    child.release_tasks()
         # udpate job_id list to monitor
         self.job_id_list = list(job_ids)
 
@@ -94,13 +128,14 @@ class TaskstatsBackend(InputBaseBackend):
 #
 
 from .genetlink.netlink import Connection, NETLINK_GENERIC, U32Attr, \
-    NLM_F_REQUEST
+    NulStrAttr, NLM_F_REQUEST
 from .genetlink.genetlink import Controller, GeNlMessage
 
 TASKSTATS_CMD_GET = 1
 
 TASKSTATS_CMD_ATTR_PID = 1
 TASKSTATS_CMD_ATTR_TGID = 2
+TASKSTATS_CMD_ATTR_REGISTER_CPUMASK = 3
 
 TASKSTATS_TYPE_PID = 1
 TASKSTATS_TYPE_TGID = 2
@@ -108,19 +143,38 @@ TASKSTATS_TYPE_STATS = 3
 TASKSTATS_TYPE_AGGR_PID = 4
 TASKSTATS_TYPE_AGGR_TGID = 5
 
+# Maximum number of requests in flight when querying a batch of tasks. The
+# replies must fit in the socket receive buffer (SO_RCVBUF is 64KB) or the
+# kernel drops them.
+TASKSTATS_BATCH_WINDOW = 32
+# Seconds to wait for a reply before considering the outstanding ones lost
+TASKSTATS_REPLY_TIMEOUT = 1.0
+# Receive buffer of the exit notifications socket
+TASKSTATS_EXIT_RCVBUF = 4 * 1024 * 1024
+
 
 class TaskStatsNetlink(object):
     # Keep in sync with format_stats() and pinfo.did_some_io()
 
-    def __init__(self, options):
+    def __init__(self, options, connection=None):
         self.options = options
-        self.connection = Connection(NETLINK_GENERIC)
+        self.batch_window = getattr(options, 'taskstats_batch_window',
+                                    TASKSTATS_BATCH_WINDOW)
+        if connection is None:
+            connection = Connection(NETLINK_GENERIC)
+        self.connection = connection
         controller = Controller(self.connection)
         self.family_id = controller.get_family_id('TASKSTATS')
 
-    def build_request(self, tid):
+    def build_request(self, tid, tgid=False):
+        '''
+        Build the request for the task `tid`, or for the whole thread group
+        `tid` if `tgid` is True. In the later case, the kernel aggregates the
+        stats of all the threads of the process, including the exited ones.
+        '''
+        attr = TASKSTATS_CMD_ATTR_TGID if tgid else TASKSTATS_CMD_ATTR_PID
         return GeNlMessage(self.family_id, cmd=TASKSTATS_CMD_GET,
-                           attrs=[U32Attr(TASKSTATS_CMD_ATTR_PID, tid)],
+                           attrs=[U32Attr(attr, tid)],
                            flags=NLM_F_REQUEST)
 
     def get_single_task_stats(self, request):
@@ -134,8 +188,61 @@ class TaskStatsNetlink(object):
             if e.errno == errno.EPERM:
                 raise NoEnoughPrivilegeError
             raise
+        return self.parse_reply(reply)
+
+    def get_tasks_stats(self, requests, decode=None):
+        '''
+        Pipelined version of get_single_task_stats. The requests are sent
+        back to back (at most `batch_window` of them in flight) and the
+        replies are matched to the requests by netlink sequence number.
+
+        Return a list of counters (or of what `decode` returns for the
+        `struct taskstats` buffers) in the same order as `requests`, with None
+        for the tasks which no more exist or whose reply was lost.
+        '''
+        results = [None] * len(requests)
+        pending = {}
+        window = max(1, self.batch_window)
+        descriptor = self.connection.descriptor
+        timeout = descriptor.gettimeout()
+        descriptor.settimeout(TASKSTATS_REPLY_TIMEOUT)
+        try:
+            index = 0
+            while index < len(requests) or pending:
+                while index < len(requests) and len(pending) < window:
+                    request = requests[index]
+                    request.seq = self.connection.seq()
+                    request.send(self.connection)
+                    pending[request.seq] = index
+                    index += 1
+                try:
+                    reply = GeNlMessage.recv(self.connection)
+                except OSError as e:
+                    if e.errno == errno.EPERM:
+                        raise NoEnoughPrivilegeError
+                    if e.errno == errno.ESRCH:
+                        # OSError: Netlink error: No such process (3)
+                        pending.pop(getattr(e, 'seq', None), None)
+                        continue
+                    if isinstance(e, socket.timeout) \
+                            or e.errno == errno.ENOBUFS:
+                        LOG.debug("taskstats: %s replies lost (%s)"
+                                  % (len(pending), e))
+                        pending.clear()
+                        continue
+                    raise
+                # replies of a previous batch which timed out are ignored
+                position = pending.pop(reply.seq, None)
+                if position is not None:
+                    results[position] = self.parse_reply(reply, decode)
+        finally:
+            descriptor.settimeout(timeout)
+        return results
+
+    def parse_reply(self, reply, decode=None):
         for attr_type, attr_value in reply.attrs.items():
-            if attr_type == TASKSTATS_TYPE_AGGR_PID:
+            if attr_type in (TASKSTATS_TYPE_AGGR_PID,
+                             TASKSTATS_TYPE_AGGR_TGID):
                 reply = attr_value.nested()
                 break
             # elif attr_type == TASKSTATS_TYPE_PID:
@@ -143,9 +250,346 @@ class TaskStatsNetlink(object):
         else:
             return
         taskstats_data = reply[TASKSTATS_TYPE_STATS].data
-        if len(taskstats_data) < 272:
-            # Short reply
+        if attr_type == TASKSTATS_TYPE_AGGR_TGID:
+            taskstats_data = fill_thread_group_stats(
+                taskstats_data, reply[TASKSTATS_TYPE_TGID].u32())
+            if taskstats_data is None:
+                # the process has exited meanwhile
+                return
+        return (decode or decode_taskstats)(taskstats_data)
+
+
+def decode_taskstats(taskstats_data):
+    '''
+    Return the counters corresponding to a `struct taskstats` buffer
+    '''
+    if len(taskstats_data) < 272:
+        # Short reply
+        return
+    taskstats_version = struct.unpack('H', taskstats_data[:2])[0]
+    assert taskstats_version >= 4
+    return CompactTaskstatsCounters(taskstats_buffer=taskstats_data)
+
+
+def taskstats_payload(taskstats_data):
+    '''
+    Return the `struct taskstats` buffer, of the size of TASKSTATS_DTYPE
+    '''
+    if len(taskstats_data) < 272:
+        # Short reply
+        return
+    return bytes(taskstats_data[:TASKSTATS_DTYPE.itemsize]).ljust(
+        TASKSTATS_DTYPE.itemsize, b"\0")
+
+
+#
+# Thread groups
+#
+
+# Clock ticks per second of the times of /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# /proc/<pid>/io field -> counter
+PROC_IO_COUNTERS = {
+    'rchar': 'read_char',
+    'wchar': 'write_char',
+    'syscr': 'read_syscalls',
+    'syscw': 'write_syscalls',
+    'read_bytes': 'read_bytes',
+    'write_bytes': 'write_bytes',
+    'cancelled_write_bytes': 'cancelled_write_bytes',
+}
+
+_boot_time = None
+
+
+def get_boot_time():
+    '''
+    Return the boot time of the node, in seconds since 1970
+    '''
+    global _boot_time
+    if _boot_time is None:
+        with open('/proc/stat', 'r') as f_stat:
+            for line in f_stat:
+                if line.startswith('btime '):
+                    _boot_time = int(line.split()[1])
+                    break
+            else:
+                _boot_time = 0
+    return _boot_time
+
+
+def read_thread_group_stats(tgid):
+    '''
+    Return the counters of the process tgid (all its threads, including the
+    exited ones) the kernel does not fill in the thread group replies: the
+    CPU times, page faults and begin time from /proc/<tgid>/stat, the I/O
+    from /proc/<tgid>/io. Return None if the process no more exists.
+    '''
+    try:
+        with open('/proc/%d/stat' % tgid, 'r') as f_stat:
+            stat = f_stat.read()
+    except (OSError, IOError):
+        return
+    # the fields following the command name, from the state (3rd field)
+    fields = stat[stat.rindex(')') + 2:].split()
+    utime = int(fields[11]) * 1000000 // CLOCK_TICKS
+    stime = int(fields[12]) * 1000000 // CLOCK_TICKS
+    counters = {
+        'ac_minflt': int(fields[7]),
+        'ac_majflt': int(fields[9]),
+        'ac_utime': utime,
+        'ac_stime': stime,
+        # the times are not scaled on the architectures colmet runs on
+        'ac_utimescaled': utime,
+        'ac_stimescaled': stime,
+        'ac_btime': get_boot_time() + int(fields[19]) // CLOCK_TICKS,
+    }
+    try:
+        with open('/proc/%d/io' % tgid, 'r') as f_io:
+            for line in f_io:
+                (key, _, value) = line.partition(':')
+                name = PROC_IO_COUNTERS.get(key)
+                if name is not None:
+                    counters[name] = int(value)
+    except (OSError, IOError):
+        # reading the I/O of a process needs the ptrace rights on it
+        LOG.debug("taskstats: no I/O counters for the process %s" % tgid)
+    return counters
+
+
+def fill_thread_group_stats(taskstats_data, tgid):
+    '''
+    Return the `struct taskstats` buffer of the thread group tgid with the
+    counters the kernel leaves to zero (see fill_stats_for_tgid) read from
+    /proc, or None if the process no more exists. coremem and virtmem have
+    no equivalent in /proc and stay zero.
+    '''
+    counters = read_thread_group_stats(tgid)
+    if counters is None:
+        return
+    taskstats_data = bytearray(taskstats_data)
+    for (name, value) in counters.items():
+        (c_offset, c_type, _, _, _) = TaskstatsCounters.counters_taskstats[name]
+        if c_offset + c_type.length <= len(taskstats_data):
+            struct.pack_into(c_type.struct_code, taskstats_data, c_offset,
+                             value)
+    return bytes(taskstats_data)
+
+
+#
+# Columnar taskstats
+#
+
+# Counters of the columns, in the order of the counters class
+TASKSTATS_COLUMNS = TaskstatsCounters._fmt_counter_ordered_keys
+
+
+def get_taskstats_dtype():
+    '''
+    Return the numpy dtype of the counters of a `struct taskstats` buffer
+    '''
+    formats = []
+    offsets = []
+    size = 0
+    for name in TASKSTATS_COLUMNS:
+        (c_offset, c_type, _, _, _) = TaskstatsCounters.counters_taskstats[name]
+        formats.append(np.dtype(c_type.struct_code))
+        offsets.append(c_offset)
+        size = max(size, c_offset + c_type.length)
+    return np.dtype({'names': TASKSTATS_COLUMNS, 'formats': formats,
+                     'offsets': offsets, 'itemsize': size})
+
+
+TASKSTATS_DTYPE = get_taskstats_dtype()
+
+# Columns of each accumulation function
+TASKSTATS_ACCUMULATIONS = dict(
+    (acc_fn, np.array([index for (index, name) in enumerate(TASKSTATS_COLUMNS)
+                       if TaskstatsCounters._counter_definitions[name][2]
+                       == acc_fn], dtype=np.intp))
+    for acc_fn in ['add', 'min', 'max', 'none'])
+
+
+class TaskstatsColumns(object):
+    '''
+    Taskstats of the tasks of a cgroup kept as a matrix (one row per task,
+    one column per counter) rather than as counters objects per task. The
+    replies of a cgroup are decoded at once, the deltas are computed against
+    the previous matrix by tid and the cgroup delta is reduced with numpy.
+
+    The first sample of a task accounts everything it has consumed since
+    it started, unless it is a baseline: the tasks which have run before
+    colmet started would make a spike of their whole lifetime.
+    '''
+
+    def __init__(self, input_backend, tgid=False):
+        self.input_backend = input_backend
+        self.tgid = tgid
+        self.requests = {}
+        # sorted tids and their last counters
+        self.tids = np.empty(0, dtype=np.int64)
+        self.totals = np.empty((0, len(TASKSTATS_COLUMNS)), dtype=np.int64)
+        # (tid, counters of the last sample) of the tracked tasks which have
+        # not answered the last update
+        self.lost = []
+
+    def get_request(self, tid):
+        request = self.requests.get(tid)
+        if request is None:
+            request = self.requests[tid] = \
+                self.input_backend.build_request(tid, self.tgid)
+        return request
+
+    def make_counters(self, row):
+        counters = self.input_backend.get_counters_class()()
+        counters._counter_values = dict(zip(TASKSTATS_COLUMNS, row.tolist()))
+        return counters
+
+    def update(self, tids, baseline=False):
+        '''
+        Fetch the tasks tids, return the counters of the sum of their deltas
+        since the last update, or None if no task has answered. With
+        baseline, the new tasks are only recorded, with nothing consumed.
+        '''
+        requests = [self.get_request(tid) for tid in tids]
+        payloads = self.input_backend.get_tasks_payloads(requests)
+        alive = [(tid, payload) for (tid, payload) in zip(tids, payloads)
+                 if payload is not None]
+        for tid in set(self.requests).difference(tid for (tid, _) in alive):
+            del self.requests[tid]
+        current_tids = np.array([tid for (tid, _) in alive], dtype=np.int64)
+        lost = ~np.isin(self.tids, current_tids)
+        self.lost = [(tid, self.make_counters(row)) for (tid, row)
+                     in zip(self.tids[lost].tolist(), self.totals[lost])]
+        if not alive:
+            self.tids = self.tids[:0]
+            self.totals = self.totals[:0]
+            return
+
+        records = np.frombuffer(b"".join(payload for (_, payload) in alive),
+                                dtype=TASKSTATS_DTYPE)
+        current = recfunctions.structured_to_unstructured(records,
+                                                          dtype=np.int64)
+        order = np.argsort(current_tids)
+        current_tids = current_tids[order]
+        current = current[order]
+
+        # the previous counters of the new tasks are their current ones,
+        # with nothing consumed yet unless they are a baseline
+        add = TASKSTATS_ACCUMULATIONS['add']
+        previous = current.copy()
+        if not baseline:
+            previous[:, add] = 0
+        if len(self.tids) > 0:
+            positions = np.searchsorted(self.tids, current_tids)
+            positions = np.minimum(positions, len(self.tids) - 1)
+            known = self.tids[positions] == current_tids
+            previous[known] = self.totals[positions[known]]
+
+        delta = current.copy()
+        delta[:, add] -= previous[:, add]
+        for (acc_fn, reduce_fn) in [('min', np.minimum), ('max', np.maximum)]:
+            columns = TASKSTATS_ACCUMULATIONS[acc_fn]
+            delta[:, columns] = reduce_fn(current[:, columns],
+                                          previous[:, columns])
+
+        row = delta[0].copy()
+        row[add] = delta[:, add].sum(axis=0)
+        for (acc_fn, reduce_fn) in [('min', np.min), ('max', np.max)]:
+            columns = TASKSTATS_ACCUMULATIONS[acc_fn]
+            row[columns] = reduce_fn(delta[:, columns], axis=0)
+
+        self.tids = current_tids
+        self.totals = current
+        return self.make_counters(row)
+
+    def forget(self, tid):
+        '''
+        Stop tracking the task tid, return the counters of its last sample
+        or None if it was not tracked
+        '''
+        self.requests.pop(tid, None)
+        position = np.searchsorted(self.tids, tid)
+        if position >= len(self.tids) or self.tids[position] != tid:
+            return
+        totals = self.totals[position]
+        self.tids = np.delete(self.tids, position)
+        self.totals = np.delete(self.totals, position, axis=0)
+        return self.make_counters(totals)
+
+
+class TaskStatsExitListener(asyncore.dispatcher):
+    '''
+    Receive the final stats the kernel sends when a task exits on any cpu
+    and hand them over to `callback(tid, ppid, counters)`. It is driven by
+    the asyncore loop of the node (the one watching the cpuset directory).
+
+    In per-process mode, only the thread group notifications are forwarded,
+    along with the ones of the tracked single-threaded processes.
+    '''
+
+    def __init__(self, options, callback, is_tracked):
+        self.options = options
+        self.callback = callback
+        self.is_tracked = is_tracked
+        self.per_process = getattr(options, 'taskstats_per_process', False)
+        self.connection = Connection(NETLINK_GENERIC)
+        # bursts of exits must not overflow the socket buffer
+        self.connection.descriptor.setsockopt(socket.SOL_SOCKET,
+                                              socket.SO_RCVBUF,
+                                              TASKSTATS_EXIT_RCVBUF)
+        controller = Controller(self.connection)
+        self.family_id = controller.get_family_id('TASKSTATS')
+        cpumask = "0-%d" % (os.cpu_count() - 1)
+        request = GeNlMessage(self.family_id, cmd=TASKSTATS_CMD_GET,
+                              attrs=[NulStrAttr(
+                                  TASKSTATS_CMD_ATTR_REGISTER_CPUMASK,
+                                  cpumask)],
+                              flags=NLM_F_REQUEST)
+        request.send(self.connection)
+        asyncore.dispatcher.__init__(self, sock=self.connection.descriptor)
+        LOG.info("Listening to the taskstats exit notifications of cpus %s"
+                 % cpumask)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        while True:
+            try:
+                message = GeNlMessage.recv(self.connection)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    LOG.warning("taskstats: exit notifications have been "
+                                "lost, the socket buffer is full")
+                    continue
+                raise
+            self.handle_exit(message)
+
+    def handle_exit(self, message):
+        aggregates = dict((attr_type, attr_value.nested())
+                          for attr_type, attr_value in message.attrs.items()
+                          if attr_type in (TASKSTATS_TYPE_AGGR_PID,
+                                           TASKSTATS_TYPE_AGGR_TGID))
+        if self.per_process and TASKSTATS_TYPE_AGGR_TGID in aggregates:
+            attrs = aggregates[TASKSTATS_TYPE_AGGR_TGID]
+            tid = attrs[TASKSTATS_TYPE_TGID].u32()
+        elif TASKSTATS_TYPE_AGGR_PID in aggregates:
+            attrs = aggregates[TASKSTATS_TYPE_AGGR_PID]
+            tid = attrs[TASKSTATS_TYPE_PID].u32()
+            if self.per_process and not self.is_tracked(tid):
+                # a thread of a process whose group stats will come later
+                return
+        else:
             return
-        taskstats_version = struct.unpack('H', taskstats_data[:2])[0]
-        assert taskstats_version >= 4
-        return TaskstatsCounters(taskstats_buffer=taskstats_data)
+        taskstats_data = attrs[TASKSTATS_TYPE_STATS].data
+        counters = decode_taskstats(taskstats_data)
+        if counters is not None:
+            ppid = struct.unpack_from('I', taskstats_data, 132)[0]
+            self.callback(tid, ppid, counters)
+
+    def handle_close(self):
+        self.close()
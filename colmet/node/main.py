@@ -9,22 +9,50 @@ import sys
 import time
 
 from colmet import VERSION
-from colmet.node.backends.infinibandstats import InfinibandstatsBackend
-from colmet.node.backends.lustrestats import LustrestatsBackend
-from colmet.node.backends.RAPLstats import RAPLstatsBackend
-from colmet.node.backends.temperaturestats import TemperaturestatsBackend
-from colmet.node.backends.procstats import ProcstatsBackend
-from colmet.node.backends.jobprocstats import JobprocstatsBackend
-from colmet.node.backends.taskstats import TaskstatsBackend
-from colmet.node.backends.perfhwstats import PerfhwstatsBackend
-from colmet.node.backends.ipmipowerstats import IpmipowerstatsBackend
-from colmet.node.backends.nvidiastats import NvidiastatsBackend
-from colmet.common.backends.zeromq import ZMQOutputBackend
+from colmet.node.backends import get_input_backend_class
+from colmet.node.registry import JobRegistry
+from colmet.node.scheduler import (BackendScheduler, OVERRUN_POLICIES,
+                                   backend_period)
+from colmet.common.metrics.base import (WIRE_FORMATS,
+                                        DEFAULT_KEYFRAME_INTERVAL,
+                                        subset_counters_class)
+from colmet.common.compression import CODECS
 from colmet.common.utils import AsyncFileNotifier, as_thread
-from colmet.common.exceptions import Error, NoneValueError
+from colmet.common.exceptions import (Error, NoneValueError,
+                                     CountersSubsetError)
 
 LOG = logging.getLogger()
 
+# Backends returning one list of counters per job
+PER_JOB_BACKENDS = ['taskstats', 'jobprocstats', 'nvidiastats', 'cgroupstats',
+                    'perfhwstats']
+
+# What to do with the counters having missing values
+INVALID_COUNTERS_POLICIES = ['drop', 'zero-fill']
+
+
+def invalid_counters_policy(value):
+    '''
+    Parse a backend:policy value of --invalid-counters
+    '''
+    name, _, policy = value.rpartition(':')
+    if not name or policy not in INVALID_COUNTERS_POLICIES:
+        raise ValueError("expected backend:%s"
+                         % "|".join(INVALID_COUNTERS_POLICIES))
+    return name, policy
+
+
+def counters_subset(value):
+    '''
+    Parse a backend:counter,counter... value of --counters
+    '''
+    name, _, counters = value.partition(':')
+    names = [counter for counter in counters.split(',') if counter]
+    if not name or not names:
+        raise ValueError("expected backend:counter[,counter...]")
+    return name, names
+
+
 class Task(object):
 
     def __init__(self, name, options):
@@ -33,34 +61,88 @@ class Task(object):
             options.cpuset_rootpath=["/dev/oar_cgroups_links/cpuset/oar/"]
         self.options = options
         self.input_backends = []
-        self.taskstats_backend = TaskstatsBackend(self.options)
-        self.input_backends.append(self.taskstats_backend)
+        self.taskstats_backend = self.create_backend('taskstats')
         if not self.options.disable_procstats:
-            self.input_backends.append(ProcstatsBackend(self.options))
+            self.create_backend('procstats')
         if self.options.enable_infinibandstats:
-            self.input_backends.append(InfinibandstatsBackend(self.options))
+            self.create_backend('infinibandstats')
         if self.options.enable_lustrestats:
-            self.input_backends.append(LustrestatsBackend(self.options))
+            self.create_backend('lustrestats')
         if self.options.enable_perfhw:
-            self.perfhwstats_back = PerfhwstatsBackend(self.options)
-            self.input_backends.append(self.perfhwstats_back)
+            self.perfhwstats_back = self.create_backend('perfhwstats')
         if self.options.enable_RAPLstats:
-            self.RAPLstatsBackend = RAPLstatsBackend(self.options)
-            self.input_backends.append(self.RAPLstatsBackend)
+            self.RAPLstatsBackend = self.create_backend('RAPLstats')
         if self.options.enable_temperaturestats:
-            self.temperaturestatsBackend = TemperaturestatsBackend(self.options)
-            self.input_backends.append(self.temperaturestatsBackend)
+            self.temperaturestatsBackend = \
+                self.create_backend('temperaturestats')
         if self.options.enable_jobproc:
-            self.jobprocstats_back = JobprocstatsBackend(self.options)
-            self.input_backends.append(self.jobprocstats_back)
+            self.jobprocstats_back = self.create_backend('jobprocstats')
         if self.options.enable_ipmipowerstats:
-            self.input_backends.append(IpmipowerstatsBackend(self.options))
+            self.create_backend('ipmipowerstats')
         if self.options.enable_nvidia:
-            self.nvidiastats_back = NvidiastatsBackend(self.options)
-            self.input_backends.append(self.nvidiastats_back)
+            self.nvidiastats_back = self.create_backend('nvidiastats')
+        if self.options.enable_cgroupstats:
+            self.cgroupstats_back = self.create_backend('cgroupstats')
+        # backends of other packages (entry points)
+        self.extra_backends = [self.create_backend(name)
+                               for name in self.options.enable_backends]
+
+        self.job_registry = JobRegistry(self.options)
+        for backend in self.input_backends:
+            backend.job_registry = self.job_registry
 
+        from colmet.common.backends.zeromq import ZMQOutputBackend
         self.zeromq_output_backend = ZMQOutputBackend(self.options)
-
+        self.scheduler = BackendScheduler(
+            self.input_backends, self.options.backend_deadline,
+            periods=dict(self.options.backend_periods),
+            default_period=self.options.sampling_period,
+            policy=self.options.overrun_policy)
+        self.invalid_counters_policies = dict(self.options.invalid_counters)
+        self.counters_subsets = self.get_counters_subsets()
+
+    def get_counters_subsets(self):
+        '''
+        Return the subset counters class of each backend given with
+        --counters
+        '''
+        subsets = {}
+        backends = dict((backend.get_backend_name(), backend)
+                        for backend in self.input_backends)
+        for (name, counter_names) in self.options.counters_subsets:
+            if name not in backends:
+                raise CountersSubsetError(name, "the backend is not enabled")
+            if self.options.wire_format == 1:
+                raise CountersSubsetError(name, "it needs --wire-format 2 "
+                                                "or 3")
+            try:
+                subsets[name] = subset_counters_class(
+                    backends[name].get_counters_class(), counter_names)
+            except ValueError as e:
+                raise CountersSubsetError(name, e)
+        return subsets
+
+    def select_counters(self, backend_name, counters_list):
+        '''
+        Return the counters of a backend restricted to the subset given with
+        --counters
+        '''
+        subset_class = self.counters_subsets.get(backend_name)
+        if subset_class is None:
+            return counters_list
+        header_keys = subset_class._fmt_header_ordered_keys
+        counter_keys = subset_class._fmt_counter_ordered_keys
+        return [subset_class.from_values(
+                    dict((key, counters._get_header(key))
+                         for key in header_keys),
+                    dict((key, counters._get_counter(key))
+                         for key in counter_keys))
+                for counters in counters_list]
+
+    def create_backend(self, name):
+        backend = get_input_backend_class(name)(self.options)
+        self.input_backends.append(backend)
+        return backend
 
     @as_thread
     def check_jobs_thread(self):
@@ -73,6 +155,7 @@ class Task(object):
         notifier.loop()
 
     def update_job_list(self):
+        self.job_registry.update()
         self.taskstats_backend.update_job_list()
         if self.options.enable_perfhw:
             self.perfhwstats_back.update_job_list()
@@ -80,9 +163,15 @@ class Task(object):
             self.jobprocstats_back.update_job_list()
         if self.options.enable_nvidia:
             self.nvidiastats_back.update_job_list()
+        if self.options.enable_cgroupstats:
+            self.cgroupstats_back.update_job_list()
+        for backend in self.extra_backends:
+            if hasattr(backend, 'update_job_list'):
+                backend.update_job_list()
 
     def start(self):
         LOG.info("Starting %s" % self.name)
+        self.job_registry.update()
         for backend in self.input_backends:
             backend.open()
         self.zeromq_output_backend.open()
@@ -95,44 +184,59 @@ class Task(object):
         LOG.info("Received a signal (%d)" % signum)
         LOG.info("Terminating %s properly..." % self.name)
         self.RAPLstatsBackend.close()
+        self.scheduler.close()
         self.zeromq_output_backend.close()
 
         sys.exit(0)
 
+    def check_counters(self, backend_name, counters_list):
+        '''
+        Return the counters of a backend having a value for every counter,
+        the other ones are dropped or zero filled according to the
+        --invalid-counters policy of the backend
+        '''
+        invalid = [counters for counters in counters_list
+                   if counters is None or not counters.is_complete()]
+        if not invalid:
+            return counters_list
+        if self.invalid_counters_policies.get(backend_name,
+                                              'drop') == 'zero-fill':
+            LOG.debug("%s counters of %s have missing values, filled with "
+                      "zeros" % (len(invalid), backend_name))
+            for counters in invalid:
+                if counters is not None:
+                    counters.fill_missing()
+            return [counters for counters in counters_list
+                    if counters is not None]
+        LOG.debug("%s counters of %s have missing values, ignored"
+                  % (len(invalid), backend_name))
+        return [counters for counters in counters_list
+                if counters is not None and counters.is_complete()]
+
     def sleep(self):
         now = time.time()
-        time_towait = (((now // self.options.sampling_period) + 1) *
-                       self.options.sampling_period - now)
-        time.sleep(time_towait)
+        time_towait = self.scheduler.next_wakeup(now) - now
+        if time_towait > 0:
+            time.sleep(time_towait)
 
     def loop(self):
         while True:
             now = time.time()
             LOG.debug("Gathering the metrics")
+            self.job_registry.new_cycle()
             counters_list = []
-            for backend in self.input_backends:
-                pulled_counters = backend.pull()
-
-                if backend.get_backend_name() == 'taskstats'\
-                or backend.get_backend_name() == "jobprocstats"\
-                or backend.get_backend_name() == "nvidiastats"\
-                or backend.get_backend_name() == "perfhwstats":
-                    if len(pulled_counters) > 0:
-                        for counters in pulled_counters:
-                            if type(counters) is not None:
-                              try:
-                                for c in counters:
-                                  c._format_counters()
-                              except:
-                                LOG.debug("Counters could not be formatted, ignoring data of %s" % backend.get_backend_name())
-                              else:
-                                counters_list += counters
-                else:
-                    if type(pulled_counters) is not None:
-                      counters_list += pulled_counters
-
-                LOG.debug("%s metrics have been pulled with %s" %
-                          (len(pulled_counters), backend.get_backend_name()))
+            for backend, pulled_counters in self.scheduler.pull():
+                name = backend.get_backend_name()
+                if name in PER_JOB_BACKENDS:
+                    # one list of counters per job
+                    pulled_counters = [c for counters in pulled_counters
+                                       if counters for c in counters]
+                counters_list += self.select_counters(
+                    name, self.check_counters(name, pulled_counters or []))
+
+                LOG.debug("%s metrics have been pulled with %s in %.3f sec" %
+                          (len(pulled_counters), backend.get_backend_name(),
+                           self.scheduler.timings[backend.get_backend_name()]))
 
             LOG.debug("time to take measure: %s sec" % (time.time() - now))
 
@@ -170,6 +274,50 @@ def main():
                         dest='sampling_period', default=5,
                         help='Sampling period of measuring in seconds')
 
+    parser.add_argument('--backend-deadline', type=float,
+                        dest='backend_deadline', default=None,
+                        help='Time in seconds given to the input backends to '
+                             'pull their metrics at each sampling, they run '
+                             'concurrently. The metrics of the late ones are '
+                             'pushed with a next sampling. Defaults to 80%% '
+                             'of the sampling period of each backend.')
+
+    parser.add_argument('--backend-period', type=backend_period,
+                        dest='backend_periods', action='append', default=[],
+                        metavar='BACKEND:SECONDS',
+                        help='Sampling period of an input backend (e.g. '
+                             'taskstats:1, ipmipowerstats:30), the other ones '
+                             'use the sampling period. Can be repeated.')
+
+    parser.add_argument('--overrun-policy', choices=OVERRUN_POLICIES,
+                        dest='overrun_policy', default='skip',
+                        help='What to do when a backend could not be pulled '
+                             'on time: skip the missed cycles (they are '
+                             'counted) or pull it once per missed cycle as '
+                             'soon as possible')
+
+    parser.add_argument('--enable-backend', dest='enable_backends',
+                        action='append', default=[], metavar='BACKEND',
+                        help='Enable an input backend provided by another '
+                             'package (colmet.node_backends entry point). '
+                             'Can be repeated.')
+
+    parser.add_argument('--invalid-counters', type=invalid_counters_policy,
+                        dest='invalid_counters', action='append', default=[],
+                        metavar='BACKEND:POLICY',
+                        help='What to do with the metrics of an input backend '
+                             'having missing values: drop them (default) or '
+                             'zero-fill them (e.g. nvidiastats:zero-fill). '
+                             'Can be repeated.')
+
+    parser.add_argument('--counters', type=counters_subset,
+                        dest='counters_subsets', action='append', default=[],
+                        metavar='BACKEND:COUNTER[,COUNTER...]',
+                        help='Only send these counters of an input backend '
+                             '(e.g. taskstats:ac_utime,ac_stime,coremem). '
+                             'The collector stores what it receives. Needs '
+                             '--wire-format 2 or 3. Can be repeated.')
+
     parser.add_argument('--disable-procstats', action="store_true",
                         default=False, dest="disable_procstats",
                         help='Disables node monitoring based on some /proc '
@@ -233,6 +381,19 @@ def main():
                         default=False, dest="enable_nvidia",
                         help='Enables monitoring of jobs running on NVIDIA GPUS')
 
+    parser.add_argument('--nvidia-smi', dest="nvidia_smi",
+                        default="/usr/bin/nvidia-smi",
+                        help='nvidia-smi command used to monitor the GPUs '
+                             'when the NVML library (LIB_NVML_PATH) cannot '
+                             'be loaded')
+
+    parser.add_argument('--enable-cgroupstats', action="store_true",
+                        default=False, dest="enable_cgroupstats",
+                        help='Enables monitoring of jobs from the accounting '
+                             'files of their cgroup (cpu.stat, memory.stat, '
+                             'io.stat, or the cpuacct, memory and blkio '
+                             'ones with cgroup v1)')
+
     group = parser.add_argument_group('Taskstat')
 
     group.add_argument('-c', '--cgroup', dest='cgroups',
@@ -244,6 +405,29 @@ def main():
     group.add_argument('-t', '--tid', type=int, dest='tids',
                        action='append', default=[],
                        help='task ids to monitor', metavar='TID')
+    group.add_argument('--taskstats-batch-window', type=int,
+                       dest='taskstats_batch_window', default=32,
+                       help='Maximum number of taskstats netlink requests '
+                            'in flight when fetching the tasks of a cgroup. '
+                            'Use 1 to wait for each reply before sending '
+                            'the next request.')
+    group.add_argument('--taskstats-per-process', action='store_true',
+                       dest='taskstats_per_process', default=False,
+                       help='Query taskstats once per process (thread group '
+                            'listed in cgroup.procs) instead of once per '
+                            'thread. The kernel aggregates the threads, '
+                            'including the exited ones, but only fills the '
+                            'delay accounting fields, ac_etime, nvcsw and '
+                            'nivcsw of thread groups: the CPU times, page '
+                            'faults and I/O are read from /proc/<pid>/stat '
+                            'and /proc/<pid>/io, coremem and virtmem are '
+                            'not available and are zero.')
+    group.add_argument('--taskstats-exit-events', action='store_true',
+                       dest='taskstats_exit_events', default=False,
+                       help='Listen to the taskstats exit notifications to '
+                            'account the final metrics of the exited tasks, '
+                            'including the ones started and exited between '
+                            'two samples.')
     # please let default as [] in the following, because of https://bugs.python.org/issue16399
     # the default cpuset path is set into the Task contructor
     group.add_argument('--cpuset_rootpath', dest='cpuset_rootpath',
@@ -277,6 +461,38 @@ def main():
                             " period.  Positive values specify an upper bound"
                             " for the  linger period in milliseconds.")
 
+    group.add_argument("--wire-format", type=int, choices=WIRE_FORMATS,
+                       default=1, dest='wire_format',
+                       help="Format of the messages sent to the collector: "
+                            "1 packs every metric with its headers, 2 sends "
+                            "one header per message with dictionary encoded "
+                            "strings, 3 encodes the counters as differences "
+                            "with the previous message (needs a collector "
+                            ">= 0.6.11)")
+
+    group.add_argument("--keyframe-interval", type=int,
+                       default=DEFAULT_KEYFRAME_INTERVAL,
+                       dest='keyframe_interval',
+                       help="Number of messages between two keyframes of "
+                            "the wire format 3, the collector resyncs on "
+                            "the keyframes (default: %s)"
+                            % DEFAULT_KEYFRAME_INTERVAL)
+
+    group.add_argument("--zeromq-compression", choices=sorted(CODECS),
+                       default='none', dest='zeromq_compression',
+                       help="Compression of the messages sent to the "
+                            "collector (needs a collector >= 0.6.11)")
+
+    group.add_argument("--zeromq-compression-level", type=int, default=None,
+                       dest='zeromq_compression_level',
+                       help="Compression level, 1 (fast) to 9 (small), "
+                            "default of the codec when not set")
+
+    group.add_argument("--zeromq-compression-dict", default=None,
+                       dest='zeromq_compression_dict',
+                       help="Preset dictionary of the zlib compression, the "
+                            "collector must load the same file")
+
     parser.add_argument_group(group)
 
     args = parser.parse_args()
@@ -0,0 +1,154 @@
+'''
+Jobs running on the node, shared by the input backends of colmet-node
+'''
+import os
+import re
+import json
+import logging
+import threading
+from types import MappingProxyType
+
+from colmet.common.job import TaskList
+
+LOG = logging.getLogger()
+
+# Size of the reads of the task lists
+TASKS_READ_SIZE = 65536
+
+
+class JobSnapshot(object):
+    '''
+    Immutable list of the jobs running on the node at a given time: the
+    registry replaces its snapshot rather than modifying it, so a backend
+    reading one snapshot during a cycle sees a consistent job list.
+    '''
+    __slots__ = ('cpuset_rootpath', 'filenames', 'involved_jobs')
+
+    def __init__(self, cpuset_rootpath, filenames):
+        object.__setattr__(self, 'cpuset_rootpath', cpuset_rootpath)
+        # job_id (str) -> name of the job cgroup directory
+        object.__setattr__(self, 'filenames', MappingProxyType(filenames))
+        # JSON list of the job ids, sent with the node metrics
+        object.__setattr__(self, 'involved_jobs',
+                           json.dumps(sorted(int(job_id)
+                                             for job_id in filenames)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("JobSnapshot is immutable")
+
+    @property
+    def job_ids(self):
+        return set(self.filenames)
+
+    def job_path(self, job_id):
+        return self.cpuset_rootpath + "/" + self.filenames[job_id]
+
+
+class JobRegistry(object):
+    '''
+    Maintain the list of the jobs of the node from the job cgroups found
+    in cpuset_rootpath (named according to regex_job_id). It is updated on
+    the inotify events of cpuset_rootpath.
+    '''
+
+    def __init__(self, options):
+        self.cpuset_rootpath = options.cpuset_rootpath[0]
+        self.regex_job_id = re.compile(options.regex_job_id[0])
+        self.lock = threading.Lock()
+        self.snapshot = JobSnapshot(self.cpuset_rootpath, {})
+        # sampling cycle of the node, the task lists are read once per cycle
+        self.cycle = 0
+        self.tasks_lock = threading.Lock()
+        # (cgroup path, filename) -> [file descriptor, cycle, tids, set of
+        # the tids]
+        self.task_lists = {}
+
+    def new_cycle(self):
+        '''
+        Called by the node at each sampling, the next calls to get_tasks
+        read the task lists again
+        '''
+        self.cycle += 1
+
+    def get_tasks(self, cgroup_path, filename='tasks', tracked=()):
+        '''
+        Return the TaskList of a cgroup for the current cycle, the added and
+        removed tasks are the differences with the tids tracked by the
+        caller: a backend sampled less often than the node sees the changes
+        of the cycles it has skipped. The task list file is read by the first
+        backend asking for it during the cycle, with a file descriptor kept
+        open between the cycles.
+
+        With cgroup v1, the kernel keeps the list read from an open file for
+        one second, the tasks started in the meantime are seen later.
+        '''
+        key = (cgroup_path, filename)
+        with self.tasks_lock:
+            entry = self.task_lists.get(key)
+            if entry is None or entry[1] != self.cycle:
+                entry = self._read_tasks(key, entry)
+        (_, _, tids, current) = entry
+        tracked = set(tracked)
+        return TaskList(tids, current.difference(tracked),
+                        tracked.difference(current))
+
+    def _read_tasks(self, key, entry):
+        fd = entry[0] if entry is not None else None
+        tids = []
+        try:
+            if fd is None:
+                fd = os.open(os.path.join(*key), os.O_RDONLY)
+            tids = self.read_tids(fd)
+        except OSError:
+            # the cgroup has been removed
+            if fd is not None:
+                os.close(fd)
+            fd = None
+        entry = [fd, self.cycle, tids, set(tids)]
+        if fd is None:
+            self.task_lists.pop(key, None)
+        else:
+            self.task_lists[key] = entry
+        return entry
+
+    @staticmethod
+    def read_tids(fd):
+        chunks = []
+        offset = 0
+        while True:
+            chunk = os.pread(fd, TASKS_READ_SIZE, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return list(map(int, b"".join(chunks).split()))
+
+    def close_task_lists(self, snapshot):
+        '''
+        Close the task lists of the jobs which are not in the snapshot
+        '''
+        running = set(snapshot.filenames.values())
+        with self.tasks_lock:
+            for key in list(self.task_lists):
+                cgroup_path = key[0]
+                if cgroup_path.startswith(self.cpuset_rootpath) and \
+                        os.path.basename(cgroup_path) not in running:
+                    os.close(self.task_lists.pop(key)[0])
+
+    def update(self):
+        '''
+        Scan cpuset_rootpath and publish the new snapshot
+        '''
+        with self.lock:
+            filenames = {}
+            try:
+                for filename in os.listdir(self.cpuset_rootpath):
+                    jid = self.regex_job_id.findall(filename)
+                    if len(jid) > 0:
+                        filenames[jid[0]] = filename
+            except OSError as err:
+                LOG.warning("Cannot list the jobs of %s: %s"
+                            % (self.cpuset_rootpath, err))
+            self.snapshot = JobSnapshot(self.cpuset_rootpath, filenames)
+            self.close_task_lists(self.snapshot)
+        return self.snapshot
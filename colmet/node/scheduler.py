@@ -0,0 +1,168 @@
+'''
+Concurrent pulling of the input backends of colmet-node
+'''
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+LOG = logging.getLogger()
+
+# What to do with the cycles of a backend which could not be pulled on time
+# (the previous pull is still running or the node woke up too late):
+# - skip: they are dropped and counted, the backend is pulled again at its
+#   next period boundary
+# - catch-up: the backend is pulled as soon as possible, once per missed cycle
+OVERRUN_POLICIES = ['skip', 'catch-up']
+
+# Seconds between two checks of a backend which is due but still pulling
+SCHEDULER_POLL = 0.1
+
+
+class BackendScheduler(object):
+    '''
+    Pull the input backends concurrently, each one in its own thread, so
+    that a slow backend (a command to fork, a busy device...) does not delay
+    the others.
+
+    Each backend has its own sampling period, its pulls are aligned on the
+    multiples of this period (wall-clock time).
+
+    The pulls which are not completed at the deadline are not waited for:
+    their results are returned by a next call to `pull`, and the backend
+    is not pulled again until then.
+    '''
+
+    def __init__(self, backends, deadline, periods=None, default_period=5,
+                 policy='skip'):
+        self.backends = backends
+        self.policy = policy
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(backends)))
+        periods = periods or {}
+        names = set(backend.get_backend_name() for backend in backends)
+        for name in set(periods) - names:
+            LOG.warning("no %s backend, its period is ignored" % name)
+        # backend -> sampling period in seconds
+        self.periods = dict(
+            (backend, periods.get(backend.get_backend_name(), default_period))
+            for backend in backends)
+        # backend -> deadline of its pulls in seconds
+        self.deadlines = dict(
+            (backend, deadline if deadline is not None else 0.8 * period)
+            for backend, period in self.periods.items())
+        # backend -> time of its next pull, the first one is immediate
+        now = time.time()
+        self.next_due = dict((backend, (now // period) * period)
+                             for backend, period in self.periods.items())
+        # backend -> future of the pull in progress
+        self.pending = {}
+        # backend name -> duration of its last completed pull in seconds
+        self.timings = {}
+        # backend name -> number of cycles skipped
+        self.skipped = dict((backend.get_backend_name(), 0)
+                            for backend in backends)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _timed_pull(backend):
+        start = time.time()
+        counters = backend.pull()
+        return counters, time.time() - start
+
+    def next_wakeup(self, now=None):
+        '''
+        Return the time of the next pull to start
+        '''
+        if now is None:
+            now = time.time()
+        wakeups = []
+        for backend, due in self.next_due.items():
+            if backend in self.pending:
+                # catching up, as soon as the running pull is completed
+                due = max(due, now + SCHEDULER_POLL)
+            wakeups.append(due)
+        return min(wakeups)
+
+    def _skip(self, backend, cycles, reason):
+        name = backend.get_backend_name()
+        self.skipped[name] += cycles
+        LOG.warning("%s: %d cycle(s) skipped, %s (%d skipped so far)"
+                    % (name, cycles, reason, self.skipped[name]))
+
+    def _schedule(self, now):
+        '''
+        Start the pull of the backends which are due, return them
+        '''
+        started = []
+        for backend in self.backends:
+            period = self.periods[backend]
+            due = self.next_due[backend]
+            if due > now:
+                continue
+            if backend in self.pending:
+                # the previous pull overran the period
+                if self.policy == 'skip':
+                    self._skip(backend, 1, "the previous pull is running")
+                    self.next_due[backend] = (now // period + 1) * period
+                continue
+            missed = int((now - due) // period)
+            if missed > 0 and self.policy == 'skip':
+                self._skip(backend, missed, "the node is late")
+                due += missed * period
+            self.next_due[backend] = due + period
+            self.pending[backend] = self.executor.submit(self._timed_pull,
+                                                         backend)
+            started.append(backend)
+        return started
+
+    def pull(self, now=None):
+        '''
+        Start the pull of the backends which are due and wait for them until
+        their deadline.
+
+        Return the list of (backend, counters) of the completed pulls, in the
+        order of the backends, including the late ones of the previous cycles.
+        '''
+        start = time.time()
+        if now is None:
+            now = start
+        started = self._schedule(now)
+        if started:
+            # the backends due before the deadline must not be delayed
+            deadline = min(min(self.deadlines[backend] for backend in started),
+                           self.next_wakeup(now) - now)
+            timeout = max(0, deadline - (time.time() - start))
+            wait([self.pending[backend] for backend in started],
+                 timeout=timeout)
+
+        results = []
+        for backend in self.backends:
+            future = self.pending.get(backend)
+            if future is None or not future.done():
+                continue
+            del self.pending[backend]
+            try:
+                counters, duration = future.result()
+            except Exception as err:
+                LOG.error("%s failed to pull its metrics: %r"
+                          % (backend.get_backend_name(), err))
+                continue
+            self.timings[backend.get_backend_name()] = duration
+            results.append((backend, counters))
+
+        for backend in started:
+            if backend in self.pending:
+                LOG.debug("%s missed the deadline, its metrics will be pushed "
+                          "later" % backend.get_backend_name())
+        return results
+
+
+def backend_period(value):
+    '''
+    Parse a backend:seconds value of --backend-period
+    '''
+    name, _, period = value.rpartition(':')
+    if not name:
+        raise ValueError("expected backend:seconds")
+    return name, float(period)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Throughput of colmet-collector for several numbers of --workers.
+
+For each number of workers, the script starts colmet-collector with the
+stdout backend (its output is discarded, printing the counters stands for the
+cost of an output backend), sends --messages messages of --nodes simulated
+nodes with the taskstats counters of --jobs jobs each, as fast as the
+collector accepts them, and reads the statistics logged by the collector
+until all the counters are pushed. The throughput should grow with the
+number of workers up to the number of cores.
+
+    $ python scripts/bench-collector-workers.py --workers 1 2 4 8
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import zmq  # noqa
+
+from colmet.common.delta import DeltaEncoder  # noqa
+from colmet.common.metrics.base import BaseCounters  # noqa
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# "<task name>: stdout backend: <n> counters pushed ..."
+STATS_RE = re.compile(r" - INFO - (.+?): stdout backend: (\d+) counters "
+                      r"pushed")
+
+
+def make_messages(first, count, args):
+    '''
+    Return the messages of the nodes first to first + count - 1
+    '''
+    nodes = []
+    for index in range(first, first + count):
+        counters_list = []
+        for job in range(args.jobs):
+            counters = TaskstatsCounters()
+            counters.fill_missing()
+            counters.hostname = 'node%05d' % index
+            counters.job_id = 1 + index * args.jobs + job
+            counters_list.append(counters)
+        nodes.append((counters_list, DeltaEncoder()))
+    messages = []
+    for step in range(args.messages // args.nodes):
+        for (counters_list, encoder) in nodes:
+            for counters in counters_list:
+                counters.timestamp = 1500000000 + step
+                counters.cpu_count += 1
+            messages.append(bytes(BaseCounters.pack_from_list(
+                counters_list, args.wire_format, encoder)))
+    return messages
+
+
+def run_nodes(first, count, args, ready, go):
+    messages = make_messages(first, count, args)
+    context = zmq.Context()
+    socket = context.socket(zmq.PUSH)
+    socket.setsockopt(zmq.LINGER, -1)
+    socket.connect(args.uri)
+    ready.release()
+    go.wait()
+    for raw in messages:
+        socket.send(raw)
+    socket.close()
+    context.term()
+
+
+def read_stats(stream, pushed, lock):
+    for line in iter(stream.readline, b''):
+        match = STATS_RE.search(line.decode('utf-8', 'replace'))
+        if match:
+            with lock:
+                pushed[match.group(1)] = int(match.group(2))
+
+
+def bench(workers, args):
+    command = [sys.executable, '-c',
+               'from colmet.collector.main import main; main()',
+               '-v', '--enable-stdout-backend',
+               '--workers', str(workers),
+               '--zeromq-bind-uri', args.uri,
+               '--zeromq-hwm', '10000',
+               '--flush-interval', '100', '--stats-period', '0.2',
+               '--output-queue-policy', 'block']
+    collector = subprocess.Popen(command, cwd=ROOT,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+    pushed = {}
+    lock = threading.Lock()
+    reader = threading.Thread(target=read_stats,
+                              args=(collector.stderr, pushed, lock))
+    reader.daemon = True
+    reader.start()
+
+    ready = multiprocessing.Semaphore(0)
+    go = multiprocessing.Event()
+    processes = []
+    per_process = args.nodes // args.senders
+    for index in range(args.senders):
+        process = multiprocessing.Process(
+            target=run_nodes,
+            args=(index * per_process, per_process, args, ready, go))
+        process.start()
+        processes.append(process)
+    for _ in processes:
+        ready.acquire()
+
+    expected = (args.messages // args.nodes) * per_process * args.senders \
+        * args.jobs
+    start = time.time()
+    go.set()
+    while True:
+        with lock:
+            done = sum(pushed.values())
+        if done >= expected or time.time() - start > args.timeout:
+            break
+        time.sleep(0.05)
+    # the last statistics are logged up to --stats-period after the flush
+    elapsed = time.time() - start - 0.1
+    for process in processes:
+        process.join()
+    collector.terminate()
+    collector.wait()
+    return (done, expected, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4],
+                        help="numbers of workers to measure")
+    parser.add_argument("--nodes", type=int, default=256,
+                        help="number of simulated nodes")
+    parser.add_argument("--senders", type=int, default=4,
+                        help="number of processes sending the messages")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="number of jobs per node")
+    parser.add_argument("--messages", type=int, default=20000,
+                        help="number of messages sent")
+    parser.add_argument("--wire-format", type=int, default=2,
+                        choices=[1, 2, 3])
+    parser.add_argument("--uri", default='tcp://127.0.0.1:5598')
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="maximum duration of a measure in seconds")
+    args = parser.parse_args()
+
+    print("%d cores, %d messages of %d nodes, %d jobs per node, wire "
+          "format %d" % (multiprocessing.cpu_count(), args.messages,
+                         args.nodes, args.jobs, args.wire_format))
+    print("%8s %12s %14s %8s" % ("workers", "counters", "counters/s",
+                                 "speedup"))
+    reference = None
+    for workers in args.workers:
+        (done, expected, elapsed) = bench(workers, args)
+        rate = done / elapsed
+        reference = reference or rate
+        print("%8d %5d/%-6d %14.0f %7.2fx" % (workers, done, expected, rate,
+                                             rate / reference))
+
+
+if __name__ == '__main__':
+    main()
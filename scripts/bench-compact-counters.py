@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compare the memory used by the taskstats counters kept by the node for the
+threads of the jobs, with the regular and the compact counters.
+
+Each tracked thread holds three counters (the total, the delta and the last
+fetch), the benchmark reports the memory allocated for them, the number of
+objects tracked by the garbage collector and the time of the accumulations.
+
+    $ python scripts/bench-compact-counters.py --threads 50000
+"""
+from __future__ import print_function
+import argparse
+import gc
+import os
+import random
+import struct
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+from colmet.common.metrics.base import compact_counters_class  # noqa
+
+
+def taskstats_buffer():
+    '''
+    Return a struct taskstats (version 8) with random counters
+    '''
+    values = [random.randint(0, 2 ** 40) for _ in range(48)]
+    return struct.pack("<HIBB8x48Q", 8, 0, 0, 0, *values)
+
+
+def track_threads(counters_class, buffers):
+    '''
+    Return the counters of the threads as kept by TaskInfo
+    '''
+    threads = []
+    for data in buffers:
+        total = counters_class(taskstats_buffer=data)
+        fetch = counters_class(taskstats_buffer=data)
+        delta = counters_class()
+        fetch.delta(total, delta)
+        threads.append((total, delta, fetch))
+    return threads
+
+
+def run(counters_class, buffers):
+    gc.collect()
+    objects = len(gc.get_objects())
+    tracemalloc.start()
+    threads = track_threads(counters_class, buffers)
+    (current, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    objects = len(gc.get_objects()) - objects
+
+    start = time.time()
+    for (total, delta, fetch) in threads:
+        fetch.delta(total, delta)
+    duration = time.time() - start
+
+    start = time.time()
+    gc.collect()
+    gc_duration = time.time() - start
+    return (current, objects, duration, gc_duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=50000,
+                        help="number of tracked threads")
+    args = parser.parse_args()
+
+    buffers = [taskstats_buffer() for _ in range(args.threads)]
+    print("%d threads, 3 counters per thread" % args.threads)
+    for counters_class in [TaskstatsCounters,
+                           compact_counters_class(TaskstatsCounters)]:
+        (memory, objects, duration, gc_duration) = run(counters_class,
+                                                       buffers)
+        print("%-26s %8.1f MiB %9d gc objects, delta %.3f s, "
+              "full collection %.3f s"
+              % (counters_class.__name__, memory / 2. ** 20, objects,
+                 duration, gc_duration))
+
+
+if __name__ == '__main__':
+    main()
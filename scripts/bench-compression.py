@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compare the compression ratio and the CPU time of the codecs and levels of
+--zeromq-compression on the messages of the nodes.
+
+The messages are recorded from the nodes with --record (the script binds the
+collector URI), read from such a recording with --input, or generated (the
+taskstats counters of --jobs jobs in each wire format). The zlib preset
+dictionary is trained on the first half of the messages and measured on the
+second half. For each link speed, the cost of a message is the compression
+time plus the transfer time of the compressed payload.
+
+    $ python scripts/bench-compression.py --record node.rec --count 1000
+    $ python scripts/bench-compression.py --input node.rec
+"""
+from __future__ import print_function
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from colmet.common.compression import (CODECS, Compressor,  # noqa
+                                       Decompressor, train_dictionary)
+from colmet.common.metrics.base import BaseCounters  # noqa
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+
+# name -> bits per second
+LINKS = [('10GbE', 10e9), ('1GbE', 1e9), ('100Mb/s', 100e6)]
+
+_length = struct.Struct("<I")
+
+
+def record(path, bind_uri, count):
+    '''
+    Store count messages received on bind_uri, uncompressed
+    '''
+    import zmq
+    context = zmq.Context()
+    socket = context.socket(zmq.PULL)
+    socket.bind(bind_uri)
+    decompressor = Decompressor()
+    with open(path, 'wb') as record_file:
+        for _ in range(count):
+            frames = socket.recv_multipart()
+            if len(frames) == 1:
+                raw = frames[0]
+            else:
+                raw = bytes(decompressor.decompress(frames[0], frames[1]))
+            record_file.write(_length.pack(len(raw)))
+            record_file.write(raw)
+    socket.close()
+    context.term()
+
+
+def read_record(path):
+    messages = []
+    with open(path, 'rb') as record_file:
+        data = record_file.read()
+    offset = 0
+    while offset < len(data):
+        (length,) = _length.unpack_from(data, offset)
+        offset += _length.size
+        messages.append(data[offset:offset + length])
+        offset += length
+    return messages
+
+
+def generate(jobs, count, wire_format):
+    '''
+    Return the messages of a node sending the taskstats of its jobs
+    '''
+    counters_list = []
+    for job_id in range(jobs):
+        counters = TaskstatsCounters()
+        counters.fill_missing()
+        counters.hostname = 'node1'
+        counters.job_id = 1000 + job_id
+        counters.timestamp = 1500000000
+        counters_list.append(counters)
+    encoder = None
+    if wire_format == 3:
+        from colmet.common.delta import DeltaEncoder
+        encoder = DeltaEncoder()
+    messages = []
+    for _ in range(count):
+        for counters in counters_list:
+            counters.timestamp += 5
+            for (name, definition) in counters._counter_definitions.items():
+                if definition[2] == 'add':
+                    counters._set_counter(name, counters._get_counter(name)
+                                          + random.randint(0, 10000))
+        messages.append(bytes(BaseCounters.pack_from_list(
+            counters_list, wire_format, encoder)))
+    return messages
+
+
+def measure(compressor, messages):
+    decompressor = Decompressor([compressor.dictionary]
+                                if compressor.dictionary else [])
+    start = time.time()
+    frames = [compressor.compress(raw) for raw in messages]
+    compress_time = time.time() - start
+    start = time.time()
+    for (header, payload) in frames:
+        decompressor.decompress(header, payload)
+    decompress_time = time.time() - start
+    size = sum(len(header) + len(payload) for (header, payload) in frames)
+    return (size, compress_time, decompress_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--record", help="record the messages in this file")
+    parser.add_argument("--bind-uri", default='tcp://0.0.0.0:5556',
+                        help="URI the nodes send their messages to")
+    parser.add_argument("--count", type=int, default=1000,
+                        help="number of messages to record or generate")
+    parser.add_argument("--input", help="recording of node messages")
+    parser.add_argument("--jobs", type=int, default=64,
+                        help="number of jobs of the generated messages")
+    parser.add_argument("--wire-format", type=int, default=1,
+                        choices=[1, 2, 3],
+                        help="wire format of the generated messages")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.bind_uri, args.count)
+        return
+    if args.input:
+        messages = read_record(args.input)
+    else:
+        messages = generate(args.jobs, args.count, args.wire_format)
+
+    half = len(messages) // 2
+    dictionary = train_dictionary(messages[:half])
+    messages = messages[half:]
+    raw_size = sum(len(raw) for raw in messages)
+    print("%d messages, %d bytes" % (len(messages), raw_size))
+
+    configurations = [('zlib', level, None) for level in [1, 6, 9]]
+    configurations += [('zlib', level, dictionary) for level in [1, 6, 9]]
+    if 'lzma' in CODECS:
+        configurations += [('lzma', preset, None) for preset in [0, 6]]
+    print("%-14s %7s %12s %12s %s"
+          % ("codec", "ratio", "compress", "decompress",
+             " ".join("%10s" % name for (name, _) in LINKS)))
+    print("%-14s %7.2f %9.1f MB/s %9.1f MB/s %s"
+          % ("none", 1, float('inf'), float('inf'),
+             " ".join("%7.1f ms" % (raw_size * 8 / bandwidth * 1000)
+                      for (_, bandwidth) in LINKS)))
+    for (codec, level, zdict) in configurations:
+        (size, compress_time, decompress_time) = \
+            measure(Compressor(codec, level, zdict), messages)
+        name = "%s-%s%s" % (codec, level, "+dict" if zdict else "")
+        print("%-14s %7.2f %9.1f MB/s %9.1f MB/s %s"
+              % (name, raw_size / float(size),
+                 raw_size / compress_time / 1e6,
+                 raw_size / decompress_time / 1e6,
+                 " ".join("%7.1f ms" % ((compress_time
+                                         + size * 8 / bandwidth) * 1000)
+                          for (_, bandwidth) in LINKS)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compare the row by row HDF5 writes (with a flush per row) of colmet 0.6.10
+to the appends of structured arrays of the HDF5 output backend, built from
+counters objects or directly from the records of the messages.
+
+The collector receives --batches batches of --batch-size taskstats counters
+of --jobs jobs (in messages of --wire-format, like from the nodes), decodes
+and pushes them to the HDF5 backend.
+
+    $ python scripts/bench-hdf5-append.py --jobs 64 --batches 20
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from colmet.collector.hdf5 import HDF5OutputBackend, JobFile  # noqa
+from colmet.common.batch import CounterBatch  # noqa
+from colmet.common.delta import DeltaDecoder, DeltaEncoder  # noqa
+from colmet.common.metrics.base import BaseCounters  # noqa
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+
+
+def to_row(row, counters):
+    '''
+    Fill a row with the values of counters, like colmet 0.6.10
+    '''
+    for key in counters._header_definitions:
+        try:
+            row[key] = counters._get_header(key)
+        except Exception:
+            pass
+    for key in counters._counter_definitions:
+        try:
+            row[key] = counters._get_counter(key)
+        except Exception:
+            pass
+
+
+class RowJobFile(JobFile):
+    def append_stats(self, stats):
+        for stat in stats:
+            metric_backend = stat.metric_backend
+            if self.job_file is None:
+                self._init_job_file_if_needed()
+
+            if metric_backend not in self.job_table:
+                self._init_job_table_if_needed(metric_backend, type(stat))
+
+            row = self.job_table[metric_backend].row
+            to_row(row, stat)
+            row.append()
+            self.job_table[metric_backend].flush()
+
+
+class RowHDF5OutputBackend(HDF5OutputBackend):
+    def _get_job_stat(self, job_id):
+        if job_id not in self.jobs:
+            self.jobs[job_id] = RowJobFile(self.options, job_id)
+        return self.jobs[job_id]
+
+
+def make_batches(args):
+    '''
+    Return the messages received for each batch
+    '''
+    encoders = {}
+    batches = []
+    for index in range(args.batches):
+        counters_list = []
+        for record in range(args.batch_size):
+            counters = TaskstatsCounters()
+            counters.fill_missing()
+            counters.hostname = 'node%03d' % (record // args.jobs)
+            counters.job_id = 1000 + record % args.jobs
+            counters.timestamp = 1500000000 + index
+            counters.cpu_count = record
+            counters_list.append(counters)
+        # the records of each node are received in their own message
+        messages = []
+        for start in range(0, args.batch_size, args.jobs):
+            encoder = encoders.setdefault(start, DeltaEncoder())
+            messages.append(bytes(BaseCounters.pack_from_list(
+                counters_list[start:start + args.jobs], args.wire_format,
+                encoder)))
+        batches.append(messages)
+    return batches
+
+
+def measure(name, backend_class, batches, directory):
+    path = os.path.join(directory, '%s.hdf5' % name.replace(' ', '-'))
+    options = argparse.Namespace(hdf5_filepath=path, hdf5_complevel=0,
+                                 hdf5_complib='zlib')
+    backend = backend_class(options)
+    backend.open()
+    decoder = DeltaDecoder()
+    start = time.time()
+    for messages in batches:
+        if name == 'wire batches':
+            backend.push_batches([batch for raw in messages for batch in
+                                  CounterBatch.from_raw(raw, decoder)])
+        else:
+            backend.push([counters for raw in messages for counters in
+                          BaseCounters.unpack_to_list(raw, decoder=decoder)])
+    backend.close()
+    return (time.time() - start, os.path.getsize(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--jobs", type=int, default=64,
+                        help="number of jobs")
+    parser.add_argument("--batch-size", type=int, default=10000,
+                        help="number of counters pushed at once")
+    parser.add_argument("--batches", type=int, default=10,
+                        help="number of batches pushed")
+    parser.add_argument("--wire-format", type=int, default=2,
+                        choices=[1, 2, 3])
+    args = parser.parse_args()
+
+    batches = make_batches(args)
+    rows = args.batches * args.batch_size
+    directory = tempfile.mkdtemp(prefix='colmet-bench-')
+    try:
+        print("%d taskstats rows of %d jobs in batches of %d, wire format %d"
+              % (rows, args.jobs, args.batch_size, args.wire_format))
+        for (name, backend_class) in [('row by row', RowHDF5OutputBackend),
+                                      ('append', HDF5OutputBackend),
+                                      ('wire batches', HDF5OutputBackend)]:
+            (duration, size) = measure(name, backend_class, batches,
+                                       directory)
+            print("%-12s %8.2f s %10.0f rows/s %10d bytes"
+                  % (name, duration, rows / duration, size))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Measure the startup time and the memory of the colmet commands.
+
+Each measure runs in a new python process, which imports the module (or
+runs `<command> --version`) and reports the elapsed time and its maximum
+resident set size. The median of the runs is printed.
+
+    $ python scripts/bench-import-time.py --runs 10
+"""
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MEASURE = '''
+import resource, sys, time
+start = time.time()
+%s
+sys.stdout = sys.__stdout__
+print(time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+IMPORT = 'import %s'
+
+COMMAND = '''
+import io
+sys.argv = ['%s', '--version']
+sys.stdout = io.StringIO()
+from %s import main
+try:
+    main()
+except SystemExit:
+    pass
+'''
+
+TARGETS = [
+    ('import colmet.common.metrics', IMPORT % 'colmet.common.metrics'),
+    ('import colmet.node.main', IMPORT % 'colmet.node.main'),
+    ('import colmet.collector.main', IMPORT % 'colmet.collector.main'),
+    ('colmet-node --version', COMMAND % ('colmet-node', 'colmet.node.main')),
+    ('colmet-collector --version', COMMAND % ('colmet-collector',
+                                              'colmet.collector.main')),
+]
+
+
+def measure(code):
+    output = subprocess.check_output([sys.executable, '-c', MEASURE % code],
+                                     cwd=ROOT)
+    (duration, maxrss) = output.split()[-2:]
+    return float(duration), int(maxrss)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of runs of each measure")
+    args = parser.parse_args()
+
+    baseline = median([measure('pass') for _ in range(args.runs)])
+    print("%-30s %8.1f ms %8.1f MiB" % ('python', baseline[0] * 1000,
+                                         baseline[1] / 1024.))
+    for (name, code) in TARGETS:
+        results = [measure(code) for _ in range(args.runs)]
+        print("%-30s %8.1f ms %8.1f MiB"
+              % (name, median([r[0] for r in results]) * 1000,
+                 median([r[1] for r in results]) / 1024.))
+
+
+if __name__ == '__main__':
+    main()
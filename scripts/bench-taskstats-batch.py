@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compare the per-thread taskstats round trips with the pipelined batch mode.
+
+The netlink socket is replaced by a stub answering each request after a
+fixed latency, so the benchmark runs without privileges and measures the
+cost of waiting for every reply before sending the next request.
+
+    $ python scripts/bench-taskstats-batch.py --tasks 4096 --latency 20
+"""
+from __future__ import print_function
+import argparse
+import collections
+import errno
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from colmet.node.backends.genetlink.netlink import (Message, Attr, U32Attr,  # noqa
+                                                    Nested, parse_attributes)
+from colmet.node.backends.genetlink.genetlink import (GENL_ID_CTRL,  # noqa
+                                                      CTRL_ATTR_FAMILY_ID)
+from colmet.node.backends.taskstats import (TaskStatsNetlink,  # noqa
+                                            TASKSTATS_CMD_ATTR_PID,
+                                            TASKSTATS_TYPE_PID,
+                                            TASKSTATS_TYPE_STATS,
+                                            TASKSTATS_TYPE_AGGR_PID)
+
+TASKSTATS_FAMILY_ID = 0x17
+
+
+class StubDescriptor(object):
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        pass
+
+
+class StubConnection(object):
+    '''
+    Fake netlink connection answering the taskstats requests. Each reply is
+    available `latency` seconds after its request has been sent.
+    '''
+    def __init__(self, latency, vanished_every=0):
+        self.descriptor = StubDescriptor()
+        self.pid = os.getpid()
+        self.latency = latency
+        self.vanished_every = vanished_every
+        self.replies = collections.deque()
+        self.stats = struct.pack('H', 10) + b'\1' * 398
+        self._seq = 0
+
+    def seq(self):
+        self._seq += 1
+        return self._seq
+
+    def send(self, data):
+        _, msg_type, _, seq, _ = struct.unpack("IHHII", data[:16])
+        genl_hdr = struct.pack("BBxx", 1, 1)
+        if msg_type == GENL_ID_CTRL:
+            payload = genl_hdr + Attr(CTRL_ATTR_FAMILY_ID, "H",
+                                      TASKSTATS_FAMILY_ID)._dump()
+        else:
+            tid = parse_attributes(data[20:])[TASKSTATS_CMD_ATTR_PID].u32()
+            if self.vanished_every and tid % self.vanished_every == 0:
+                err = OSError("Netlink error: No such process (3)")
+                err.errno = errno.ESRCH
+                err.seq = seq
+                payload = err
+            else:
+                payload = genl_hdr + Nested(TASKSTATS_TYPE_AGGR_PID, [
+                    U32Attr(TASKSTATS_TYPE_PID, tid),
+                    Attr(TASKSTATS_TYPE_STATS, self.stats)])._dump()
+        self.replies.append((time.perf_counter() + self.latency, seq,
+                             msg_type, payload))
+
+    def recv(self):
+        ready, seq, msg_type, payload = self.replies.popleft()
+        while time.perf_counter() < ready:
+            pass
+        if isinstance(payload, OSError):
+            raise payload
+        msg = Message(msg_type, 0, seq, payload)
+        msg.pid = self.pid
+        return msg
+
+
+def run(nl, tids, window):
+    requests = [nl.build_request(tid) for tid in tids]
+    start = time.perf_counter()
+    if window == 0:
+        results = [nl.get_single_task_stats(request) for request in requests]
+    else:
+        nl.batch_window = window
+        results = nl.get_tasks_stats(requests)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(1 for r in results if r is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tasks', type=int, default=4096)
+    parser.add_argument('--latency', type=float, default=20,
+                        help='reply latency of the stub in microseconds')
+    parser.add_argument('--vanished-every', type=int, default=50,
+                        help='one task out of N answers ESRCH')
+    parser.add_argument('--windows', type=int, nargs='+',
+                        default=[1, 8, 32, 128])
+    args = parser.parse_args()
+
+    connection = StubConnection(args.latency / 1e6, args.vanished_every)
+    nl = TaskStatsNetlink(argparse.Namespace(), connection=connection)
+    tids = list(range(1, args.tasks + 1))
+
+    reference, found = run(nl, tids, 0)
+    print("%-20s %10s %10s %8s" % ("mode", "time (ms)", "replies", "speedup"))
+    print("%-20s %10.1f %10d %8s" % ("one round trip", reference * 1e3,
+                                     found, "1.0x"))
+    for window in args.windows:
+        elapsed, found = run(nl, tids, window)
+        print("%-20s %10.1f %10d %7.1fx" % ("batch window=%d" % window,
+                                            elapsed * 1e3, found,
+                                            reference / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Compare the size and the decoding time of the messages of a node in the wire
+formats 1, 2 and 3 (delta encoded stream).
+
+The node sends the taskstats counters of its jobs every period, the counters
+accumulated by the kernel grow by a random amount between two messages. The
+sizes are reported raw and compressed with zlib.
+
+    $ python scripts/bench-wire-formats.py --jobs 64 --messages 120
+"""
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from colmet.common.metrics.base import BaseCounters  # noqa
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+from colmet.common.delta import DeltaEncoder, DeltaDecoder  # noqa
+
+
+def make_jobs(jobs):
+    counters_list = []
+    for job_id in range(jobs):
+        counters = TaskstatsCounters()
+        counters.fill_missing()
+        counters.hostname = 'node1'
+        counters.job_id = 1000 + job_id
+        counters.timestamp = 1500000000
+        counters_list.append(counters)
+    return counters_list
+
+
+def sample(counters_list, period):
+    '''
+    Update the counters as after a sampling period
+    '''
+    for counters in counters_list:
+        counters.timestamp += period
+        for (name, definition) in counters._counter_definitions.items():
+            if definition[2] == 'add':
+                counters._set_counter(name, counters._get_counter(name)
+                                      + random.randint(0, 10000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--jobs", type=int, default=64,
+                        help="number of jobs of the node")
+    parser.add_argument("--messages", type=int, default=120,
+                        help="number of messages sent by the node")
+    parser.add_argument("--keyframe-interval", type=int, default=60,
+                        help="number of messages between two keyframes")
+    args = parser.parse_args()
+
+    counters_list = make_jobs(args.jobs)
+    encoder = DeltaEncoder(args.keyframe_interval)
+    messages = dict((wire_format, []) for wire_format in [1, 2, 3])
+    for _ in range(args.messages):
+        sample(counters_list, 5)
+        for wire_format in [1, 2, 3]:
+            raw = BaseCounters.pack_from_list(counters_list, wire_format,
+                                              encoder)
+            messages[wire_format].append(bytes(raw))
+
+    print("%d jobs, %d messages" % (args.jobs, args.messages))
+    for (wire_format, raws) in sorted(messages.items()):
+        size = sum(len(raw) for raw in raws)
+        compressed = sum(len(zlib.compress(raw)) for raw in raws)
+        decoder = DeltaDecoder()
+        start = time.time()
+        for raw in raws:
+            BaseCounters.unpack_to_list(raw, unpack_counters=True,
+                                        decoder=decoder)
+        duration = time.time() - start
+        print("wire format %d: %9d bytes, %9d bytes with zlib, "
+              "decoded in %.3f s" % (wire_format, size, compressed, duration))
+
+
+if __name__ == '__main__':
+    main()
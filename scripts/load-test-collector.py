@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Load test of the collector ingest loop with simulated nodes.
+
+Processes simulate --nodes nodes, each with its own zeromq socket sending the
+taskstats counters of --jobs jobs every --period seconds (with a random
+phase). The collector runs its loop with an output backend counting the
+counters. The nodes send without blocking: the messages refused because the
+high water mark is reached are counted as dropped.
+
+    $ python scripts/load-test-collector.py --nodes 2000 --duration 60
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import zmq  # noqa
+
+from colmet.collector.main import Task  # noqa
+from colmet.common.backends.base import OutputBaseBackend  # noqa
+from colmet.common.metrics.base import BaseCounters  # noqa
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+
+
+class CountingBackend(OutputBaseBackend):
+    __backend_name__ = "counting"
+
+    def __init__(self, options):
+        OutputBaseBackend.__init__(self, options)
+        self.counters = 0
+        self.pushes = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def push(self, counters_list):
+        self.counters += len(counters_list)
+        self.pushes += 1
+
+
+def make_node(hostname, jobs):
+    counters_list = []
+    for job_id in range(jobs):
+        counters = TaskstatsCounters()
+        counters.fill_missing()
+        counters.hostname = hostname
+        counters.job_id = 1000 + job_id
+        counters_list.append(counters)
+    return counters_list
+
+
+def run_nodes(first, count, args, sent, dropped):
+    '''
+    Simulate the nodes first to first + count - 1
+    '''
+    context = zmq.Context()
+    nodes = []
+    for index in range(first, first + count):
+        socket = context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.SNDHWM, args.zeromq_hwm)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(args.uri)
+        encoder = None
+        if args.wire_format == 3:
+            from colmet.common.delta import DeltaEncoder
+            encoder = DeltaEncoder()
+        nodes.append([random.uniform(0, args.period), socket, encoder,
+                      make_node('node%05d' % index, args.jobs)])
+
+    start = time.time()
+    end = start + args.duration
+    while True:
+        nodes.sort(key=lambda node: node[0])
+        node = nodes[0]
+        send_time = start + node[0]
+        if send_time >= end:
+            break
+        if send_time > time.time():
+            time.sleep(send_time - time.time())
+        (_, socket, encoder, counters_list) = node
+        for counters in counters_list:
+            counters.timestamp = int(send_time)
+            counters.cpu_count += 1
+        raw = BaseCounters.pack_from_list(counters_list, args.wire_format,
+                                          encoder)
+        try:
+            socket.send(raw, zmq.NOBLOCK)
+            with sent.get_lock():
+                sent.value += 1
+        except zmq.Again:
+            with dropped.get_lock():
+                dropped.value += 1
+        node[0] += args.period
+    time.sleep(1)
+    for node in nodes:
+        node[1].close()
+    context.term()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nodes", type=int, default=2000,
+                        help="number of simulated nodes")
+    parser.add_argument("--processes", type=int, default=8,
+                        help="number of processes simulating the nodes")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="number of jobs per node")
+    parser.add_argument("--period", type=float, default=5,
+                        help="sampling period of the nodes in seconds")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="duration of the test in seconds")
+    parser.add_argument("--wire-format", type=int, default=2,
+                        choices=[1, 2, 3])
+    parser.add_argument("--uri", default='tcp://127.0.0.1:5599')
+    parser.add_argument("--zeromq-hwm", type=int, default=1000)
+    parser.add_argument("--buffer-size", type=int, default=10000,
+                        help="number of counters flushed at once")
+    parser.add_argument("--flush-interval", type=int, default=1000,
+                        help="maximum time before a flush in milliseconds")
+    args = parser.parse_args()
+
+    options = argparse.Namespace(
+        hdf5_filepath=None, enable_stdout_backend=False, elastic_host=None,
+        zeromq_bind_uri=args.uri, zeromq_hwm=args.zeromq_hwm,
+        zeromq_linger=0, zeromq_compression_dicts=[],
+        buffer_size=args.buffer_size, flush_interval=args.flush_interval,
+        sampling_period=5, stats_period=5, output_queue_size=0,
+        output_queue_policy='block', output_spill_dir=None)
+    task = Task('collector', options)
+    backend = CountingBackend(options)
+    task.add_output_backend(backend)
+    task.input_backend.open()
+    collector = threading.Thread(target=task.loop)
+    collector.start()
+
+    sent = multiprocessing.Value('l', 0)
+    dropped = multiprocessing.Value('l', 0)
+    processes = []
+    per_process = args.nodes // args.processes
+    for index in range(args.processes):
+        first = index * per_process
+        count = per_process if index < args.processes - 1 \
+            else args.nodes - first
+        process = multiprocessing.Process(target=run_nodes,
+                                          args=(first, count, args, sent,
+                                                dropped))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    # let the collector flush the last counters
+    time.sleep(args.flush_interval / 1000. + 1)
+    task.stop()
+    collector.join()
+    task.push()
+    task.input_backend.close()
+
+    stats = task.get_stats()
+    expected = args.nodes * args.duration / args.period
+    print("%d nodes, %d jobs per node, every %.1f s during %.0f s, wire "
+          "format %d" % (args.nodes, args.jobs, args.period, args.duration,
+                         args.wire_format))
+    print("messages: %d expected, %d sent, %d dropped by the nodes, %d "
+          "received" % (expected, sent.value, dropped.value,
+                        stats['received_messages']))
+    print("counters: %d received, %d pushed in %d flushes, %.0f messages/s, "
+          "%.0f counters/s" % (stats['received_counters'], backend.counters,
+                               backend.pushes,
+                               stats['received_messages'] / args.duration,
+                               backend.counters / args.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ here = op.abspath(op.dirname(__file__))
 
 requirements = [
     'tables',
+    'numpy',
     'pyinotify',
     'pyzmq',
     'requests',
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the reading of the cgroup accounting files
+"""
+import argparse
+
+from colmet.node.backends.cgroupstats import CgroupStats
+
+
+def write_files(path, files):
+    path.mkdir(parents=True)
+    for filename, content in files.items():
+        (path / filename).write_text(content)
+
+
+def test_cgroup_v2(tmp_path):
+    write_files(tmp_path / 'oar' / 'user_42', {
+        'cgroup.controllers': 'cpuset cpu io memory\n',
+        'cpu.stat': 'usage_usec 300\nuser_usec 200\nsystem_usec 100\n'
+                    'nr_periods 0\nnr_throttled 0\nthrottled_usec 0\n',
+        'memory.current': '4096\n',
+        'memory.peak': '8192\n',
+        'memory.stat': 'anon 1024\nfile 2048\nshmem 0\npgfault 7\n'
+                       'pgmajfault 1\n',
+        'io.stat': '8:0 rbytes=10 wbytes=20 rios=1 wios=2 dbytes=0 dios=0\n'
+                   '8:16 rbytes=5 wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n',
+    })
+    options = argparse.Namespace(cpuset_rootpath=[str(tmp_path / 'oar')])
+    cgroupstats = CgroupStats(options)
+
+    counters = cgroupstats.get_stats('user_42')
+    assert counters.cpu_usage_usec == 300
+    assert counters.memory_peak == 8192
+    assert counters.memory_file == 2048
+    assert counters.io_rbytes == 15
+    assert counters.io_wios == 2
+
+    # the files are kept open and read again
+    (tmp_path / 'oar' / 'user_42' / 'cpu.stat').write_text('usage_usec 500\n')
+    assert cgroupstats.get_stats('user_42').cpu_usage_usec == 500
+    assert len(cgroupstats.job_fds['user_42']) == 5
+    cgroupstats.close()
+    assert cgroupstats.job_fds == {}
+
+
+def test_cgroup_v1(tmp_path):
+    write_files(tmp_path / 'cpuset' / 'oar' / 'user_42', {})
+    write_files(tmp_path / 'cpuacct' / 'oar' / 'user_42', {
+        'cpuacct.usage': '3000000\n',
+    })
+    write_files(tmp_path / 'memory' / 'oar' / 'user_42', {
+        'memory.usage_in_bytes': '4096\n',
+        'memory.max_usage_in_bytes': '8192\n',
+        'memory.stat': 'rss 1\ntotal_rss 1024\ntotal_cache 2048\n',
+    })
+    write_files(tmp_path / 'blkio' / 'oar' / 'user_42', {
+        'blkio.throttle.io_service_bytes': '8:0 Read 10\n8:0 Write 20\n'
+                                           '8:0 Total 30\nTotal 30\n',
+    })
+    options = argparse.Namespace(
+        cpuset_rootpath=[str(tmp_path / 'cpuset' / 'oar')])
+    cgroupstats = CgroupStats(options)
+
+    counters = cgroupstats.get_stats('user_42')
+    assert counters.cpu_usage_usec == 3000
+    assert counters.memory_current == 4096
+    assert counters.memory_anon == 1024
+    assert counters.io_rbytes == 10
+    assert counters.io_wbytes == 20
+    # not available
+    assert counters.cpu_user_usec == -1
+    assert counters.io_rios == -1
+
+    # the files created later are opened at the next samples
+    (tmp_path / 'blkio' / 'oar' / 'user_42' /
+     'blkio.throttle.io_serviced').write_text('8:0 Read 3\n8:0 Write 4\n')
+    counters = cgroupstats.get_stats('user_42')
+    assert counters.io_rios == 3
+    assert 'blkio.throttle.io_serviced' not in \
+        cgroupstats.job_missing['user_42']
+    cgroupstats.close()
+    assert cgroupstats.job_missing == {}
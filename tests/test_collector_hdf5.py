@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the HDF5 output backend of the collector
+"""
+import argparse
+import threading
+import time
+
+import pytest
+
+tables = pytest.importorskip('tables')
+
+from colmet.collector.hdf5 import HDF5OutputBackend, JobFile, to_records  # noqa
+from colmet.collector.output import OutputQueue, queue_policy  # noqa
+from colmet.common.batch import CounterBatch  # noqa
+from colmet.common.delta import DeltaDecoder, DeltaEncoder  # noqa
+from colmet.common.metrics.base import BaseCounters, subset_counters_class  # noqa
+from colmet.common.metrics.taskstats import TaskstatsCounters  # noqa
+
+from .test_metrics_base import make_batch  # noqa
+
+
+def hdf5_options(tmp_path, **kwargs):
+    options = argparse.Namespace(hdf5_filepath=str(tmp_path / 'colmet.hdf5'),
+                                 hdf5_complevel=0, hdf5_complib='zlib')
+    for (key, value) in kwargs.items():
+        setattr(options, key, value)
+    return options
+
+
+def sent_counters():
+    counters_list = make_batch()
+    for job_id in [7, 8]:
+        counters = TaskstatsCounters()
+        counters.fill_missing()
+        counters.hostname = 'node1'
+        counters.job_id = job_id
+        counters.timestamp = 1002
+        counters.cpu_count = job_id * 10
+        counters_list.append(counters)
+    subset = subset_counters_class(TaskstatsCounters,
+                                   ['cpu_count', 'coremem'])
+    counters_list.append(subset.from_values(
+        {'metric_backend': 'taskstats_default', 'hostname': 'node1',
+         'job_id': 8, 'timestamp': 1003}, {'cpu_count': 4, 'coremem': 9}))
+    return counters_list
+
+
+def received_counters():
+    return BaseCounters.unpack_to_list(
+        BaseCounters.pack_from_list(sent_counters()[:-1], 2))
+
+
+def read_tables(path):
+    with tables.open_file(path) as hdf5_file:
+        return dict((table._v_pathname, table.read().tolist())
+                    for table in hdf5_file.walk_nodes('/', 'Table'))
+
+
+def test_to_records(tmp_path):
+    '''Testing that the bulk append writes the values of the counters'''
+    counters_list = [c for c in received_counters()
+                     if c.metric_backend == 'cgroupstats_default']
+    hdf5_class = JobFile.hdf5_counters['cgroupstats_default']
+    description = hdf5_class.get_table_description()
+    with tables.open_file(str(tmp_path / 'rows.hdf5'), 'w') as hdf5_file:
+        bulk = hdf5_file.create_table('/', 'bulk', description)
+        bulk.append(to_records(hdf5_class, bulk, counters_list))
+        rows = [hdf5_class.to_counters(row) for row in bulk.iterrows()]
+    keys = ['job_id', 'timestamp'] + \
+        list(hdf5_class.Counters._counter_definitions)
+    assert [[getattr(c, key) for key in keys] for c in rows] == \
+        [[getattr(c, key) for key in keys] for c in counters_list]
+
+
+def test_push(tmp_path):
+    options = hdf5_options(tmp_path)
+    backend = HDF5OutputBackend(options)
+    backend.open()
+    backend.push(received_counters())
+    backend.push(received_counters())
+    backend.close()
+    rows = read_tables(options.hdf5_filepath)
+    assert sorted(rows) == ['/job_0/infinibandstats_default',
+                            '/job_7/cgroupstats_default',
+                            '/job_7/taskstats_default',
+                            '/job_8/cgroupstats_default',
+                            '/job_8/taskstats_default']
+    assert len(rows['/job_0/infinibandstats_default']) == 4
+    assert len(rows['/job_8/taskstats_default']) == 2
+
+
+def test_push_subset(tmp_path):
+    options = hdf5_options(tmp_path)
+    subset = subset_counters_class(TaskstatsCounters,
+                                   ['cpu_count', 'coremem'])
+    counters = subset.from_values(
+        {'metric_backend': 'taskstats_default', 'hostname': 'node1',
+         'job_id': 8, 'timestamp': 6}, {'cpu_count': 4, 'coremem': 9})
+    backend = HDF5OutputBackend(options)
+    backend.open()
+    backend.push(BaseCounters.unpack_to_list(
+        BaseCounters.pack_from_list([counters], 2)))
+    backend.close()
+    with tables.open_file(options.hdf5_filepath) as hdf5_file:
+        table = hdf5_file.get_node('/job_8/taskstats_default')
+        assert table.colnames == ['coremem', 'cpu_count', 'hostname',
+                                  'job_id', 'metric_backend', 'timestamp']
+        assert table.read().tolist() == [(9, 4, b'node1', 8,
+                                          b'taskstats_default', 6)]
+
+
+def test_flush_policy(tmp_path):
+    options = hdf5_options(tmp_path, hdf5_flush_rows=8,
+                           hdf5_flush_interval=3600)
+    backend = HDF5OutputBackend(options)
+    backend.open()
+    backend.push(received_counters())
+    assert backend.unflushed_rows == 6
+    backend.push(received_counters())
+    assert backend.unflushed_rows == 0
+    backend.close()
+
+
+@pytest.mark.parametrize('queue_size', [0, 2])
+def test_flush_while_idle(tmp_path, queue_size):
+    '''Testing that the rows are flushed when nothing else is pushed'''
+    options = hdf5_options(tmp_path, hdf5_flush_rows=1000,
+                           hdf5_flush_interval=0.05)
+    backend = HDF5OutputBackend(options)
+    backend.open()
+    output_queue = OutputQueue(backend, queue_size)
+    output_queue.put(received_counters())
+    for _ in range(100):
+        if backend.unflushed_rows == 0 and backend.jobs:
+            break
+        # the collector loop ticks the backends it pushes itself
+        output_queue.tick()
+        time.sleep(0.01)
+    assert backend.jobs
+    assert backend.unflushed_rows == 0
+    output_queue.close()
+    backend.close()
+
+
+def test_full_queue_keeps_rows(tmp_path):
+    '''Testing that the default policy does not drop the batches of HDF5'''
+    options = hdf5_options(tmp_path)
+    backend = HDF5OutputBackend(options)
+    backend.open()
+    running = threading.Event()
+    push = backend.push
+
+    def slow_push(counters_list):
+        running.wait()
+        push(counters_list)
+    backend.push = slow_push
+    output_queue = OutputQueue(backend, 1, queue_policy(None, 'hdf5'))
+    producer = threading.Thread(
+        target=lambda: [output_queue.put(received_counters())
+                        for _ in range(4)])
+    producer.start()
+    # the collector waits for room instead of dropping a batch
+    producer.join(0.2)
+    assert producer.is_alive()
+    running.set()
+    producer.join()
+    output_queue.close()
+    backend.close()
+    assert output_queue.get_stats()['dropped_counters'] == 0
+    rows = read_tables(options.hdf5_filepath)
+    assert len(rows['/job_0/infinibandstats_default']) == 8
+    assert len(rows['/job_8/taskstats_default']) == 4
+
+
+@pytest.mark.parametrize('wire_format', [1, 2, 3])
+def test_push_batches(tmp_path, wire_format):
+    '''Testing that the records of the messages are written like counters'''
+    counters_list = sent_counters()
+    if wire_format == 1:
+        # no subsets in the wire format 1
+        counters_list = counters_list[:-1]
+    encoder = DeltaEncoder()
+    messages = [BaseCounters.pack_from_list(counters_list, wire_format,
+                                            encoder) for _ in range(2)]
+    results = []
+    for name in ['counters', 'batches']:
+        options = hdf5_options(tmp_path)
+        options.hdf5_filepath = str(tmp_path / ('%s.hdf5' % name))
+        backend = HDF5OutputBackend(options)
+        backend.open()
+        decoder = DeltaDecoder()
+        for raw in messages:
+            if name == 'counters':
+                backend.push(BaseCounters.unpack_to_list(raw,
+                                                         decoder=decoder))
+            else:
+                backend.push_batches(CounterBatch.from_raw(raw, decoder))
+        backend.close()
+        results.append(read_tables(options.hdf5_filepath))
+    assert results[0] == results[1]
+    assert len(results[1]['/job_8/taskstats_default']) == \
+        (2 if wire_format == 1 else 4)
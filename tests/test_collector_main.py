@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the ingest loop of the collector
+"""
+import argparse
+import time
+
+import pytest
+
+from colmet.collector import output
+from colmet.collector.main import Task
+from colmet.common.exceptions import OutputBackendUnavailableError
+
+
+class StubInput(object):
+    '''Returns a list of counters at each wait, then stops the task'''
+
+    def __init__(self, task, batches):
+        self.task = task
+        self.batches = list(batches)
+        self.ready = None
+
+    def wait(self, timeout=None):
+        if not self.batches:
+            self.task.stop()
+            return False
+        self.ready = self.batches.pop(0)
+        if self.ready is None:
+            # nothing received during timeout
+            time.sleep(timeout / 1000.)
+            return False
+        return True
+
+    def pull(self, buffer_size):
+        return self.ready
+
+    def get_stats(self):
+        return {'received_messages': 0}
+
+    def close(self):
+        pass
+
+
+class StubOutput(object):
+    name = 'stub'
+
+    def __init__(self):
+        self.pushed = []
+
+    def push(self, counters_list):
+        self.pushed.append(list(counters_list))
+
+    def get_backend_name(self):
+        return self.name
+
+    def close(self):
+        pass
+
+
+class TickedOutput(StubOutput):
+    tick_interval = 0.01
+
+    def __init__(self):
+        StubOutput.__init__(self)
+        self.ticks = 0
+
+    def tick(self):
+        self.ticks += 1
+
+
+class UnavailableOutput(StubOutput):
+    name = 'elasticsearch'
+
+    def push(self, counters_list):
+        raise OutputBackendUnavailableError('elasticsearch', 'down')
+
+
+def make_task(batches, buffer_size, flush_interval, **kwargs):
+    options = argparse.Namespace(
+        hdf5_filepath=None, enable_stdout_backend=False, elastic_host=None,
+        buffer_size=buffer_size, flush_interval=flush_interval,
+        sampling_period=5, stats_period=0, output_queue_size=0,
+        output_queue_policy='block', output_spill_dir=None)
+    for (key, value) in kwargs.items():
+        setattr(options, key, value)
+    task = Task('collector', options)
+    task.input_backend = StubInput(task, batches)
+    output = StubOutput()
+    task.add_output_backend(output)
+    return task, output
+
+
+def test_flush_on_size():
+    task, output = make_task([[1, 2], [3], [4, 5, 6], [7]], 3, 60000)
+    task.loop()
+    assert output.pushed == [[1, 2, 3], [4, 5, 6]]
+    assert task.get_stats()['queued_counters'] == 1
+    task.push()
+    assert output.pushed[-1] == [7]
+    assert task.get_stats()['flushed_counters'] == 7
+
+
+def test_flush_on_time():
+    task, output = make_task([[1], None, None, [2]], 100, 10)
+    task.loop()
+    assert output.pushed == [[1]]
+    assert task.counters_list == [2]
+
+
+def test_flush_batches():
+    '''Testing the CounterBatch pulled when the output takes them'''
+    from colmet.common.batch import CounterBatch
+    from colmet.common.metrics.base import BaseCounters
+    from .test_metrics_base import make_batch
+    raw = BaseCounters.pack_from_list(make_batch(), 2)
+    task, output = make_task([None], 5, 60000)
+    assert not task.use_batches()
+    task.input_backend.pull_batches = lambda buffer_size: \
+        CounterBatch.from_raw(raw)
+    output.push_batches = output.push
+    task.input_backend.batches = [True, True, True]
+    assert task.use_batches()
+    task.loop()
+    # the records of two messages (two batches each) fill the buffer
+    assert [len(batches) for batches in output.pushed] == [4]
+    assert task.get_stats()['flushed_counters'] == 8
+    assert task.get_stats()['queued_counters'] == 4
+
+
+def test_tick_while_idle():
+    '''Testing the ticks of a backend when nothing is received'''
+    task, output = make_task([None, None, None], 100, 60000)
+    ticked = TickedOutput()
+    task.add_output_backend(ticked)
+    start = time.time()
+    task.loop()
+    # the loop waits tick_interval instead of flush_interval
+    assert time.time() - start < 1
+    assert ticked.ticks >= 3
+
+
+@pytest.mark.parametrize('spill', [False, True])
+def test_elasticsearch_outage(tmp_path, monkeypatch, spill):
+    '''Testing that HDF5 keeps its rows while Elasticsearch is down'''
+    monkeypatch.setattr(output, 'MIN_RETRY_DELAY', 0.01)
+    spill_dir = str(tmp_path) if spill else None
+    from .test_metrics_base import make_batch
+    batches = [make_batch() for _ in range(20)]
+    task, stub = make_task(batches, 1, 60000, output_queue_size=1,
+                           output_queue_policy=None,
+                           output_spill_dir=spill_dir)
+    hdf5 = StubOutput()
+    hdf5.name = 'hdf5'
+    task.add_output_backend(hdf5)
+    task.add_output_backend(UnavailableOutput())
+    start = time.time()
+    task.loop()
+    # the collector loop is never blocked by the full elasticsearch queue
+    assert time.time() - start < 5
+    stats = task.get_stats()['outputs']
+    for output_queue in task.output_queues:
+        output_queue.close()
+    assert sum(len(counters_list) for counters_list in hdf5.pushed) == 80
+    assert stats['hdf5']['dropped_counters'] == 0
+    if spill:
+        assert stats['elasticsearch']['spilled_counters'] > 0
+        assert stats['elasticsearch']['dropped_counters'] == 0
+    else:
+        assert stats['elasticsearch']['dropped_counters'] > 0
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the queues of the output backends of the collector
+"""
+import os
+import threading
+import time
+
+import pytest
+
+from colmet.collector import output
+from colmet.collector.output import (OutputQueue, parse_queue_policies,
+                                     queue_policy)
+from colmet.common.exceptions import OutputBackendUnavailableError
+
+from .test_metrics_base import make_batch
+
+
+class SlowBackend(object):
+    '''Records the batches pushed, blocks or fails on demand'''
+
+    def __init__(self):
+        self.pushed = []
+        self.running = threading.Event()
+        self.running.set()
+        self.available = True
+
+    def get_backend_name(self):
+        return 'slow'
+
+    def push(self, counters_list):
+        self.running.wait()
+        if not self.available:
+            raise OutputBackendUnavailableError('slow', 'down')
+        self.pushed.append([(c.job_id, c.timestamp) for c in counters_list])
+
+
+def batch(timestamp):
+    counters_list = make_batch()
+    for counters in counters_list:
+        counters.timestamp = timestamp
+    return counters_list
+
+
+def keys(timestamp):
+    return [(c.job_id, timestamp) for c in make_batch()]
+
+
+def wait_pushed(output_queue, count):
+    for _ in range(500):
+        if output_queue.get_stats()['pushed_counters'] >= count:
+            return
+        time.sleep(0.01)
+
+
+def test_drop_oldest():
+    backend = SlowBackend()
+    backend.running.clear()
+    output_queue = OutputQueue(backend, 2, 'drop-oldest')
+    output_queue.put(batch(1))
+    # wait for the thread to be blocked pushing the first batch
+    while output_queue.get_stats()['queued_batches']:
+        pass
+    for timestamp in [2, 3, 4]:
+        output_queue.put(batch(timestamp))
+    stats = output_queue.get_stats()
+    assert stats['dropped_counters'] == 4
+    assert stats['lag'] > 0
+    backend.running.set()
+    output_queue.close()
+    assert backend.pushed == [keys(1), keys(3), keys(4)]
+    assert output_queue.get_stats()['pushed_counters'] == 12
+
+
+def test_spill_while_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr(output, 'MIN_RETRY_DELAY', 0.01)
+    backend = SlowBackend()
+    backend.available = False
+    output_queue = OutputQueue(backend, 1, 'spill', str(tmp_path))
+    for timestamp in [1, 2, 3]:
+        output_queue.put(batch(timestamp))
+    assert output_queue.get_stats()['spilled_counters'] >= 8
+    backend.available = True
+    wait_pushed(output_queue, 12)
+    output_queue.close()
+    assert backend.pushed == [keys(1), keys(2), keys(3)]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spill_on_close(tmp_path, monkeypatch):
+    monkeypatch.setattr(output, 'MIN_RETRY_DELAY', 0.01)
+    backend = SlowBackend()
+    backend.available = False
+    output_queue = OutputQueue(backend, 4, 'drop-oldest', str(tmp_path))
+    for timestamp in [1, 2]:
+        output_queue.put(batch(timestamp))
+    output_queue.close()
+    assert backend.pushed == []
+    assert len(os.listdir(str(tmp_path))) == 2
+
+    # the next collector pushes the spilled batches
+    backend = SlowBackend()
+    output_queue = OutputQueue(backend, 4, 'drop-oldest', str(tmp_path))
+    output_queue.put(batch(3))
+    output_queue.close()
+    assert backend.pushed == [keys(1), keys(2), keys(3)]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_queue_policies():
+    assert parse_queue_policies(None) == {}
+    assert parse_queue_policies('hdf5:block, elasticsearch:spill') == \
+        {'hdf5': 'block', 'elasticsearch': 'spill'}
+    with pytest.raises(ValueError):
+        parse_queue_policies('hdf5:drop')
+    # hdf5 blocks by default, the other backends do not delay it
+    assert queue_policy(None, 'hdf5', '/spill') == 'block'
+    assert queue_policy(None, 'elasticsearch') == 'drop-oldest'
+    assert queue_policy(None, 'elasticsearch', '/spill') == 'spill'
+    assert queue_policy('drop-oldest', 'hdf5') == 'drop-oldest'
+    assert queue_policy('spill,hdf5:block', 'hdf5') == 'block'
+    assert queue_policy('spill,hdf5:block', 'stdout') == 'spill'
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the sharded collector pipeline
+"""
+import time
+
+import pytest
+import zmq
+
+from colmet.collector.pipeline import (ShardedZMQInputBackend, batch_shards,
+                                       host_shard, job_shard,
+                                       worker_endpoints, worker_options)
+from colmet.common.batch import CounterBatch
+from colmet.common.delta import DeltaEncoder
+from colmet.common.metrics.base import BaseCounters
+
+from .test_compression import zmq_options
+from .test_metrics_base import make_batch
+
+
+@pytest.mark.parametrize('wire_format', [1, 2, 3])
+def test_get_hostname_from_raw(wire_format):
+    raw = BaseCounters.pack_from_list(make_batch(), wire_format,
+                                      DeltaEncoder())
+    assert BaseCounters.get_hostname_from_raw(raw) == 'node1'
+
+
+def test_job_shard():
+    counters_list = make_batch()
+    # the counters of the node are sharded by hostname
+    assert job_shard(counters_list[0], 4) == host_shard('node1', 4)
+    assert [job_shard(c, 2) for c in counters_list[2:]] == [1, 0]
+
+
+def test_batch_shards():
+    counters_list = make_batch()
+    # the records of the nodes are sharded by hostname
+    for (index, counters) in enumerate(counters_list):
+        counters.hostname = 'node%d' % index
+    raw = BaseCounters.pack_from_list(counters_list, 1).raw
+    shards = [batch_shards(batch, 3).tolist()
+              for batch in CounterBatch.from_raw(raw)]
+    assert shards == [[job_shard(c, 3) for c in counters_list[:2]],
+                      [job_shard(c, 3) for c in counters_list[2:]]]
+
+
+def test_worker_options(tmp_path):
+    endpoints = worker_endpoints(str(tmp_path), 2)
+    options = zmq_options(tmp_path, hdf5_filepath='/data/colmet.hdf5',
+                          output_spill_dir='/var/spool/colmet')
+    assert worker_options(options, 1, endpoints).hdf5_filepath == \
+        '/data/colmet.1.hdf5'
+    assert worker_options(options, 1, endpoints).zeromq_bind_uri == \
+        endpoints[1]
+    assert worker_options(options, 1, endpoints).output_spill_dir == \
+        '/var/spool/colmet/1'
+    options.hdf5_filepath = '/data/colmet'
+    assert worker_options(options, 0, endpoints).hdf5_filepath == \
+        '/data/colmet.0'
+    # the options of the receiver are unchanged
+    assert options.hdf5_filepath == '/data/colmet'
+
+
+def pull_all(backend, count, batches=False):
+    counters_list = []
+    for _ in range(100):
+        if batches:
+            for batch in backend.pull_batches():
+                counters_list.extend(batch.to_counters())
+        else:
+            counters_list.extend(backend.pull())
+        if len(counters_list) >= count:
+            break
+        time.sleep(0.01)
+    return counters_list
+
+
+@pytest.mark.parametrize('batches', [False, True])
+def test_sharded_input(tmp_path, batches):
+    '''Testing two workers exchanging the counters of their jobs'''
+    endpoints = worker_endpoints(str(tmp_path), 2)
+    options = zmq_options(tmp_path, hdf5_filepath=None,
+                          output_spill_dir=None)
+    workers = [ShardedZMQInputBackend(worker_options(options, index,
+                                                     endpoints),
+                                      index, endpoints)
+               for index in range(2)]
+    try:
+        for worker in workers:
+            worker.open()
+        # stands for the receiver sending the message of node1 to its worker
+        node_worker = host_shard('node1', 2)
+        sender = workers[1 - node_worker].peers[node_worker]
+        sender.send(BaseCounters.pack_from_list(make_batch(), 2))
+
+        kept = pull_all(workers[node_worker], 1, batches)
+        forwarded = pull_all(workers[1 - node_worker], 1, batches)
+        kept_jobs = sorted(c.job_id for c in kept)
+        forwarded_jobs = sorted(c.job_id for c in forwarded)
+        assert sorted(kept_jobs + forwarded_jobs) == [0, 0, 7, 8]
+        assert [job_shard(c, 2) for c in kept] == [node_worker] * len(kept)
+        assert [job_shard(c, 2) for c in forwarded] == \
+            [1 - node_worker] * len(forwarded)
+        assert workers[node_worker].get_stats()['forwarded_counters'] == \
+            len(forwarded)
+    finally:
+        for worker in workers:
+            worker.close()
+
+
+@pytest.mark.parametrize('batches', [False, True])
+def test_forward_to_full_worker(tmp_path, batches):
+    '''
+    Testing that a worker does not wait for a peer which does not read, and
+    forwards it all the counters once it reads
+    '''
+    endpoints = worker_endpoints(str(tmp_path), 2)
+    options = zmq_options(tmp_path, hdf5_filepath=None,
+                          output_spill_dir=None, zeromq_hwm=1)
+    node_worker = host_shard('node1', 2)
+    workers = [ShardedZMQInputBackend(worker_options(options, index,
+                                                     endpoints),
+                                      index, endpoints)
+               for index in range(2)]
+    worker = workers[node_worker]
+    peer = workers[1 - node_worker]
+    try:
+        # the peer of the worker is not even started
+        worker.open()
+        sender = worker.context.socket(zmq.PUSH)
+        sender.connect(endpoints[node_worker])
+        for _ in range(20):
+            sender.send(BaseCounters.pack_from_list(make_batch(), 2))
+        kept = []
+        for _ in range(100):
+            # one message at a time, each forwarded in its own message
+            if worker.wait(10):
+                if batches:
+                    for batch in worker.pull_batches(1):
+                        kept.extend(batch.to_counters())
+                else:
+                    kept.extend(worker.pull(1))
+            if worker.get_stats()['received_messages'] == 20:
+                break
+        sender.close()
+        stats = worker.get_stats()
+        assert stats['received_messages'] == 20
+        assert stats['pending_forwarded_counters'] > 0
+        assert len(kept) + stats['forwarded_counters'] + \
+            stats['pending_forwarded_counters'] == 20 * 4
+
+        peer.open()
+        forwarded = []
+        for _ in range(100):
+            worker.wait(10)
+            forwarded.extend(pull_all(peer, 0, batches))
+            if len(kept) + len(forwarded) == 20 * 4:
+                break
+        assert len(kept) + len(forwarded) == 20 * 4
+        assert worker.get_stats()['pending_forwarded_counters'] == 0
+        assert worker.get_stats()['forwarded_counters'] == len(forwarded)
+    finally:
+        for backend in workers:
+            if hasattr(backend, 'socket'):
+                backend.close()
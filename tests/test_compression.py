@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the compression of the messages sent to the collector
+"""
+import argparse
+import struct
+import time
+
+import pytest
+
+from colmet.common.backends.zeromq import ZMQInputBackend, ZMQOutputBackend
+from colmet.common.compression import (CODECS, MAX_MESSAGE_LENGTH,
+                                       Compressor, Decompressor,
+                                       train_dictionary)
+from colmet.common.metrics.base import BaseCounters
+
+from .test_metrics_base import make_batch
+
+
+@pytest.mark.parametrize('codec', sorted(set(CODECS) - set(['none'])))
+def test_compression(codec):
+    raw = BaseCounters.pack_from_list(make_batch())
+    (header, payload) = Compressor(codec, 6).compress(raw)
+    assert len(payload) * 5 < len(raw)
+    assert Decompressor().decompress(header, payload) == raw.raw
+
+
+def test_compression_dictionary():
+    samples = [BaseCounters.pack_from_list(make_batch(), 2)
+               for _ in range(10)]
+    dictionary = train_dictionary(samples)
+    assert 0 < len(dictionary) <= 32768
+
+    (header, payload) = Compressor('zlib', 9, dictionary).compress(samples[0])
+    (_, plain_payload) = Compressor('zlib', 9).compress(samples[0])
+    assert len(payload) < len(plain_payload)
+    assert Decompressor([dictionary]).decompress(header, payload) == \
+        samples[0]
+    with pytest.raises(ValueError):
+        Decompressor().decompress(header, payload)
+    with pytest.raises(ValueError):
+        Decompressor([dictionary]).decompress(header, payload[:-4])
+
+
+@pytest.mark.parametrize('codec', sorted(set(CODECS) - set(['none'])))
+def test_decompression_is_bounded(codec):
+    '''A payload inflating beyond the announced length is rejected'''
+    compressor = Compressor(codec, 6)
+    (header, _) = compressor.compress(b"\0" * 100)
+    (_, bomb) = compressor.compress(b"\0" * (64 * 1024 * 1024))
+    with pytest.raises(ValueError, match="more than 100 bytes"):
+        Decompressor().decompress(header, bomb)
+    (_, short) = compressor.compress(b"\0" * 99)
+    with pytest.raises(ValueError):
+        Decompressor().decompress(header, short)
+    (header, payload) = compressor.compress(b"\0" * 100)
+    with pytest.raises(ValueError, match="Truncated"):
+        Decompressor().decompress(header, payload[:len(payload) // 2])
+    # the announced length is bounded as well
+    huge = header[:-4] + struct.pack("<I", MAX_MESSAGE_LENGTH + 1)
+    with pytest.raises(ValueError):
+        Decompressor().decompress(huge, payload)
+
+
+def zmq_options(tmp_path, **kwargs):
+    uri = 'ipc://%s' % (tmp_path / 'colmet.sock')
+    options = argparse.Namespace(zeromq_uri=uri, zeromq_bind_uri=uri,
+                                 zeromq_hwm=1000, zeromq_linger=0,
+                                 wire_format=2, keyframe_interval=60,
+                                 zeromq_compression='none',
+                                 zeromq_compression_level=None,
+                                 zeromq_compression_dict=None,
+                                 zeromq_compression_dicts=[])
+    for (key, value) in kwargs.items():
+        setattr(options, key, value)
+    return options
+
+
+def test_compressed_and_plain_nodes(tmp_path):
+    '''Testing a collector receiving compressed and uncompressed messages'''
+    collector = ZMQInputBackend(zmq_options(tmp_path))
+    collector.open()
+    nodes = [ZMQOutputBackend(zmq_options(tmp_path)),
+             ZMQOutputBackend(zmq_options(tmp_path, zeromq_compression='zlib',
+                                          wire_format=1))]
+    try:
+        for node in nodes:
+            node.open()
+            node.push(make_batch())
+        counters_list = []
+        for _ in range(100):
+            counters_list.extend(collector.pull())
+            if len(counters_list) == 8:
+                break
+            time.sleep(0.01)
+        assert sorted(c.job_id for c in counters_list) == [0, 0, 0, 0,
+                                                          7, 7, 8, 8]
+    finally:
+        for node in nodes:
+            node.close()
+        collector.close()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the numpy batches of counters
+"""
+import numpy as np
+
+from colmet.common.batch import CounterBatch, get_dtype, merge_batches
+from colmet.common.metrics.base import BaseCounters, UInt64, Int64
+from colmet.common.metrics.cgroupstats import CgroupstatsCounters
+from colmet.common.metrics.infinibandstats import InfinibandstatsCounters
+
+from .test_metrics_base import make_batch
+
+
+class AccCounters(BaseCounters):
+    __metric_name__ = 'test_acc'
+    _counters = [
+        ('total', UInt64(), 'count', 'add', 'Total'),
+        ('lowest', Int64(), 'count', 'min', 'Lowest'),
+        ('highest', Int64(), 'count', 'max', 'Highest'),
+        ('last', Int64(), 'count', 'none', 'Last'),
+    ]
+
+
+def make_acc_counters(values):
+    counters_list = []
+    for (i, (total, lowest, highest, last)) in enumerate(values):
+        counters = AccCounters()
+        counters.hostname = 'node1'
+        counters.job_id = i
+        counters.timestamp = 10
+        counters.total = total
+        counters.lowest = lowest
+        counters.highest = highest
+        counters.last = last
+        counters_list.append(counters)
+    return counters_list
+
+
+def test_dtype():
+    assert get_dtype(CgroupstatsCounters).itemsize == \
+        CgroupstatsCounters._fmt_length
+    assert get_dtype(InfinibandstatsCounters)['involved_jobs'] == \
+        np.dtype('S8192')
+
+
+def test_from_raw():
+    '''Both wire formats give the same batches'''
+    counters_list = make_batch()
+    for wire_format in [1, 2]:
+        raw = BaseCounters.pack_from_list(counters_list, wire_format)
+        batches = CounterBatch.from_raw(raw)
+        assert [b.counters_class for b in batches] == \
+            [InfinibandstatsCounters, CgroupstatsCounters]
+        (infiniband, cgroup) = batches
+        assert list(infiniband['port']) == [b'mlx5_0/1', b'mlx5_1/1']
+        assert list(infiniband['involved_jobs']) == [b'[7, 8]'] * 2
+        assert list(infiniband['hostname']) == [b'node1'] * 2
+        assert list(cgroup['job_id']) == [7, 8]
+        assert list(cgroup['cpu_usage_usec']) == [7, 8]
+        assert list(cgroup['memory_current']) == [-1, -1]
+        assert cgroup.tobytes() == b"".join(
+            c.get_packed() for c in counters_list[2:])
+        assert cgroup.to_counters()[1].cpu_usage_usec == 8
+
+
+def test_accumulate():
+    '''The vectorized accumulation matches the one of the counters'''
+    first = make_acc_counters([(10, 5, 5, 1), (20, -3, 2, 2)])
+    second = make_acc_counters([(1, 7, 7, 3), (2, -4, 1, 4)])
+    batch = CounterBatch.from_counters(AccCounters, first)
+    other = CounterBatch.from_counters(AccCounters, second)
+
+    result = batch.accumulate(other)
+    for (i, counters) in enumerate(first):
+        expected = AccCounters()
+        counters.accumulate(second[i], expected)
+        for name in ['total', 'lowest', 'highest', 'last']:
+            assert result[name][i] == expected._get_counter(name)
+    assert list(result['job_id']) == [0, 1]
+
+    result = batch.delta(other)
+    assert list(result['total']) == [9, 18]
+    # self is unchanged
+    assert list(batch['total']) == [10, 20]
+
+
+def test_iter_jobs():
+    '''Testing the records of the batches merged then split by job'''
+    counters_list = make_acc_counters([(1, 1, 1, 1), (2, 2, 2, 2)] * 2)
+    counters_list[2].job_id = 1
+    counters_list[3].job_id = 0
+    raw = BaseCounters.pack_from_list(counters_list, 2)
+    (batch,) = merge_batches(CounterBatch.from_raw(raw) * 2)
+    assert len(batch) == 8
+    jobs = [(job_id, list(job_batch['total']))
+            for (job_id, job_batch) in batch.iter_jobs()]
+    assert jobs == [(0, [1, 2, 1, 2]), (1, [2, 1, 2, 1])]
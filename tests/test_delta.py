@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the delta encoded stream of the wire format 3
+"""
+import random
+
+import pytest
+
+from colmet.common.delta import (DeltaEncoder, DeltaDecoder, decode_uvarints,
+                                 write_uvarint, zigzag, unzigzag)
+from colmet.common.metrics.base import (BaseCounters, UInt64, Int64, UFloat,
+                                        String, compact_counters_class)
+
+from .test_metrics_base import make_batch
+
+
+class DeltaCounters(BaseCounters):
+    __metric_name__ = 'test_delta'
+    _counters = [
+        ('total', UInt64(), 'count', 'add', 'Total'),
+        ('level', Int64(), 'count', 'none', 'Level'),
+        ('load', UFloat(), 'n/a', 'none', 'Load'),
+        ('device', String(16), 'n/a', 'none', 'Device'),
+    ]
+
+
+def make_stream(length):
+    '''
+    Return the messages of a node: two jobs, with two records for the job 7
+    '''
+    messages = []
+    for step in range(length):
+        counters_list = []
+        for (job_id, device) in [(7, 'sda'), (7, 'sdb'), (8, 'sda')]:
+            counters = DeltaCounters()
+            counters.hostname = 'node1'
+            counters.job_id = job_id
+            counters.timestamp = 1000 + 5 * step
+            counters.total = 2 ** 64 - 1 - job_id if step == 3 \
+                else job_id * 1000 + step * 17
+            counters.level = -step if device == 'sda' else step
+            counters.load = 0.5 * step
+            counters.device = device
+            counters_list.append(counters)
+        messages.append(counters_list)
+    return messages
+
+
+def values(counters_list):
+    return [(c.hostname, c.job_id, c.timestamp, c.total, c.level, c.load,
+             c.device) for c in counters_list]
+
+
+def test_varints():
+    numbers = [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63, 2 ** 64 - 1] + \
+        [random.randint(0, 2 ** 64 - 1) for _ in range(100)]
+    payload = bytearray()
+    for number in numbers:
+        write_uvarint(payload, number)
+    assert decode_uvarints(bytes(payload)).tolist() == numbers
+
+    deltas = [0, 1, -1, 2 ** 63 - 1, -2 ** 63]
+    codes = decode_uvarints(bytes(
+        b"".join(_varint(zigzag(delta)) for delta in deltas)))
+    assert unzigzag(codes).view('<i8').tolist() == deltas
+
+    with pytest.raises(ValueError):
+        decode_uvarints(b"\x80")
+
+
+def _varint(number):
+    out = bytearray()
+    write_uvarint(out, number)
+    return bytes(out)
+
+
+def test_delta_stream():
+    '''Testing the round trip of a stream, with keyframes every 4 messages'''
+    encoder = DeltaEncoder(keyframe_interval=4)
+    decoder = DeltaDecoder()
+    for counters_list in make_stream(10):
+        raw = BaseCounters.pack_from_list(counters_list, 3, encoder)
+        unpacked = BaseCounters.unpack_to_list(raw, decoder=decoder)
+        assert values(unpacked) == values(counters_list)
+    assert decoder.dropped == 0
+
+    with pytest.raises(ValueError):
+        BaseCounters.unpack_to_list(raw)
+
+
+def test_delta_resync():
+    '''Testing the messages dropped until a keyframe after a missing one'''
+    encoder = DeltaEncoder(keyframe_interval=4)
+    decoder = DeltaDecoder()
+    stream = make_stream(9)
+    messages = [encoder.encode(counters_list) for counters_list in stream]
+    received = []
+    # the collector starts after the first message and misses the 6th one
+    for (step, raw) in enumerate(messages):
+        if step in (0, 5):
+            continue
+        unpacked = decoder.decode(raw)
+        if unpacked:
+            assert values(unpacked) == values(stream[step])
+            received.append(step)
+    assert received == [4, 8]
+    assert decoder.dropped == 5
+
+
+def test_delta_batches():
+    '''Testing the records decoded in batches, like the counters'''
+    from colmet.common.batch import CounterBatch
+    encoder = DeltaEncoder(keyframe_interval=4)
+    by_counters = DeltaDecoder()
+    by_batches = DeltaDecoder()
+    for (step, counters_list) in enumerate(make_stream(9)):
+        raw = encoder.encode(counters_list)
+        if step == 5:
+            continue
+        unpacked = by_counters.decode(raw)
+        batches = CounterBatch.from_raw(raw, by_batches)
+        assert values(c for batch in batches for c in batch.to_counters()) \
+            == values(unpacked)
+    assert by_batches.dropped == by_counters.dropped == 2
+
+
+def test_delta_size():
+    '''Testing the size of slowly growing counters against the version 2'''
+    encoder = DeltaEncoder()
+    stream = make_batch()
+    compact_class = compact_counters_class(type(stream[-1]))
+    size_v2 = size_v3 = 0
+    for step in range(20):
+        for counters in stream:
+            if counters.metric_backend == 'infinibandstats_default':
+                counters.portXmitData += 4096
+                counters.portXmitPkts += 2
+            else:
+                counters.cpu_usage_usec += 5000000
+            counters.timestamp += 5
+        size_v2 += len(BaseCounters.pack_from_list(stream, 2))
+        size_v3 += len(BaseCounters.pack_from_list(stream, 3, encoder))
+    assert size_v3 * 2 < size_v2
+
+    # the compact counters are encoded as the ones of their metric
+    encoder = DeltaEncoder()
+    decoder = DeltaDecoder()
+    decoder.decode(encoder.encode(stream))
+    compact = compact_class()
+    compact._counter_values = stream[-1]._counter_values
+    compact._header_values = stream[-1]._header_values
+    unpacked = decoder.decode(encoder.encode(stream[:-1] + [compact]))
+    assert unpacked[-1].cpu_usage_usec == stream[-1].cpu_usage_usec
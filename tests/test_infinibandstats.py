@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the reading of the InfiniBand counters from sysfs
+"""
+import argparse
+
+from colmet.node.backends.infinibandstats import InfinibandStats
+
+
+class StubSnapshot(object):
+    involved_jobs = '[42]'
+
+
+class StubRegistry(object):
+    snapshot = StubSnapshot()
+
+
+def write_counters(path, counters):
+    path.mkdir(parents=True, exist_ok=True)
+    for filename, value in counters.items():
+        (path / filename).write_text("%d\n" % value)
+
+
+def test_ports_are_read_from_sysfs(tmp_path):
+    port1 = tmp_path / 'mlx5_0' / 'ports' / '1'
+    write_counters(port1 / 'counters', {
+        'port_xmit_data': 2 ** 32 - 10, 'port_rcv_data': 100,
+        'port_xmit_packets': 1, 'port_rcv_packets': 2})
+    # a device providing only hw_counters, in bytes
+    port2 = tmp_path / 'efa_0' / 'ports' / '1'
+    write_counters(port2 / 'hw_counters', {
+        'tx_bytes': 4000, 'rx_bytes': 8000, 'tx_pkts': 3, 'rx_pkts': 4})
+
+    options = argparse.Namespace(omnipath=False)
+    infinibandstats = InfinibandStats(options, StubRegistry(),
+                                      sysfs_root=str(tmp_path))
+    counters = infinibandstats.get_stats()
+    assert [c.port for c in counters] == ['efa_0/1', 'mlx5_0/1']
+    assert counters[0].portXmitData == 4000
+    assert counters[1].portXmitData == 4 * (2 ** 32 - 10)
+    assert counters[1].involved_jobs == '[42]'
+
+    # the 32 bits counter wraps around
+    write_counters(port1 / 'counters', {'port_xmit_data': 5})
+    counters = infinibandstats.get_stats()
+    assert counters[1].portXmitData == 4 * (2 ** 32 + 5)
+    assert counters[1].portRcvData == 400
+    infinibandstats.close()
+
+
+def test_omnipath_multiplier(tmp_path):
+    write_counters(tmp_path / 'hfi1_0' / 'ports' / '1' / 'counters', {
+        'port_xmit_data': 10, 'port_rcv_data': 20})
+    options = argparse.Namespace(omnipath=True)
+    counters = InfinibandStats(options, StubRegistry(),
+                               sysfs_root=str(tmp_path)).get_stats()
+    assert counters[0].portXmitData == 80
+    assert counters[0].portRcvData == 160
+    assert counters[0].portXmitPkts == -1
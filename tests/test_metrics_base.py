@@ -2,6 +2,8 @@
 """
 Testing the base metric class
 """
+import gc
+
 import pytest
 
 from colmet.common.metrics.base import (UInt8, UInt16, UInt32, UInt64, String,
@@ -126,3 +128,211 @@ def test_failure_if_deriving_counters_from_multiple_class():
     with pytest.raises(TypeError):
         class MyCounters3(MyCounters, MyCounters2):
             pass
+
+
+def make_batch():
+    from colmet.common.metrics.infinibandstats import InfinibandstatsCounters
+    from colmet.common.metrics.cgroupstats import CgroupstatsCounters
+    counters_list = []
+    for port in ['mlx5_0/1', 'mlx5_1/1']:
+        counters = InfinibandstatsCounters(infinibandstats_buffer={
+            'portXmitData': 4000, 'portRcvData': 8000, 'portXmitPkts': 3,
+            'portRcvPkts': 4, 'port': port, 'involved_jobs': '[7, 8]'})
+        counters.job_id = 0
+        counters.timestamp = 1000
+        counters.hostname = 'node1'
+        counters_list.append(counters)
+    for job_id in [7, 8]:
+        counters = CgroupstatsCounters(cgroupstats_buffer={'cpu_usage_usec': job_id})
+        counters.job_id = job_id
+        counters.timestamp = 1001
+        counters.hostname = 'node1'
+        counters_list.append(counters)
+    return counters_list
+
+
+def test_wire_format_v2():
+    '''Testing the version 2 batches and the detection of the format'''
+    counters_list = make_batch()
+    raw_v1 = BaseCounters.pack_from_list(counters_list)
+    raw_v2 = BaseCounters.pack_from_list(counters_list, 2)
+    assert len(raw_v2) * 10 < len(raw_v1)
+
+    for raw in [raw_v1.raw, raw_v2]:
+        unpacked = BaseCounters.unpack_to_list(raw)
+        assert [c.job_id for c in unpacked] == [0, 0, 7, 8]
+        assert [c.hostname for c in unpacked] == ['node1'] * 4
+        assert [c.port for c in unpacked[:2]] == ['mlx5_0/1', 'mlx5_1/1']
+        assert unpacked[1].involved_jobs == '[7, 8]'
+        assert unpacked[1].portRcvData == 8000
+        assert unpacked[3].metric_backend == 'cgroupstats_default'
+        assert unpacked[3].cpu_usage_usec == 8
+        assert unpacked[3].memory_current == -1
+        assert unpacked[3].timestamp == 1001
+
+
+def test_wire_format_v2_one_host():
+    counters_list = make_batch()
+    counters_list[-1].hostname = 'node2'
+    with pytest.raises(ValueError):
+        BaseCounters.pack_from_list(counters_list, 2)
+
+
+def test_unpack_views():
+    '''The version 1 counters are read only views on the received message'''
+    counters_list = make_batch()
+    raw = bytes(BaseCounters.pack_from_list(counters_list))
+    unpacked = BaseCounters.unpack_to_list(memoryview(raw))
+    assert unpacked[0]._view and unpacked[0]._packed
+    assert unpacked[0].port == 'mlx5_0/1'
+    assert unpacked[3].cpu_usage_usec == 8
+    assert bytes(unpacked[2].get_packed()) == counters_list[2].get_packed()
+
+    # a modification unpacks the counters, the message is left untouched
+    unpacked[3].cpu_usage_usec = 12
+    assert unpacked[3].cpu_usage_usec == 12
+    assert not unpacked[3]._view and unpacked[3]._buf is None
+    assert BaseCounters.unpack_to_list(raw)[3].cpu_usage_usec == 8
+
+
+def test_compact_counters():
+    '''The compact counters behave as the counters they derive from'''
+    from colmet.common.metrics import get_counters_class
+    from colmet.common.metrics.base import compact_counters_class
+    from colmet.common.metrics.cgroupstats import CgroupstatsCounters
+    CompactCgroupstats = compact_counters_class(CgroupstatsCounters)
+    assert compact_counters_class(CgroupstatsCounters) is CompactCgroupstats
+    assert get_counters_class('cgroupstats_default') is CgroupstatsCounters
+
+    compact = CompactCgroupstats(cgroupstats_buffer={'cpu_usage_usec': 10})
+    assert not hasattr(compact, '__dict__')
+    compact.job_id = 7
+    compact.timestamp = 1
+    compact.hostname = 'node1'
+    # the values are not in other objects tracked by the garbage collector
+    assert [o for o in gc.get_referents(compact) if gc.is_tracked(o)] == \
+        [CompactCgroupstats]
+    # out of the range of the array
+    compact.memory_peak = 2 ** 64
+    assert compact.memory_peak == 2 ** 64
+    compact.memory_peak = 2 ** 62
+    assert compact.memory_peak == 2 ** 62
+    assert compact.memory_current == -1
+    assert compact.metric_backend == 'cgroupstats_default'
+
+    regular = CgroupstatsCounters(cgroupstats_buffer={'cpu_usage_usec': 10})
+    regular.job_id = 7
+    regular.timestamp = 1
+    regular.hostname = 'node1'
+    regular.memory_peak = 2 ** 62
+    assert compact.get_packed() == regular.get_packed()
+    assert BaseCounters.unpack_to_list(
+        BaseCounters.pack_from_list([compact], 2))[0].memory_peak == 2 ** 62
+
+    total = CompactCgroupstats()
+    assert total.cpu_usage_usec is None
+    compact.accumulate(total, total)
+    assert total.cpu_usage_usec == 10
+    compact.delta(total, total)
+    assert total.cpu_usage_usec == 10
+    # with regular counters ('none' keeps the value of self)
+    regular.cpu_usage_usec = 30
+    regular.accumulate(compact, total)
+    assert total.cpu_usage_usec == 30
+    compact.accumulate(regular, regular)
+    assert regular.cpu_usage_usec == 10
+
+
+def test_subset_counters():
+    '''The subsets of counters are described in the batches'''
+    from colmet.common.delta import DeltaEncoder, DeltaDecoder
+    from colmet.common.metrics import get_counters_class
+    from colmet.common.metrics.base import BatchSchema, subset_counters_class
+    from colmet.common.metrics.taskstats import TaskstatsCounters
+    names = ['coremem', 'ac_utime', 'ac_stime']
+    Subset = subset_counters_class(TaskstatsCounters, names)
+    assert subset_counters_class(TaskstatsCounters, names[::-1]) is Subset
+    assert Subset.__metric_name__ == 'taskstats_default'
+    assert get_counters_class('taskstats_default') is TaskstatsCounters
+    assert sorted(Subset._counter_definitions) == sorted(names)
+    with pytest.raises(ValueError):
+        subset_counters_class(TaskstatsCounters, ['coremem', 'unknown'])
+
+    counters_list = make_batch()
+    for job_id in [7, 8]:
+        counters = Subset.from_values(
+            {'metric_backend': 'taskstats_default', 'hostname': 'node1',
+             'job_id': job_id, 'timestamp': 1002},
+            {'coremem': 3 * job_id, 'ac_utime': job_id, 'ac_stime': 1})
+        counters_list.append(counters)
+    full = TaskstatsCounters()
+    full.fill_missing()
+    full.hostname = 'node1'
+    full.job_id = 9
+    full.timestamp = 1002
+    assert BatchSchema.get(Subset).record.size * 5 < \
+        BatchSchema.get(TaskstatsCounters).record.size
+    counters_list.append(full)
+
+    decoder = DeltaDecoder()
+    for raw in [BaseCounters.pack_from_list(counters_list, 2),
+                BaseCounters.pack_from_list(counters_list, 3, DeltaEncoder())]:
+        unpacked = BaseCounters.unpack_to_list(raw, decoder=decoder)
+        assert [c.job_id for c in unpacked] == [0, 0, 7, 8, 7, 8, 9]
+        assert type(unpacked[4]) is Subset
+        assert unpacked[5].coremem == 24
+        assert unpacked[5].timestamp == 1002
+        assert type(unpacked[6]) is TaskstatsCounters
+    with pytest.raises(ValueError):
+        BaseCounters.pack_from_list(counters_list)
+
+
+def test_missing_counters():
+    '''Testing the completeness check and the zero filling'''
+    from colmet.common.metrics.base import compact_counters_class
+    from colmet.common.metrics.infinibandstats import InfinibandstatsCounters
+    for counters_class in [InfinibandstatsCounters,
+                           compact_counters_class(InfinibandstatsCounters)]:
+        counters = counters_class()
+        assert not counters.is_complete()
+        counters.portXmitData = 12
+        counters.fill_missing()
+        assert counters.is_complete()
+        assert counters.portXmitData == 12
+        assert counters.portRcvData == 0
+        assert counters.port == ''
+
+
+def test_counters_registry(monkeypatch):
+    '''The counters classes are imported on first use'''
+    import colmet.common.metrics as metrics
+    for (metric, path) in metrics.COUNTERS_CLASSES.items():
+        assert metrics.get_counters_class(metric).__metric_name__ == metric
+
+    # the classes of other packages are declared with entry points
+    class OtherCounters(BaseCounters):
+        __metric_name__ = 'other_default'
+
+    monkeypatch.setattr(metrics, 'iter_entry_points', lambda group: [
+        ('other_default', lambda: OtherCounters)])
+    monkeypatch.setattr(metrics, 'counters_registry', {})
+    assert metrics.get_counters_class('other_default') is OtherCounters
+    with pytest.raises(metrics.UnableToFindCounterClassError):
+        metrics.get_counters_class('unknown_default')
+
+
+def test_missing_metrics_are_cached(monkeypatch):
+    '''The entry points are scanned once per unknown metric'''
+    import colmet.common.metrics as metrics
+    scans = []
+    monkeypatch.setattr(metrics, 'iter_entry_points',
+                        lambda group: scans.append(group) or [])
+    monkeypatch.setattr(metrics, 'missing_metrics', set())
+    for _ in range(3):
+        with pytest.raises(metrics.UnableToFindCounterClassError):
+            metrics.get_counters_class('unknown_default')
+    assert len(scans) == 1
+    metrics.clear_missing_metrics()
+    with pytest.raises(metrics.UnableToFindCounterClassError):
+        metrics.get_counters_class('unknown_default')
+    assert len(scans) == 2
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the checks of the node on the pulled counters
+"""
+import argparse
+
+import pytest
+
+from colmet.common.metrics.infinibandstats import InfinibandstatsCounters
+from colmet.common.exceptions import CountersSubsetError
+from colmet.node.main import Task, invalid_counters_policy, counters_subset
+
+
+def make_counters(complete):
+    counters = InfinibandstatsCounters()
+    if complete:
+        counters.fill_missing()
+    return counters
+
+
+def test_invalid_counters_policy():
+    assert invalid_counters_policy('nvidiastats:zero-fill') == \
+        ('nvidiastats', 'zero-fill')
+    with pytest.raises(ValueError):
+        invalid_counters_policy('nvidiastats:ignore')
+
+
+def test_check_counters():
+    task = argparse.Namespace(
+        invalid_counters_policies={'infinibandstats': 'zero-fill'})
+    counters_list = [make_counters(True), make_counters(False), None]
+
+    checked = Task.check_counters(task, 'lustrestats', counters_list)
+    assert checked == counters_list[:1]
+
+    checked = Task.check_counters(task, 'infinibandstats', counters_list)
+    assert checked == counters_list[:2]
+    assert checked[1].is_complete()
+
+
+def test_input_backends_registry():
+    from colmet.node.backends import INPUT_BACKENDS, get_input_backend_class
+    for name in INPUT_BACKENDS:
+        assert get_input_backend_class(name).__backend_name__ == name
+    with pytest.raises(ValueError):
+        get_input_backend_class('unknown')
+
+
+def test_counters_subset():
+    assert counters_subset('infinibandstats:portXmitData,portRcvData') == \
+        ('infinibandstats', ['portXmitData', 'portRcvData'])
+    with pytest.raises(ValueError):
+        counters_subset('infinibandstats')
+
+
+def test_select_counters():
+    class Backend(object):
+        def get_backend_name(self):
+            return 'infinibandstats'
+
+        def get_counters_class(self):
+            return InfinibandstatsCounters
+
+    task = argparse.Namespace(
+        input_backends=[Backend()],
+        options=argparse.Namespace(
+            counters_subsets=[('infinibandstats', ['portXmitData'])],
+            wire_format=2))
+    task.counters_subsets = Task.get_counters_subsets(task)
+    counters = make_counters(True)
+    counters.hostname = 'node1'
+    counters.job_id = 0
+    counters.timestamp = 1000
+    counters.portXmitData = 12
+    selected = Task.select_counters(task, 'infinibandstats', [counters])
+    assert list(selected[0]._counter_definitions) == ['portXmitData']
+    assert selected[0].portXmitData == 12
+    assert selected[0].metric_backend == 'infinibandstats_default'
+    assert Task.select_counters(task, 'procstats', [counters]) == [counters]
+
+    task.options.wire_format = 1
+    with pytest.raises(CountersSubsetError):
+        Task.get_counters_subsets(task)
+    task.options.wire_format = 2
+    task.options.counters_subsets = [('lustrestats', ['read_bytes'])]
+    with pytest.raises(CountersSubsetError):
+        Task.get_counters_subsets(task)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the job registry of the node
+"""
+import argparse
+
+import pytest
+
+from colmet.node.registry import JobRegistry
+
+
+def test_snapshots_are_immutable(tmp_path):
+    for name in ['user_42', 'user_7', 'other']:
+        (tmp_path / name).mkdir()
+    options = argparse.Namespace(cpuset_rootpath=[str(tmp_path)],
+                                 regex_job_id=['_(\\d+)$'])
+    registry = JobRegistry(options)
+    assert registry.snapshot.job_ids == set()
+
+    snapshot = registry.update()
+    assert snapshot.job_ids == set(['42', '7'])
+    assert snapshot.involved_jobs == '[7, 42]'
+    assert snapshot.job_path('42') == str(tmp_path) + "/user_42"
+    with pytest.raises(TypeError):
+        snapshot.filenames['43'] = 'user_43'
+    with pytest.raises(AttributeError):
+        snapshot.involved_jobs = '[]'
+
+    (tmp_path / 'user_7').rmdir()
+    assert registry.update().job_ids == set(['42'])
+    # the previous snapshot is left untouched
+    assert snapshot.job_ids == set(['42', '7'])
+
+
+def test_task_lists_are_read_once_per_cycle(tmp_path):
+    (tmp_path / 'user_42').mkdir()
+    tasks = tmp_path / 'user_42' / 'tasks'
+    tasks.write_text("1\n2\n")
+    options = argparse.Namespace(cpuset_rootpath=[str(tmp_path)],
+                                 regex_job_id=['_(\\d+)$'])
+    registry = JobRegistry(options)
+    job_path = registry.update().job_path('42')
+
+    task_list = registry.get_tasks(job_path)
+    assert task_list.tids == [1, 2]
+    assert task_list.added == set([1, 2])
+
+    tasks.write_text("2\n3\n")
+    assert registry.get_tasks(job_path).tids is task_list.tids
+    registry.new_cycle()
+    task_list = registry.get_tasks(job_path, tracked=[1, 2])
+    assert task_list.tids == [2, 3]
+    assert task_list.added == set([3])
+    assert task_list.removed == set([1])
+
+    # the task list of an ended job is closed
+    tasks.unlink()
+    (tmp_path / 'user_42').rmdir()
+    registry.update()
+    assert registry.task_lists == {}
+
+
+def test_task_lists_diff_per_backend(tmp_path):
+    '''A backend skipping cycles sees the tasks changed meanwhile'''
+    (tmp_path / 'user_42').mkdir()
+    tasks = tmp_path / 'user_42' / 'tasks'
+    options = argparse.Namespace(cpuset_rootpath=[str(tmp_path)],
+                                 regex_job_id=['_(\\d+)$'])
+    registry = JobRegistry(options)
+    job_path = registry.update().job_path('42')
+    slow = set()
+    fast = set()
+    for (cycle, tids) in enumerate([[1, 2], [2, 3], [3, 4]]):
+        tasks.write_text("\n".join(map(str, tids)))
+        registry.new_cycle()
+        task_list = registry.get_tasks(job_path, tracked=fast)
+        fast = fast.union(task_list.added).difference(task_list.removed)
+        if cycle != 1:
+            task_list = registry.get_tasks(job_path, tracked=slow)
+            slow = slow.union(task_list.added).difference(task_list.removed)
+    assert task_list.added == set([3, 4])
+    assert task_list.removed == set([1, 2])
+    assert fast == slow == set([3, 4])
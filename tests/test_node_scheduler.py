@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the concurrent pulling of the input backends
+"""
+import threading
+
+from colmet.node.scheduler import BackendScheduler
+
+
+class FakeBackend(object):
+    def __init__(self, name, event=None):
+        self.name = name
+        self.event = event
+        self.pulls = 0
+
+    def get_backend_name(self):
+        return self.name
+
+    def pull(self):
+        if self.event is not None:
+            self.event.wait()
+        self.pulls += 1
+        return [self.name]
+
+
+def test_late_backend_is_pushed_with_next_cycle():
+    release = threading.Event()
+    fast = FakeBackend('fast')
+    slow = FakeBackend('slow', release)
+    scheduler = BackendScheduler([slow, fast], deadline=0.05,
+                                 default_period=1, policy='catch-up')
+    start = scheduler.next_wakeup()
+
+    results = scheduler.pull(start)
+    assert [(b.name, c) for b, c in results] == [('fast', ['fast'])]
+    assert 'slow' not in scheduler.timings
+
+    # the slow backend is not pulled again while it is running
+    release.set()
+    results = scheduler.pull(start + 1)
+    assert sorted(c[0] for b, c in results) == ['fast', 'slow']
+    assert slow.pulls == 1
+    assert fast.pulls == 2
+    assert set(scheduler.timings) == set(['fast', 'slow'])
+    # catching up the cycle missed by the slow backend
+    assert scheduler.next_wakeup(start + 1) == start + 1
+    scheduler.close()
+
+
+def test_failing_backend_does_not_stop_the_others():
+    class FailingBackend(FakeBackend):
+        def pull(self):
+            raise IOError("device is gone")
+
+    scheduler = BackendScheduler([FailingBackend('bad'), FakeBackend('ok')],
+                                 deadline=1)
+    results = scheduler.pull()
+    assert [b.name for b, c in results] == ['ok']
+    scheduler.close()
+
+
+def test_backend_periods_and_skipped_cycles():
+    fast = FakeBackend('fast')
+    slow = FakeBackend('slow')
+    scheduler = BackendScheduler([fast, slow], deadline=1,
+                                 periods={'fast': 1}, default_period=10)
+    start = scheduler.next_due[slow]
+    scheduler.next_due[fast] = start
+
+    for tick in range(10):
+        scheduler.pull(start + tick)
+    assert fast.pulls == 10
+    assert slow.pulls == 1
+    assert scheduler.next_wakeup(start + 9.5) == start + 10
+
+    # the node wakes up 3.5 seconds late
+    scheduler.pull(start + 13.5)
+    assert scheduler.skipped == {'fast': 3, 'slow': 0}
+    assert scheduler.next_due[fast] == start + 14
+    assert slow.pulls == 2
+    scheduler.close()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the GPU samplers of nvidiastats
+"""
+import argparse
+import sys
+import time
+
+from colmet.common.job import TaskList
+from colmet.node.backends.nvidiastats import (nvidiaStats, NvmlSampler,
+                                              NvidiaSmiSampler,
+                                              NVML_ERROR_INSUFFICIENT_SIZE)
+
+STUB_NVIDIA_SMI = '''#!%s
+import sys, time
+loop = int(sys.argv[-1].split('=')[1]) / 1000.
+while True:
+    if sys.argv[1].startswith('--query-compute-apps'):
+        print("pid, gpu_uuid")
+        print("12, GPU-a")
+        print("13, GPU-b")
+    else:
+        print("uuid, power.draw [W], temperature.gpu, utilization.gpu [%%], "
+              "utilization.memory [%%], memory.total [MiB], "
+              "memory.free [MiB], memory.used [MiB]")
+        print("GPU-a, 60.50, 40, 10, 5, 16000, 15000, 1000")
+        print("GPU-b, [N/A], 50, 20, 6, 16000, 14000, 2000")
+    sys.stdout.flush()
+    time.sleep(loop)
+''' % sys.executable
+
+
+class StubNvml(object):
+    '''Two GPUs, the process 12 runs on the first one'''
+
+    def nvmlInit_v2(self):
+        return 0
+
+    def nvmlShutdown(self):
+        return 0
+
+    def nvmlDeviceGetCount_v2(self, count):
+        count._obj.value = 2
+        return 0
+
+    def nvmlDeviceGetHandleByIndex_v2(self, index, handle):
+        handle._obj.value = index + 1
+        return 0
+
+    def nvmlDeviceGetUUID(self, handle, uuid, size):
+        uuid.value = b"GPU-" + (b"a" if handle.value == 1 else b"b")
+        return 0
+
+    def nvmlDeviceGetComputeRunningProcesses_v3(self, handle, count, infos):
+        pids = [12] if handle.value == 1 else []
+        if infos is None or count._obj.value < len(pids):
+            count._obj.value = len(pids)
+            return NVML_ERROR_INSUFFICIENT_SIZE if pids else 0
+        for i, pid in enumerate(pids):
+            infos[i].pid = pid
+        count._obj.value = len(pids)
+        return 0
+
+    def nvmlDeviceGetPowerUsage(self, handle, power):
+        power._obj.value = 60500
+        return 0
+
+    def nvmlDeviceGetTemperature(self, handle, sensor, temperature):
+        temperature._obj.value = 40
+        return 0
+
+    def nvmlDeviceGetUtilizationRates(self, handle, utilization):
+        utilization._obj.gpu = 10
+        utilization._obj.memory = 5
+        return 0
+
+    def nvmlDeviceGetMemoryInfo(self, handle, memory):
+        memory._obj.total = 16000 << 20
+        memory._obj.free = 15000 << 20
+        memory._obj.used = 1000 << 20
+        return 0
+
+
+class StubRegistry(object):
+    def get_tasks(self, cgroup_path, filename='tasks'):
+        return TaskList([11, 12], set(), set())
+
+
+def test_nvml_sampler():
+    sampler = NvmlSampler(StubNvml())
+    snapshot = sampler.sample()
+    assert snapshot.pid_gpus == {12: set(['GPU-a'])}
+    assert snapshot.gpu_metrics['GPU-a']['power'] == 60
+    assert snapshot.gpu_metrics['GPU-b']['memory-used'] == 1000
+
+    options = argparse.Namespace(cpuset_rootpath=['/oar'])
+    counters = nvidiaStats(options, StubRegistry(), sampler).get_stats('u_1')
+    assert counters.power == 60
+    assert counters.temperature == 40
+    assert counters._get_counter('memory-free') == 15000
+
+
+def test_nvidia_smi_sampler(tmp_path):
+    stub = tmp_path / 'nvidia-smi'
+    stub.write_text(STUB_NVIDIA_SMI)
+    stub.chmod(0o755)
+    sampler = NvidiaSmiSampler(str(stub), 20)
+    try:
+        for _ in range(100):
+            snapshot = sampler.sample()
+            if snapshot.pid_gpus and snapshot.gpu_metrics:
+                break
+            time.sleep(0.05)
+        assert snapshot.pid_gpus == {12: set(['GPU-a']), 13: set(['GPU-b'])}
+        assert snapshot.gpu_metrics['GPU-a']['power'] == 60
+        assert snapshot.gpu_metrics['GPU-b']['power'] == -1
+        assert snapshot.gpu_metrics['GPU-b']['memory-used'] == 2000
+    finally:
+        sampler.close()
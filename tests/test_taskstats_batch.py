@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the pipelined taskstats queries
+"""
+import argparse
+import errno
+import os
+import struct
+import time
+
+from colmet.node.backends.genetlink.netlink import (Message, Attr, U32Attr,
+                                                    Nested, parse_attributes)
+from colmet.node.backends.genetlink.genetlink import (GENL_ID_CTRL,
+                                                      CTRL_ATTR_FAMILY_ID)
+from colmet.node.backends.taskstats import (TaskStatsNetlink,
+                                            TASKSTATS_CMD_ATTR_PID,
+                                            TASKSTATS_CMD_ATTR_TGID,
+                                            TASKSTATS_TYPE_PID,
+                                            TASKSTATS_TYPE_TGID,
+                                            TASKSTATS_TYPE_STATS,
+                                            TASKSTATS_TYPE_AGGR_PID,
+                                            TASKSTATS_TYPE_AGGR_TGID)
+
+
+class StubDescriptor(object):
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        pass
+
+
+class StubConnection(object):
+    '''Answer the requests in reverse order, tids >= 100 do not exist'''
+    def __init__(self):
+        self.descriptor = StubDescriptor()
+        self.pid = 1
+        self.replies = []
+        self.max_in_flight = 0
+        self._seq = 0
+
+    def seq(self):
+        self._seq += 1
+        return self._seq
+
+    def send(self, data):
+        _, msg_type, _, seq, _ = struct.unpack("IHHII", data[:16])
+        hdr = struct.pack("BBxx", 1, 1)
+        if msg_type == GENL_ID_CTRL:
+            self.replies.append((seq, hdr + Attr(CTRL_ATTR_FAMILY_ID, "H",
+                                                 0x17)._dump()))
+            return
+        attrs = parse_attributes(data[20:])
+        if TASKSTATS_CMD_ATTR_TGID in attrs:
+            # like the kernel, no CPU times nor I/O for the thread groups
+            stats = bytearray(400)
+            struct.pack_into('H', stats, 0, 8)
+            tgid = attrs[TASKSTATS_CMD_ATTR_TGID].u32()
+            self.replies.append((seq, hdr + Nested(TASKSTATS_TYPE_AGGR_TGID, [
+                U32Attr(TASKSTATS_TYPE_TGID, tgid),
+                Attr(TASKSTATS_TYPE_STATS, bytes(stats))])._dump()))
+            return
+        tid = attrs[TASKSTATS_CMD_ATTR_PID].u32()
+        if tid >= 100:
+            self.replies.append((seq, None))
+        else:
+            stats = bytearray(400)
+            struct.pack_into('H', stats, 0, 8)
+            struct.pack_into('Q', stats, 152, tid)  # ac_utime
+            self.replies.append((seq, hdr + Nested(TASKSTATS_TYPE_AGGR_PID, [
+                U32Attr(TASKSTATS_TYPE_PID, tid),
+                Attr(TASKSTATS_TYPE_STATS, bytes(stats))])._dump()))
+        self.max_in_flight = max(self.max_in_flight, len(self.replies))
+
+    def recv(self):
+        seq, payload = self.replies.pop()
+        if payload is None:
+            err = OSError("Netlink error: No such process (3)")
+            err.errno = errno.ESRCH
+            err.seq = seq
+            raise err
+        msg = Message(0x17, 0, seq, payload)
+        msg.pid = self.pid
+        return msg
+
+
+def test_batch_replies_are_matched_by_sequence_number():
+    connection = StubConnection()
+    options = argparse.Namespace(taskstats_batch_window=4)
+    nl = TaskStatsNetlink(options, connection=connection)
+    tids = [1, 2, 100, 3, 4, 5, 101, 6]
+    results = nl.get_tasks_stats([nl.build_request(tid) for tid in tids])
+
+    assert len(results) == len(tids)
+    for tid, counters in zip(tids, results):
+        if tid >= 100:
+            assert counters is None
+        else:
+            assert counters.ac_utime == tid
+    assert connection.max_in_flight <= 4
+
+
+def test_thread_group_stats_are_read_from_proc():
+    '''The CPU times of a thread group come from /proc/<tgid>/stat'''
+    # spend more than a clock tick of user CPU time
+    start = time.process_time()
+    while time.process_time() - start < 0.05:
+        pass
+    nl = TaskStatsNetlink(argparse.Namespace(), connection=StubConnection())
+    (counters,) = nl.get_tasks_stats([nl.build_request(os.getpid(),
+                                                       tgid=True)])
+    assert counters.ac_utime > 0
+    assert counters.ac_btime > 0
+    assert counters.ac_utimescaled == counters.ac_utime
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the columnar taskstats of the cgroups
+"""
+from colmet.common.job import CGroupInfo, FORGOTTEN_TASK_CYCLES
+
+from .test_taskstats_exit import FakeTaskstatsBackend, make_stats
+
+
+def test_columns_reduction(tmp_path):
+    backend = FakeTaskstatsBackend()
+    cgroup = CGroupInfo(str(tmp_path), backend)
+    assert cgroup.task_columns is not None
+
+    def sample(utimes):
+        backend.utimes = utimes
+        (tmp_path / 'tasks').write_text(
+            "\n".join(str(tid) for tid in utimes))
+        cgroup.update_stats(0, 42, 'localhost')
+
+    # baseline of the tasks running before the first update
+    sample({3: 10, 1: 5})
+    assert cgroup.stats_delta.ac_utime == 0
+    assert cgroup.stats_delta.ac_etime == 30
+    # the task 2 started since, everything it consumed is accounted
+    sample({1: 20, 3: 12, 2: 4})
+    assert cgroup.stats_delta.ac_utime == 15 + 2 + 4
+    assert cgroup.stats_total.ac_utime == 21
+    assert list(cgroup.task_columns.tids) == [1, 2, 3]
+
+    # the task 3 vanishes without an exit notification
+    sample({1: 21, 2: 4})
+    assert cgroup.stats_delta.ac_utime == 1
+    assert list(cgroup.task_columns.tids) == [1, 2]
+
+
+def test_columns_exit_after_forget(tmp_path):
+    '''The exit of a task no more sampled only accounts the remainder'''
+    backend = FakeTaskstatsBackend()
+    cgroup = CGroupInfo(str(tmp_path), backend)
+
+    def sample(utimes, tids=None):
+        backend.utimes = utimes
+        (tmp_path / 'tasks').write_text(
+            "\n".join(str(tid) for tid in (tids or utimes)))
+        cgroup.update_stats(0, 42, 'localhost')
+
+    sample({1: 10, 2: 5})
+    sample({1: 20, 2: 8})
+    assert cgroup.stats_total.ac_utime == 20 - 10 + 8 - 5
+
+    # the task 2 is still listed but has exited before answering
+    sample({1: 25}, [1, 2])
+    cgroup.account_exit(2, make_stats(9))
+    # the task 1 has left the cgroup before its exit is notified
+    sample({}, [])
+    cgroup.account_exit(1, make_stats(26))
+    sample({}, [])
+    assert cgroup.stats_total.ac_utime == 26 - 10 + 9 - 5
+    assert backend.task_index == {}
+    assert cgroup.forgotten == {}
+
+    # the task 3 leaves without an exit notification
+    sample({3: 1})
+    sample({}, [])
+    assert set(backend.task_index) == set([3])
+    for _ in range(FORGOTTEN_TASK_CYCLES):
+        sample({}, [])
+    assert backend.task_index == {}
+    assert cgroup.forgotten == {}
+
+
+def test_release_tasks(tmp_path):
+    '''The tasks of an ended job are removed from the task index'''
+    backend = FakeTaskstatsBackend()
+    cgroup = CGroupInfo(str(tmp_path), backend)
+    backend.utimes = {1: 10, 2: 5}
+    (tmp_path / 'tasks').write_text("1\n2")
+    cgroup.update_stats(0, 42, 'localhost')
+    backend.task_index[3] = object()
+    cgroup.release_tasks()
+    assert list(backend.task_index) == [3]
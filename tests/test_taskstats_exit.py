@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Testing the accounting of the exited tasks of a cgroup
+"""
+import argparse
+import struct
+
+from colmet.common.job import CGroupInfo
+from colmet.common.metrics.taskstats import TaskstatsCounters
+from colmet.node.backends.taskstats import (TaskstatsColumns,
+                                            taskstats_payload)
+
+
+def make_stats(utime):
+    taskstats_buffer = bytearray(400)
+    struct.pack_into('H', taskstats_buffer, 0, 8)
+    struct.pack_into('Q', taskstats_buffer, 152, utime)  # ac_utime
+    return TaskstatsCounters(taskstats_buffer=bytes(taskstats_buffer))
+
+
+def make_payload(utime, etime):
+    taskstats_buffer = bytearray(400)
+    struct.pack_into('H', taskstats_buffer, 0, 8)
+    struct.pack_into('Q', taskstats_buffer, 144, etime)  # ac_etime (max)
+    struct.pack_into('Q', taskstats_buffer, 152, utime)  # ac_utime (add)
+    return taskstats_payload(bytes(taskstats_buffer))
+
+
+class FakeTaskstatsBackend(object):
+    options = argparse.Namespace()
+
+    def __init__(self):
+        self.task_index = {}
+        self.utimes = {}
+
+    def get_counters_class(self):
+        return TaskstatsCounters
+
+    def build_request(self, tid, tgid=False):
+        return tid
+
+    def get_tasks_payloads(self, requests):
+        return [make_payload(self.utimes[tid], 10 * tid)
+                if tid in self.utimes else None for tid in requests]
+
+    def create_task_columns(self, tgid=False):
+        return TaskstatsColumns(self, tgid)
+
+
+def test_exited_tasks_are_accounted_once(tmp_path):
+    backend = FakeTaskstatsBackend()
+    cgroup = CGroupInfo(str(tmp_path), backend)
+
+    def sample(utimes):
+        backend.utimes = utimes
+        (tmp_path / 'tasks').write_text(
+            "\n".join(str(tid) for tid in utimes))
+        cgroup.update_stats(0, 42, 'localhost')
+
+    # the first samples are the baseline of the tasks running before
+    sample({1: 10, 2: 5})
+    assert cgroup.stats_total.ac_utime == 0
+    sample({1: 20, 2: 8})
+    assert cgroup.stats_total.ac_utime == 20 - 10 + 8 - 5
+    assert set(backend.task_index) == set([1, 2])
+
+    # the tracked task 2 exits, the untracked task 3 starts and exits
+    cgroup.account_exit(2, make_stats(9))
+    cgroup.account_exit(3, make_stats(4))
+    assert set(backend.task_index) == set([1])
+    assert list(cgroup.task_columns.tids) == [1]
+
+    sample({1: 25})
+    assert cgroup.stats_total.ac_utime == 25 - 10 + 9 - 5 + 4
+
+
+def test_exited_thread_group_keeps_missing_counters(tmp_path):
+    '''The exit notification of a thread group has no CPU times'''
+    backend = FakeTaskstatsBackend()
+    backend.options = argparse.Namespace(taskstats_per_process=True)
+    cgroup = CGroupInfo(str(tmp_path), backend)
+
+    def sample(utimes):
+        backend.utimes = utimes
+        (tmp_path / 'cgroup.procs').write_text(
+            "\n".join(str(tid) for tid in utimes))
+        cgroup.update_stats(0, 42, 'localhost')
+
+    sample({1: 10})
+    sample({1: 15})
+    cgroup.account_exit(1, make_stats(0))
+    sample({})
+    assert cgroup.stats_total.ac_utime == 15 - 10